@@ -22,6 +22,8 @@ from petram.model import Domain, Bdry, Point, Pair
 import petram.debug
 dprint1, dprint2, dprint3 = petram.debug.init_dprints('Engine')
 from petram.helper.matrix_file import write_coo_matrix, write_vector
+from petram.sol.solbin import write_solbin, solbin_header
+from petram.sol.solbin import SolbinFile, is_solbin
 
 def iter_phys(phys_targets, *args):
     for phys in phys_targets:
@@ -74,6 +76,7 @@ class Engine(object):
         self.max_attr = -1        
         self.sol_extra = None
         self.sol = None
+        self._coo_patterns = {} # block layout -> GlobalCooPattern
 
         self._r_x_old = {}
         self._i_x_old = {}
@@ -87,6 +90,12 @@ class Engine(object):
         #               physics moduel provides a map form variable name to index.
 
         self.case_base = 0
+
+        # evaluate coefficients on all integration points at once
+        # (set by solver. see Phys.set_quadrature_table)
+        self.vectorized_coeff = False
+        from petram.phys.quadrature_table import QuadratureTableCache
+        self.coeff_cache = QuadratureTableCache()
         
     @property
     def n_matrix(self):
@@ -525,12 +534,15 @@ class Engine(object):
                    form.Assemble()
             
             self.extras = {}        
+            self.extras_updated = []
             for phys in phys_target:               
-                self.assemble_extra(phys, phys_range)
+                self.assemble_extra(phys, phys_range, update=update)
             self.aux_ops = {}
             #for phys in phys_target:               
-            self.assemble_aux_ops(phys_target, phys_range)
-                
+            self.assemble_aux_ops(phys_target, phys_range, update=update)
+
+        if self.vectorized_coeff:
+            dprint1(self.coeff_cache.info())
         return np.any(self.mask_M)
 
     def run_assemble_b(self, phys_target = None, update=False):
@@ -559,6 +571,8 @@ class Engine(object):
         self.access_idx = 0
         for phys in phys_target:
             self.fill_lf(phys, update)
+        for extra_name, dep_name in getattr(self, 'extras_updated', []):
+            self.mask_B[self.dep_var_offset(extra_name)] = True
 
         self.r_b.set_no_allocator()
         self.i_b.set_no_allocator()
@@ -629,7 +643,10 @@ class Engine(object):
         #M[0].save_to_file("M0there")                        
         #Ae.save_to_file("Ae")
         RHS = self.eliminateBC(Ae, X[0], RHS)  # modify RHS and
-        A, RHS = self.apply_interp(A, RHS)     # A and RHS is modifedy by global DoF coupling P
+        if isAnew:
+            A, RHS = self.apply_interp(A, RHS) # A and RHS is modifedy by global DoF coupling P
+        else:
+            RHS = self.apply_interp(RHS=RHS)   # A is reused. it has been modified already
         #M[0].save_to_file("M0there2")                        
         #M[1].save_to_file("M1")
         #X[0].save_to_file("X0")
@@ -639,6 +656,23 @@ class Engine(object):
         
         #= [A, X, RHS, Ae,  B,  M, self.dep_vars[:]]
         return self.assembled_blocks, M_changed
+
+    def run_combine_blocks(self, compute_A, compute_rhs, M, B,
+                           inplace = True):
+        '''
+        make A and RHS from M, B blockmatrices given from outside,
+        such as M, B which are combined from assembled ones 
+        (affine parameter decomposition).
+        '''
+        X = self.assembled_blocks[1]
+        A2, isAnew = compute_A(M, B, X, self.mask_M, self.mask_B)
+        A, Ae = self.fill_BCeliminate_matrix(A2, inplace=inplace)
+        RHS = compute_rhs(M, B, X)
+        RHS = self.eliminateBC(Ae, X[0], RHS)
+        A, RHS = self.apply_interp(A, RHS)
+        
+        self.assembled_blocks = [A, X, RHS, Ae,  B,  M, self.dep_vars[:]]
+        return self.assembled_blocks
      
     def run_update_B_blocks(self):
         '''
@@ -763,34 +797,51 @@ class Engine(object):
                 igf = self.i_x[r_ifes]
             else:
                 igf = None
-            fr, fi = self.solfile_name(names[kfes], emesh_idx)
+            keyr, keyi = self.solfile_name(names[kfes], emesh_idx)
             meshname = 'solmesh_' + str(emesh_idx) + suffix
-            fr = fr + suffix
-            fi = fi + suffix
+            fr = keyr + suffix
+            fi = keyi + suffix
         
             path = os.path.expanduser(init_path)
             if path == '': path = os.getcwd()
             fr = os.path.join(path, fr)
             fi = os.path.join(path, fi)
             meshname = os.path.join(path, meshname)
+            binname = os.path.join(path, solbin_header + suffix)
 
+            solbin = None
+            if not os.path.exists(fr) and is_solbin(binname):
+               solbin = SolbinFile(binname)
+               
             rgf.Assign(0.0)
             if igf is not None: igf.Assign(0.0)
             if not os.path.exists(meshname):
                assert False, "Meshfile for sol does not exist:"+meshname
-            if not os.path.exists(fr):
-               assert False, "Solution (real) does not exist:"+fr
-            if igf is not None and not os.path.exists(fi): 
-               assert False, "Solution (imag) does not exist:"+fi
+            if solbin is not None:
+               if not keyr in solbin:
+                   assert False, "Solution (real) does not exist:"+binname
+               if igf is not None and not keyi in solbin:
+                   assert False, "Solution (imag) does not exist:"+binname
+            else:
+               if not os.path.exists(fr):
+                   assert False, "Solution (real) does not exist:"+fr
+               if igf is not None and not os.path.exists(fi): 
+                   assert False, "Solution (imag) does not exist:"+fi
 
             m = mfem.Mesh(str(meshname), 1, 1)
             m.ReorientTetMesh()            
-            solr = mfem.GridFunction(m, str(fr))
+            if solbin is not None:
+               solr = solbin.gridfunction(keyr, m, mfem)
+            else:
+               solr = mfem.GridFunction(m, str(fr))
             if solr.Size() != rgf.Size():
                assert False, "Solution file (real) has different length!!!"
             rgf += solr
             if igf is not None:
-               soli = mfem.GridFunction(m, str(fi))
+               if solbin is not None:
+                   soli = solbin.gridfunction(keyi, m, mfem)
+               else:
+                   soli = mfem.GridFunction(m, str(fi))
                if soli.Size() != igf.Size():
                    assert False, "Solution file (imag) has different length!!!"
                igf += soli
@@ -1003,7 +1054,7 @@ class Engine(object):
     def fill_coupling(self, coupling, phys_target):
         raise NotImplementedError("Coupling is not supported")
   
-    def assemble_extra(self, phys, phys_range):
+    def assemble_extra(self, phys, phys_range, update=False):
         for mm in phys.walk():
             if not mm.enabled: continue
             for phys2 in phys_range:
@@ -1025,8 +1076,15 @@ class Engine(object):
                         assert False, "extra with key= " + str(key) + " already exists."
                     self.extras[key] = tmp
                     self.extras_mm[key] = mm.fullpath()
+                    if update and mm.update_flag:
+                        r = self.dep_var_offset(extra_name)
+                        c = self.r_dep_var_offset(dep_var)
+                        self.mask_M[self.access_idx, r, c] = True
+                        self.mask_M[self.access_idx, c, r] = True
+                        self.mask_M[self.access_idx, r, r] = True
+                        self.extras_updated.append(key)
                     
-    def assemble_aux_ops(self, phys_target, phys_range):
+    def assemble_aux_ops(self, phys_target, phys_range, update=False):
         allmm = [mm for phys in phys_target for mm in phys.walk() if mm.is_enabled()]
         for phys1 in phys_target:
             names = phys1.dep_vars           
@@ -1043,6 +1101,10 @@ class Engine(object):
                                            test_ess_tdof=gl_ess_tdof1,
                                            trial_ess_tdof=gl_ess_tdof2)
                         self.aux_ops[(name1, name2, mm.fullpath())] = op
+                        if update and mm.update_flag:
+                            r = self.dep_var_offset(name1)
+                            c = self.r_dep_var_offset(name2)
+                            self.mask_M[self.access_idx, r, c] = True
 
     def assemble_interp(self, phys):
         names = phys.dep_vars
@@ -1408,31 +1470,39 @@ class Engine(object):
         return X
      
     def finalize_coo_matrix(self, M_block, is_complex, convert_real = False,
-                            verbose=True):
+                            interleave = False, verbose=True):
         if verbose: dprint1("A (in finalizie_coo_matrix) \n",  M_block)       
+        from petram.helper.block_matrix import GlobalCooPattern
+        key = M_block.get_layout()
+        if convert_real: key = (key, 'real', interleave)
+        if not key in self._coo_patterns:
+            self._coo_patterns[key] = GlobalCooPattern()
+        pattern = self._coo_patterns[key]
+        
         if not convert_real:
             if is_complex:
-                M = M_block.get_global_coo(dtype='complex')           
+                M = M_block.get_global_coo(dtype='complex', pattern=pattern)
             else:
-                M = M_block.get_global_coo(dtype='float')                          
+                M = M_block.get_global_coo(dtype='float', pattern=pattern)
         else:
-            M = M_block.get_global_coo(dtype='complex')                      
-            M = scipy.sparse.bmat([[M.real, -M.imag], [M.imag, M.real]], format='coo')
+            # [[M.real, -M.imag], [M.imag, M.real]] built block by block
+            M = M_block.get_global_coo_real(pattern=pattern,
+                                            interleave=interleave)
             # (this one make matrix symmetric, for now it is off to do the samething
             #  as GMRES case)
             # M = scipy.sparse.bmat([[M.real, -M.imag], [-M.imag, -M.real]], format='coo')
         return M
 
     def finalize_coo_rhs(self, b, is_complex,
-                         convert_real = False,
+                         convert_real = False, interleave = False,
                          verbose=True):
         if verbose: dprint1("b (in finalizie_coo_rhs) \n",  b)
-        B = b.gather_densevec()
         if convert_real:
-             B = np.vstack((B.real, B.imag))
+             B = b.gather_densevec_real(interleave=interleave)
              # (this one make matrix symmetric)           
              # B = np.vstack((B.real, -B.imag))
         else:
+           B = b.gather_densevec()
            if not is_complex:
               pass
              # B = B.astype(float)
@@ -1526,7 +1596,13 @@ class Engine(object):
     
     def save_sol_to_file(self, phys_target, skip_mesh = False,
                                mesh_only = False,
-                               save_parmesh = False):
+                               save_parmesh = False,
+                               binary = False):
+        '''
+        binary = True writes all GridFunctions of this rank to one
+        binary container (see petram.sol.solbin), instead of
+        solr_*/soli_* text files.
+        '''
         if not skip_mesh:
             mesh_filenames =self.save_mesh()
         if save_parmesh:
@@ -1534,19 +1610,30 @@ class Engine(object):
         if mesh_only: return mesh_filenames
 
         self.access_idx = 0
+        gfs = []
         for phys in phys_target:
             emesh_idx = phys.emesh_idx
             for name in phys.dep_vars:
                 ifes = self.r_ifes(name)
                 r_x = self.r_x[ifes]
                 i_x = self.i_x[ifes]
-                self.save_solfile_fespace(name, emesh_idx, r_x, i_x)
+                if binary:
+                    gfs.extend(self.solfile_entries(name, emesh_idx,
+                                                    r_x, i_x))
+                else:
+                    self.save_solfile_fespace(name, emesh_idx, r_x, i_x)
+        if binary:
+            self.save_solbin(gfs)
+        else:
+            self.clear_solmesh_files(solbin_header)
                 
     def extrafile_name(self):
         return 'sol_extended.data'
      
-    def save_extra_to_file(self, sol_extra):
+    def save_extra_to_file(self, sol_extra, binary = False):
         if sol_extra is None: return
+        if binary:
+            return self.save_extra_to_binfile(sol_extra)
         
         extrafile_name = self.extrafile_name()+self.solfile_suffix()
 
@@ -1572,12 +1659,74 @@ class Engine(object):
                          fid.write(str(kk) + ' ' + str(d) +'\n')
         fid.close()
         self.sol_extra = sol_extra # keep it for future reuse
+
+    extrafile_magic = 'PetraM-extra-binary 1\n'
+    
+    def save_extra_to_binfile(self, sol_extra):
+        '''
+        same metadata as text format. each data is written as
+        little-endian raw bytes following its header.
+        '''
+        extrafile_name = self.extrafile_name()+self.solfile_suffix()
+
+        fid = open(extrafile_name, 'wb')
+        fid.write(self.extrafile_magic.encode())
+        for name in sol_extra.keys():
+            for k in sol_extra[name].keys():
+                data = sol_extra[name][k]
+                ndim = data.ndim
+                data = np.ascontiguousarray(data.flatten())
+                if ndim != 0: sol_extra[name][k] = data
+                dtype = data.dtype.newbyteorder('<')
+                header = ('name : ' + name + '.' + str(k) +'\n' +
+                          'size : ' + str(data.size) +'\n' +
+                          'dim : ' + str(ndim) +'\n' +
+                          'dtype: ' + str(data.dtype) +'\n' +
+                          'bytes: ' + str(data.size*dtype.itemsize) +'\n')
+                fid.write(header.encode())
+                data.astype(dtype, copy=False).tofile(fid)
+        fid.close()
+        self.sol_extra = sol_extra # keep it for future reuse
+
+    def load_extra_from_binfile(self, path):
+        size = os.path.getsize(path)
+        buf = bytearray(size)
+        fid = open(path, 'rb')
+        fid.readinto(buf)
+        fid.close()
+
+        sol_extra = {}
+        pos = len(self.extrafile_magic)
+        def readline():
+            end = buf.index(b'\n', pos)
+            return end + 1, str(buf[pos:end].decode().split(':')[1].strip())
+        while pos < size:
+            pos, name = readline()
+            name, name2 = name.split('.')
+            if not name in sol_extra: sol_extra[name]={}
+            pos, count = readline()
+            pos, dim = readline()
+            pos, dtype = readline()
+            pos, nbytes = readline()
+            dtype = np.dtype(dtype).newbyteorder('<')
+            # no copy. arrays share buf
+            data = np.frombuffer(buf, dtype=dtype, count=int(count),
+                                 offset=pos)
+            sol_extra[name][name2] = data
+            pos = pos + int(nbytes)
+        return sol_extra
         
     def load_extra_to_file(self, init_path):
         sol_extra = {}
         extrafile_name = self.extrafile_name()+self.solfile_suffix()
         
         path = os.path.join(init_path, extrafile_name)
+
+        fid = open(path, 'rb')
+        magic = fid.read(len(self.extrafile_magic))
+        fid.close()
+        if magic == self.extrafile_magic.encode():
+            return self.load_extra_from_binfile(path)
         
         fid = open(path, 'r')
         line = fid.readline()
@@ -1788,6 +1937,7 @@ class Engine(object):
         self.meshes = []
         self.emeshes = []
         self.emesh_data = MeshExt()
+        self.coeff_cache.clear()
         if meshmodel is None:
             parent = self.model['Mesh']
             children =  [parent[g] for g in parent.keys()
@@ -1884,6 +2034,22 @@ class Engine(object):
         if i_x is not None:
             i_x.SaveToFile(fnamei, 8)
 
+    def solfile_entries(self, name, mesh_idx, r_x, i_x):
+        fnamer, fnamei = self.solfile_name(name, mesh_idx)
+
+        # text files of the same variable would shadow the container
+        self.clear_solmesh_files(fnamer)
+        self.clear_solmesh_files(fnamei)
+
+        gfs = [(fnamer, r_x)]
+        if i_x is not None:
+            gfs.append((fnamei, i_x))
+        return gfs
+
+    def save_solbin(self, gfs):
+        write_solbin(solbin_header + self.solfile_suffix(), gfs,
+                     merge = True)
+
     def save_mesh(self):
         mesh_names = []
         suffix=self.solfile_suffix()
@@ -2075,14 +2241,26 @@ class Engine(object):
             #           "Use InitSetting to load value from previous SolveStep: ", k)               
             self.model._variables[k] = variables[k]
 
-    def set_update_flag(self, mode):
+    def set_update_flag(self, mode, names=None):
+        '''
+        set update_flag of model objects, which is used to choose
+        forms to be renewed when assembling with update = True
+          TimeDependent : objects checked as time dependent
+          ParamChanged : objects whose contributions depend on names
+                         (None means all names are changed)
+        '''
+        count = 0
         for k in self.model['Phys'].keys():
             for mm in self.model['Phys'][k].walk():
                mm._update_flag = False
                if mode == 'TimeDependent':
                   if mm.isTimeDependent: mm._update_flag = True
+               elif mode == 'ParamChanged':
+                  if mm.depends_on(names): mm._update_flag = True
                else:
                   assert False, "update mode not supported: mode = "+mode
+               if mm._update_flag: count += 1
+        dprint1("number of model objects to be updated", count)
        
 class SerialEngine(Engine):
     def __init__(self, modelfile='', model=None):
@@ -2163,6 +2341,7 @@ class SerialEngine(Engine):
             if file.startswith('solmesh'): os.remove(os.path.join(d, file))
             if file.startswith('solr'): os.remove(os.path.join(d, file))
             if file.startswith('soli'): os.remove(os.path.join(d, file))
+            if file.startswith(solbin_header): os.remove(os.path.join(d, file))
 
 
     def a2A(self, a):  # BilinearSystem to matrix
@@ -2227,6 +2406,7 @@ class ParallelEngine(Engine):
         self.meshes = []
         self.emeshes = []
         self.emesh_data = MeshExt()
+        self.coeff_cache.clear()
         
         if meshmodel is None:
             parent = self.model['Mesh']
@@ -2239,7 +2419,18 @@ class ParallelEngine(Engine):
                 for k in child.keys():
                     o = child[k]
                     if not o.enabled: continue
-                    if o.isMeshGenerator:                    
+                    if isinstance(o, MeshFile) and o.cache_partition:
+                        pmesh = o.run_par()
+                        def gmax(arr):
+                            v = max(arr) if len(arr) > 0 else -1
+                            return MPI.COMM_WORLD.allreduce(v, op=MPI.MAX)
+                        self.max_bdrattr = np.max([self.max_bdrattr,
+                                                   gmax(pmesh.GetBdrAttributeArray())])
+                        self.max_attr = np.max([self.max_attr,
+                                                gmax(pmesh.GetAttributeArray())])
+                        self.meshes[idx] = pmesh
+                        target = self.meshes[idx]
+                    elif o.isMeshGenerator:                    
                         smesh = o.run()
                         self.max_bdrattr = np.max([self.max_bdrattr,
                                                    max(smesh.GetBdrAttributeArray())])
@@ -2499,6 +2690,8 @@ class ParallelEngine(Engine):
                 if file.startswith('solmesh'): os.remove(os.path.join(d, file))
                 if file.startswith('solr'): os.remove(os.path.join(d, file))
                 if file.startswith('soli'): os.remove(os.path.join(d, file))
+                if file.startswith(solbin_header):
+                    os.remove(os.path.join(d, file))
         else:
             pass
         MPI.COMM_WORLD.Barrier()
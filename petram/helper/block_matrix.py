@@ -82,15 +82,24 @@ class ScipyCoo(coo_matrix):
         return convert_to_ScipyCoo(ret)
 
     def setDiag(self, idx, value=1.0):
-        ret = self.tolil()
-        idx = np.array(idx, dtype=int, copy=False)
-        ret[idx,idx] = value
-        #for i in idx:
-        #   ret[i,i] = value
-        ret = ret.tocoo()
-        self.data = ret.data
-        self.row  = ret.row
-        self.col  = ret.col
+        # diagonal is set without changing the existing sparsity pattern.
+        # entries are appended only for missing diagonal elements
+        data, row, col = assign_diag(self.data.copy(), self.row, self.col,
+                                     self.shape, idx, value)
+        self.data = data
+        self.row  = row
+        self.col  = col
+
+    def _set_data(self, data, inplace, row=None, col=None):
+        row = self.row if row is None else row
+        col = self.col if col is None else col
+        if inplace:
+            self.data = data
+            self.row  = row
+            self.col  = col
+            return self
+        else:
+            return ScipyCoo((data, (row, col)), shape=self.shape)
     '''    
     def resetDiagImag(self, idx):
         ret = self.tolil()
@@ -104,32 +113,17 @@ class ScipyCoo(coo_matrix):
     '''    
 
     def resetRow(self, rows, inplace=True):
-        ret = self.tolil()
-        rows = np.array(rows, dtype=int, copy=False)
-        ret[rows, :] = 0.0                
-        ret = ret.tocoo()
-        
-        if inplace:
-            self.data = ret.data
-            self.row  = ret.row
-            self.col  = ret.col
-            return self
-        else:
-            return ret
+        # entries are set to zero, but kept in the sparsity pattern
+        flag = index_flag(rows, self.shape[0])
+        data = self.data.copy()
+        data[flag[self.row]] = 0.0
+        return self._set_data(data, inplace)
        
     def resetCol(self, cols, inplace=True):
-        ret = self.tolil()
-        cols = np.array(cols, dtype=int, copy=False)
-        ret[:, cols] = 0.0                
-        #for c in cols: 
-        ret = ret.tocoo()
-        if inplace:
-            self.data = ret.data
-            self.row  = ret.row
-            self.col  = ret.col
-            return self
-        else:
-            return ret
+        flag = index_flag(cols, self.shape[1])
+        data = self.data.copy()
+        data[flag[self.col]] = 0.0
+        return self._set_data(data, inplace)
      
     def selectRows(self, nonzeros):
         m = self.tocsr()
@@ -231,37 +225,26 @@ class ScipyCoo(coo_matrix):
     GetPartitioningArray = GetRowPartArray
 
     def eliminate_RowsCols(self, tdof, inplace=True):
-        print("inplace flag off copying matrix")
         # A + Ae style elimination
-        idx = np.in1d(self.col,tdof)
-        idx2 = np.in1d(self.row,tdof)        
+        # eliminated entries are kept as explicit zeros, so that the
+        # sparsity pattern of matrix does not change.
+        tdof = np.array(tdof, dtype=int, copy=False)
+        idx = index_flag(tdof, self.shape[1])[self.col]
+        idx2 = index_flag(tdof, self.shape[0])[self.row]
         diag = self.diagonal()[tdof]-1
 
         aidx = np.logical_or(idx, idx2)
-        AeCol  = self.col[aidx]
-        AeRow  = self.row[aidx]
-        AeData = self.data[aidx]
+        AeData, AeRow, AeCol = assign_diag(self.data[aidx], self.row[aidx],
+                                           self.col[aidx], self.shape,
+                                           tdof, diag)
         Ae2 = coo_matrix((AeData, (AeRow, AeCol)),
                          shape=self.shape, dtype=self.dtype)
-        Ae2c = Ae2.tocsr()
-        Ae2c[tdof, tdof] = diag
-        Ae2 = Ae2c.tocoo()
 
-        if inplace:
-            target=self
-        else:
-            target = self.copy()
-        
-        target.data[idx] = 0        
-        target.data[idx2] = 0
-        target.eliminate_zeros()
-        lil2 = target.tolil()        
-        lil2[tdof, tdof] = 1.
-        coo = lil2.tocoo()
-        target.data = coo.data
-        target.row = coo.row
-        target.col = coo.col
-        return Ae2, target
+        data = self.data.copy()
+        data[aidx] = 0
+        data, row, col = assign_diag(data, self.row, self.col, self.shape,
+                                     tdof, 1.0)
+        return Ae2, self._set_data(data, inplace, row=row, col=col)
 
         '''
         # this one is slower
@@ -292,6 +275,41 @@ class ScipyCoo(coo_matrix):
         self.row = coo.row
         self.col = coo.col
         
+def index_flag(idx, size):
+    '''
+    boolean array of length size, which is True at idx
+    (flag[coo.row] is used in place of np.in1d(coo.row, idx))
+    '''
+    flag = np.zeros(size, dtype=bool)
+    flag[np.array(idx, dtype=int, copy=False)] = True
+    return flag
+
+def assign_diag(data, row, col, shape, idx, value):
+    '''
+    set diagonal elements (idx, idx) of coo data to value.
+    existing entries are overwritten (duplicated entries are handled
+    as one element) and missing entries are appended.
+    data is modified.
+    '''
+    idx = np.array(idx, dtype=int, copy=False)
+    value = np.broadcast_to(value, idx.shape)
+    idx, uidx = np.unique(idx, return_index=True)
+    if len(idx) == 0: return data, row, col
+    value = value[uidx]
+    
+    pos = np.where(np.logical_and(row == col,
+                                  index_flag(idx, shape[0])[row]))[0]
+    data[pos] = 0
+    drow, first = np.unique(row[pos], return_index=True)
+    data[pos[first]] = value[np.searchsorted(idx, drow)]
+
+    missing = np.logical_not(index_flag(drow, shape[0])[idx])
+    if np.any(missing):
+        row = np.hstack((row, idx[missing].astype(row.dtype)))
+        col = np.hstack((col, idx[missing].astype(col.dtype)))
+        data = np.hstack((data, value[missing].astype(data.dtype)))
+    return data, row, col
+
 def convert_to_ScipyCoo(mat):
     if isinstance(mat, np.ndarray):
        mat = coo_matrix(mat)
@@ -301,6 +319,50 @@ def convert_to_ScipyCoo(mat):
        mat.__class__ = ScipyCoo
     return mat
 
+class DistributedSolution(object):
+    '''
+    solution of linear system kept on each node (used in place of
+    solution matrix gathered to root node)
+
+    blocks[k] : local part of k-th block. array of (local size, # of solutions)
+    '''
+    def __init__(self, blocks):
+        self.blocks = blocks
+
+    def __repr__(self):
+        return "DistributedSolution" + str([b.shape for b in self.blocks])
+     
+class GlobalCooPattern(object):
+    '''
+    frozen sparsity pattern of global coo matrix made from BlockMatrix
+
+    global row/col arrays are computed once and kept together with
+    row/col of each block. When the next BlockMatrix has the same
+    blocks pattern, only data arrays are collected.
+    '''
+    def __init__(self):
+        self.blocks = None
+        self.row = None
+        self.col = None
+        self.flags = None
+
+    def set(self, gcoos, row, col, flags = None):
+        self.blocks = [(gcoo.shape, gcoo.row, gcoo.col) for gcoo in gcoos]
+        self.row = row
+        self.col = col
+        self.flags = flags
+
+    def is_same(self, gcoos, flags = None):
+        if self.blocks is None: return False
+        if len(self.blocks) != len(gcoos): return False
+        if self.flags != flags: return False
+        for (shape, row, col), gcoo in zip(self.blocks, gcoos):
+            if shape != gcoo.shape: return False
+            if row is gcoo.row and col is gcoo.col: continue
+            if not (np.array_equal(row, gcoo.row) and
+                    np.array_equal(col, gcoo.col)): return False
+        return True
+            
 class BlockMatrix(object):
     def __init__(self, shape, kind = default_kind, complex=False):
         '''
@@ -455,12 +517,16 @@ class BlockMatrix(object):
             for j in range(self.shape[1]):
                 name = file +'_'+str(i)+'_'+str(j)
                 v = self[i,j]
+                # rows are local to rank. row_offset is kept so that
+                # read_coo_matrix can assemble the global matrix
                 if isinstance(v, chypre.CHypreMat):
                     m = v.get_local_coo()
-                    write_coo_matrix(name, m)
+                    write_coo_matrix(name, m,
+                                     row_offset = v.GetRowPartArray()[0])
                 elif isinstance(v, chypre.CHypreVec):
                     m = coo_matrix(v.toarray()).transpose()
-                    write_coo_matrix(name, m)
+                    write_coo_matrix(name, m,
+                                     row_offset = v.GetPartitioningArray()[0])
                 elif isinstance(v, ScipyCoo):
                     write_coo_matrix(name, v)                   
                 elif v is None:
@@ -621,13 +687,16 @@ class BlockMatrix(object):
         so that matrix can be multiplied from the right of this 
 
         self is a block diagonal matrix
+
+        mat can be DistributedSolution. In this case, local part of
+        solution is used directly.
         '''
         L = []
         idx = 0
         imask = [x for x in range(len(mask[0])) if mask[0][x]]
         jmask = [x for x in range(len(mask[1])) if mask[1][x]]        
         
-        for j in jmask:
+        for k, j in enumerate(jmask):
             for i in imask:
                if self[i,j] is not None:
                   l =  self[i, j].shape[1]
@@ -635,6 +704,10 @@ class BlockMatrix(object):
             L.append(l)
             ref = self[i,j]
 
+            if isinstance(mat, DistributedSolution):
+                v = mat.blocks[k][:, ksol]
+                ret.set_element_from_distributed(v, j, 0, ref)
+                continue
             if mat is not None:
                 v = mat[idx:idx+l, ksol]
             else:
@@ -677,6 +750,28 @@ class BlockMatrix(object):
                 v = comm.bcast(v)
                 self[i, j] = v.reshape(-1,1)
 
+    def set_element_from_distributed(self, v, i, j, ref):
+        ''' 
+        set element using local part of vector. 
+        (local part is given by column partitioning of ref)
+        '''
+        if self.kind == 'scipy':
+            self[i, j] = v.reshape(-1,1)
+        elif ref.isHypre:
+            v = np.ascontiguousarray(v)
+            if np.iscomplexobj(v):
+                rv = ToHypreParVec(np.ascontiguousarray(v.real))
+                iv = ToHypreParVec(np.ascontiguousarray(v.imag))
+                self[i,j] = chypre.CHypreVec(rv, iv)
+            else:
+                rv = ToHypreParVec(v)    
+                self[i,j] = chypre.CHypreVec(rv, None)
+        else:
+            # non-distributed element is stored only in root node
+            from mpi4py import MPI
+            v = MPI.COMM_WORLD.bcast(v)
+            self[i, j] = v.reshape(-1,1)
+            
     def get_squaremat_from_right(self, r, c):
         size = self[r, c].shape
         if self.kind == 'scipy':
@@ -713,6 +808,38 @@ class BlockMatrix(object):
                                      ":" + str(type(self[i,0])))
             return np.hstack(data).reshape(-1,1)
 
+    def gather_densevec_real(self, interleave = False):
+        '''
+        gather vector data to head node as real dense data (for rhs).
+        real and imaginary parts are written into a preallocated
+        array in the same ordering as get_global_coo_real
+        '''
+        data = []
+        for i in range(self.shape[0]):
+            v = self[i,0]
+            if isinstance(v, chypre.CHypreVec):
+                data.append(v.GlobalVector())
+            elif isinstance(v, np.ndarray):
+                data.append(v.ravel())
+            elif isinstance(v, spmatrix):
+                data.append(v.toarray().ravel())
+            else:
+                raise ValueError("Unsupported element" + str((i,0)) + 
+                                 ":" + str(type(v)))
+        sizes = np.array([len(d) for d in data], dtype=int)
+        offsets = np.hstack([0, np.cumsum(sizes)])
+        if interleave:
+            ro = (2*offsets[:-1], 2*offsets[:-1] + sizes)
+        else:
+            ro = (offsets[:-1], offsets[:-1] + offsets[-1])
+
+        B = np.zeros((2*offsets[-1], 1), dtype=float)
+        for i, d in enumerate(data):
+            B[ro[0][i]:ro[0][i]+sizes[i], 0] = d.real
+            if np.iscomplexobj(d):
+                B[ro[1][i]:ro[1][i]+sizes[i], 0] = d.imag
+        return B
+
     def get_global_offsets(self, convert_real = False,
                                  interleave = True):
         '''
@@ -743,26 +870,108 @@ class BlockMatrix(object):
         coffsets = np.hstack([0, np.cumsum(coffset)])
         return roffsets, coffsets
 
-    def get_global_coo(self, dtype = 'float'):
+    def get_layout(self):
+        '''
+        block structure (position and shape of non-None blocks)
+        '''
+        return tuple([(i, j, self[i,j].shape)
+                      for i in range(self.shape[0])
+                      for j in range(self.shape[1])
+                      if self[i,j] is not None])
+     
+    def get_global_coo(self, dtype = 'float', pattern = None):
+        '''
+        pattern : GlobalCooPattern. if given, global row/col arrays are
+                  reused when the sparsity pattern of blocks is unchanged.
+        '''
         roffsets, coffsets = self.get_global_offsets()
-        col = []
-        row = []
-        data = []
         glcoo = coo_matrix((roffsets[-1], coffsets[-1]), dtype = dtype)
         dprint1("roffset(get_global_coo)", roffsets)
-        for i in range(self.shape[0]):
-            for j in range(self.shape[1]):
-                if self[i,j] is None: continue
-                gcoo = self[i,j].get_global_coo()
-                row.append(gcoo.row + roffsets[i])                
-                col.append(gcoo.col + coffsets[j])
-                data.append(gcoo.data)
-        glcoo.col = np.hstack(col)
-        glcoo.row = np.hstack(row)
+        gcoos = [self[i,j].get_global_coo() for i, j, s in self.get_layout()]
+        data = [gcoo.data for gcoo in gcoos]
+        
+        if pattern is not None and pattern.is_same(gcoos):
+            dprint2("get_global_coo: reusing index arrays")
+            row, col = pattern.row, pattern.col
+        else:
+            row = np.hstack([gcoo.row + roffsets[i]
+                             for (i, j, s), gcoo in zip(self.get_layout(), gcoos)])
+            col = np.hstack([gcoo.col + coffsets[j]
+                             for (i, j, s), gcoo in zip(self.get_layout(), gcoos)])
+            if pattern is not None:
+                pattern.set(gcoos, row, col)
+        glcoo.col = col
+        glcoo.row = row
         glcoo.data = np.hstack(data)
 
         return glcoo
 
+    def get_global_coo_real(self, pattern = None, interleave = False):
+        '''
+        real 2x2 equivalent of complex global coo
+             [[M.real, -M.imag], [M.imag, M.real]]
+
+        row/col/data are written directly from the real/imaginary
+        part of each block into preallocated arrays, so that complex
+        global matrix is not formed.
+
+        interleave = False : unknowns are Re (all), Im (all)
+        interleave = True  : unknowns are Re FES1, Im FES1, Re FES2, ...
+        pattern : GlobalCooPattern (see get_global_coo)
+        '''
+        roffsets, coffsets = self.get_global_offsets()
+        layout = self.get_layout()
+        gcoos = [self[i,j].get_global_coo() for i, j, s in layout]
+        flags = tuple([np.iscomplexobj(gcoo.data) for gcoo in gcoos])
+
+        if interleave:
+            ro = (2*roffsets[:-1], 2*roffsets[:-1] + np.diff(roffsets))
+            co = (2*coffsets[:-1], 2*coffsets[:-1] + np.diff(coffsets))
+        else:
+            ro = (roffsets[:-1], roffsets[:-1] + roffsets[-1])
+            co = (coffsets[:-1], coffsets[:-1] + coffsets[-1])
+
+        # (row, col, sign, use imag) of 2x2 sub-blocks
+        parts = ((0, 0, 1, False), (1, 1, 1, False),
+                 (0, 1, -1, True), (1, 0, 1, True))
+
+        nnz = sum([len(gcoo.data)*(4 if c else 2)
+                   for gcoo, c in zip(gcoos, flags)])
+        data = np.empty(nnz, dtype=float)
+        reuse = pattern is not None and pattern.is_same(gcoos, flags)
+        if reuse:
+            dprint2("get_global_coo_real: reusing index arrays")
+            row, col = pattern.row, pattern.col
+        else:
+            size = 2*max(roffsets[-1], coffsets[-1])
+            itype = np.int32 if size < np.iinfo(np.int32).max else np.int64
+            row = np.empty(nnz, dtype=itype)
+            col = np.empty(nnz, dtype=itype)
+
+        k = 0
+        for (i, j, s), gcoo, c in zip(layout, gcoos, flags):
+            n = len(gcoo.data)
+            for pr, pc, sign, use_imag in parts:
+                if use_imag and not c: continue
+                d = gcoo.data.imag if use_imag else gcoo.data.real
+                if sign > 0:
+                    data[k:k+n] = d
+                else:
+                    np.negative(d, out=data[k:k+n])
+                if not reuse:
+                    np.add(gcoo.row, ro[pr][i], out=row[k:k+n], casting='unsafe')
+                    np.add(gcoo.col, co[pc][j], out=col[k:k+n], casting='unsafe')
+                k = k + n
+
+        if not reuse and pattern is not None:
+            pattern.set(gcoos, row, col, flags)
+
+        glcoo = coo_matrix((2*roffsets[-1], 2*coffsets[-1]), dtype = float)
+        glcoo.row = row
+        glcoo.col = col
+        glcoo.data = data
+        return glcoo
+
     #
     #  methods for distributed csr format
     #
@@ -25,9 +25,11 @@
      For ND, and RT, M^-1 needs inversion. 
 '''
 
+import os
 import numpy as np
 import scipy
 from scipy.sparse import lil_matrix
+from scipy.spatial import cKDTree
 import petram.debug as debug
 debug.debug_default_level = 1
 dprint1, dprint2, dprint3 = debug.init_dprints('dof_map')
@@ -56,6 +58,21 @@ mapper_debug = False
 gf_debug = False
 element_data_debug = False
 
+# in parallel, destination element data is routed to the owner of
+# spatial bins instead of being allgathered (see route_destination_data)
+distributed_mapping = False
+
+# mapping matrices are stored in map_cache_dir and reused when mesh,
+# FE space, boundary, transformation and partitioning are the same.
+# (off by default. set PetraM_UseMapCache=1 to use it)
+# least recently used files are removed when the total size of cache
+# exceeds map_cache_size (MB)
+use_map_cache = os.getenv('PetraM_UseMapCache', '0') == '1'
+map_cache_size = float(os.getenv('PetraM_MapCacheSize', '1000'))
+map_cache_dir = os.getenv('PetraM_MapCache',
+                          os.path.join(os.path.expanduser('~'), '.petram',
+                                       'mapcache'))
+
 methods = {}
 methods['Dom'] = {'N': 'GetNE',
                   'AttributeArray': 'GetAttributeArray',
@@ -204,8 +221,16 @@ def resolve_nonowned_dof(pt1all, pt2all, k1all, k2all, map_1_2):
     resolves shadowed DoF
     this is done based on integration point distance.
     It searches a closeest true (non-shadow) DoF point
+    (KD-tree of true DoF points is used for the search)
     '''
     k2all = np.stack(k2all)
+    if len(k2all) == 0: return k2all
+    
+    pts = np.array(pt2all).reshape(len(k2all)*k2all.shape[1], -1)
+    fdof = k2all[:,:,2].flatten()
+    owned = np.where(fdof != -1)[0]
+    if len(owned) > 0: tree = cKDTree(pts[owned])
+    
     for k in range(len(pt1all)):
         subvdof1 = k1all[k][:,2]
         k2 = map_1_2[k]
@@ -215,24 +240,17 @@ def resolve_nonowned_dof(pt1all, pt2all, k1all, k2all, map_1_2):
         if -1 in subvdof2:
                 check = True
                 dprint2('before resolving dof', subvdof2)
+                assert len(owned) > 0, "failed to resolve shadow DoF"
         for kk, x in enumerate(subvdof2):
              if x == -1:
-                dist = pt2all-pt2[kk]
-                dist = np.sqrt(np.sum((dist)**2, -1))
-                fdist= dist.flatten()
-                isort = np.argsort(fdist)
-                minidx =  np.where(dist.flatten() == np.min(dist.flatten()))[0]
-                #dprint1("distances", np.min(dist),fdist[isort[:25]])
-                while all(k2all[:,:,2].flatten()[minidx] == -1):
-                    dprint2("distances (non -1 exists?)", fdist[minidx],
-                            k2all[:,:,2].flatten()[minidx])
-                    minidx = np.hstack((minidx, isort[len(minidx)]))
-                dprint2("distances", np.min(dist),fdist[minidx],
-                        fdist[isort[:len(minidx)+1]])                    
-                dprint2("minidx",  minidx, k2all[:,:,2].flatten()[minidx])
-                for i in minidx:
-                    if k2all[:,:,2].flatten()[i] != -1:
-                       subvdof2[kk] = k2all[:,:,2].flatten()[i]
+                # candidates are true DoF points closest to pt2[kk]
+                d, i = tree.query(pt2[kk])
+                cand = owned[tree.query_ball_point(pt2[kk], d*(1+1e-8)+1e-300)]
+                cand = np.union1d(cand, [owned[i]])
+                dist = np.sqrt(np.sum((pts[cand]-pt2[kk])**2, -1))
+                minidx = cand[dist == np.min(dist)]
+                dprint2("distances", np.min(dist), "minidx", minidx, fdof[minidx])
+                subvdof2[kk] = fdof[minidx[-1]]
 
         if check:
              dprint2('resolved dof', k2all[k2][:,2])
@@ -245,8 +263,9 @@ def map_dof_scalar(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
                trans1, trans2, tol, tdof, rstart):
 
     pt = []
-    subvdofs1 = []
+    subvdofs1 = set()
     subvdofs2 = []
+    tdof = set(tdof)
 
     num_entry = 0
     num_pts = 0
@@ -259,7 +278,7 @@ def map_dof_scalar(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
         P = ToScipyCoo(P).tocsr()
         VDoFtoGTDoF = P.indices  #this is global TrueDoF (offset is not subtracted)
         external_entry = []
-        gtdof_check = []
+        gtdof_check = set()
         
     for k0 in range(len(pt1all)):
         k2 = map_1_2[k0]
@@ -271,12 +290,13 @@ def map_dof_scalar(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
         pto2 = pto2all[k2]
         newk2 = k2all[k2]
         sh2 = sh2all[k2]
+        dist_all = np.sum((pt1[:, None, :] - pt2[None, :, :])**2, -1)
         for k, p in enumerate(pt1):
             num_pts = num_pts + 1
             if newk1[k,2] in tdof: continue
             if newk1[k,2] in subvdofs1: continue               
 
-            dist = np.sum((pt2-p)**2, 1)
+            dist = dist_all[k]
             d = np.where(dist == np.min(dist))[0]
             if myid == 1: dprint2('min_dist', np.min(dist))
 
@@ -292,7 +312,7 @@ def map_dof_scalar(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
                    map[newk1[k][2]-rstart, 
                        newk2[d][2]] = value
                    num_entry = num_entry + 1
-                   subvdofs1.append(newk1[k][2])
+                   subvdofs1.add(newk1[k][2])
                else:
                    # for scalar, this is perhaps not needed
                    # rr = newk1[k][1]] if newk1[k][1]] >= 0 else -1-newk1[k][1]]
@@ -301,7 +321,7 @@ def map_dof_scalar(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
                    gtdof = VDoFtoGTDoF[newk1[k][1]]
                    if not gtdof in gtdof_check:
                        external_entry.append((gtdof, newk2[d][2], value))
-                       gtdof_check.append(gtdof)
+                       gtdof_check.add(gtdof)
                    
 
             else:
@@ -313,7 +333,7 @@ def map_dof_scalar(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
     if use_parallel:
         dprint1("total entry (before)",sum(allgather(num_entry)))
         #nicePrint(len(subvdofs1), subvdofs1)
-        external_entry =  sum(comm.allgather(external_entry),[])
+        external_entry = exchange_external_entry(external_entry, fes1)
         for r, c, d in external_entry:
            h = map.shape[0]
            if (r - rstart >= 0 and r - rstart < h and
@@ -321,7 +341,7 @@ def map_dof_scalar(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
                num_entry = num_entry + 1                                 
                print("adding",myid, r,  c, d )
                map[r-rstart, c] = d
-               subvdofs1.append(r)
+               subvdofs1.add(r)
         total_entry = sum(allgather(num_entry))
         total_pts = sum(allgather(num_pts))
         if sum(allgather(map.nnz)) != total_entry:
@@ -340,8 +360,9 @@ def map_dof_vector(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
                    trans1, trans2, tol, tdof, rstart):
 
     pt = []
-    subvdofs1 = []
+    subvdofs1 = set()
     subvdofs2 = []
+    tdof = set(tdof)
 
     num1 = 0
     num2 = 0    
@@ -355,7 +376,7 @@ def map_dof_vector(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
         P = ToScipyCoo(P).tocsr()
         VDoFtoGTDoF = P.indices  #this is global TrueDoF (offset is not subtracted)
         external_entry = []
-        gtdof_check = []
+        gtdof_check = set()
         
     def make_entry(r, c, value, num_entry):
         value = np.around(value, decimals)
@@ -363,13 +384,13 @@ def map_dof_vector(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
         if r[1] != -1: 
             map[r[1]-rstart, c] = value 
             num_entry = num_entry + 1
-            subvdofs1.append(r[1])
+            subvdofs1.add(r[1])
         else:
             rr = r[0] if r[0] >= 0 else -1-r[0]
             gtdof = VDoFtoGTDoF[rr]
             if not gtdof in gtdof_check:
                external_entry.append((gtdof, c, value))
-               gtdof_check.append(gtdof)
+               gtdof_check.add(gtdof)
         return num_entry      
         
     for k0 in range(len(pt1all)):
@@ -386,12 +407,13 @@ def map_dof_vector(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
         #if myid == 1:
         #    x = [r if r >= 0 else -1-r for r in newk1[:,1]]
         #    print [VDoFtoGTDoF[r] for r in x]
+        dist_all = np.sum((pt1[:, None, :] - pt2[None, :, :])**2, -1)
         for k, p in enumerate(pt1):
             num_pts = num_pts + 1
             if newk1[k,2] in tdof: continue
             if newk1[k,2] in subvdofs1: continue               
 
-            dist = np.sum((pt2-p)**2, 1)
+            dist = dist_all[k]
             d = np.where(dist == np.min(dist))[0]
             #if myid == 1: dprint1('min_dist', np.min(dist))
             if len(d) == 1:            
@@ -522,7 +544,7 @@ def map_dof_vector(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
     if use_parallel:
         dprint1("total entry (before)",sum(allgather(num_entry)))
         #nicePrint(len(subvdofs1), subvdofs1)
-        external_entry =  sum(comm.allgather(external_entry),[])
+        external_entry = exchange_external_entry(external_entry, fes1)
         #nicePrint(external_entry)        
         for r, c, d in external_entry:
            h = map.shape[0]
@@ -531,7 +553,7 @@ def map_dof_vector(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
                num_entry = num_entry + 1                                 
                print("adding",myid, r,  c, d )
                map[r-rstart, c] = d
-               subvdofs1.append(r)
+               subvdofs1.add(r)
         total_entry = sum(allgather(num_entry))
         total_pts = sum(allgather(num_pts))
         if sum(allgather(map.nnz)) != total_entry:
@@ -546,9 +568,98 @@ def map_dof_vector(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all,
                              
     return map
 
+def exchange_external_entry(external_entry, fes):
+    '''
+    send (gtdof, col, value) entries to the node which owns gtdof
+    (returns entries received by this node)
+    '''
+    rstarts = np.array(comm.allgather(fes.GetMyTDofOffset()))
+    send = [[] for i in range(num_proc)]
+    for entry in external_entry:
+        send[np.searchsorted(rstarts, entry[0], 'right')-1].append(entry)
+    return sum(comm.alltoall(send), [])
+
+def spatial_bin_owner(ct, lo, h, nb):
+    idx = np.clip(np.floor((ct - lo)/h).astype(int), 0, nb-1)
+    return np.ravel_multi_index(idx.transpose(), (nb,)*ct.shape[1]) % num_proc
+
+def route_destination_data(ct1, ct2, k2all, pt2all, pto2all, sh2all, fes2):
+    '''
+    find destination element for each source element without
+    allgathering the destination side.
+
+    destination elements are sent to the owner of spatial bins of their
+    centers, and source element centers are sent to the owner of their
+    bin. the owner answers with the closest destination element data.
+    shadowed DoFs on destination are resolved before sending using
+    the Dof_TrueDof matrix of fes2.
+
+    returns ctr_dist, k2all, pt2all, pto2all, sh2all aligned to ct1
+    '''
+    import itertools
+    from mfem.common.parcsr_extra import ToScipyCoo
+    
+    P = ToScipyCoo(fes2.Dof_TrueDof_Matrix()).tocsr()
+    VDoFtoGTDoF = P.indices  #this is global TrueDoF 
+    k2all = [k.copy() for k in k2all]
+    for k in k2all:
+        idx = k[:,2] == -1
+        rr = np.array([x if x >= 0 else -1-x for x in k[idx, 1]], dtype=int)
+        k[idx, 2] = VDoFtoGTDoF[rr]
+
+    # spatial bins
+    dim = ct1.shape[1]
+    pts = np.vstack((ct1, ct2))
+    ranges = comm.allgather((np.min(pts, 0), np.max(pts, 0))
+                            if len(pts) > 0 else None)
+    ranges = [x for x in ranges if x is not None]
+    if len(ranges) == 0:
+        return np.array([]), (), (), (), []
+    lo = np.min([x[0] for x in ranges], 0)
+    hi = np.max([x[1] for x in ranges], 0)
+    nb = int(np.ceil((4*num_proc)**(1./dim)))
+    h = (hi - lo)/nb
+    h[h == 0] = 1.0
+    eps = 1e-6*np.max(hi - lo)
+    
+    send = [[] for i in range(num_proc)]
+    if len(ct2) > 0:
+        # destination goes to all bins within eps, so that slightly
+        # shifted source center finds it
+        owners = np.vstack([spatial_bin_owner(ct2 + np.array(off), lo, h, nb)
+                            for off in itertools.product([-eps, eps],
+                                                         repeat = dim)])
+        for k in range(len(ct2)):
+            for o in np.unique(owners[:, k]):
+                send[o].append((ct2[k], k2all[k], pt2all[k], pto2all[k],
+                                sh2all[k]))
+    dest = sum(comm.alltoall(send), [])
+
+    send = [[] for i in range(num_proc)]
+    if len(ct1) > 0:
+        owners = spatial_bin_owner(ct1, lo, h, nb)
+        for k in range(len(ct1)):
+            send[owners[k]].append((k, ct1[k]))
+    queries = comm.alltoall(send)
+
+    if sum([len(q) for q in queries]) > 0:
+        assert len(dest) > 0, "destination element is not found"
+        tree = cKDTree(np.vstack([d[0] for d in dest]))
+    send = [[] for i in range(num_proc)]
+    for rank, q in enumerate(queries):
+        for k, c in q:
+            dist, i = tree.query(c)
+            send[rank].append((k, dist**2) + tuple(dest[i][1:]))
+    answers = sorted(sum(comm.alltoall(send), []), key = lambda x: x[0])
+    if len(answers) == 0:
+        return np.array([]), (), (), (), []
+    
+    k, ctr_dist, k2all, pt2all, pto2all, sh2all = zip(*answers)
+    return np.array(ctr_dist), k2all, pt2all, pto2all, list(sh2all)
+
 def gather_dataset(idx1, idx2, fes1, fes2, trans1,
                                trans2, tol, shape_type = 'scalar',
-                               mode = 'surface'):
+                               mode = 'surface', distributed = False):
 
     if fes2 is None: fes2 = fes1
     if trans1 is None: trans1=notrans
@@ -594,13 +705,15 @@ def gather_dataset(idx1, idx2, fes1, fes2, trans1,
     except:
        k2all, pt2all, pto2all = (), (), ()
 
+    distributed = distributed and use_parallel
     if use_parallel:
        # share ibr2 (destination information among nodes...)
        ct1dim = ct1.shape[1] if ct1.size > 0 else 0
        ct1dim = comm.allgather(ct1dim)
        ct1 = np.atleast_2d(ct1).reshape(-1, max(ct1dim))       
        ct2 = np.atleast_2d(ct2).reshape(-1, max(ct1dim))
-       ct2 =  allgather_vector(ct2, MPI.DOUBLE)
+       if not distributed:
+           ct2 =  allgather_vector(ct2, MPI.DOUBLE)
        fesize1 = fes1.GetTrueVSize()
        fesize2 = fes2.GlobalTrueVSize()
        rstart = fes1.GetMyTDofOffset()
@@ -609,14 +722,22 @@ def gather_dataset(idx1, idx2, fes1, fes2, trans1,
        fesize2 = fes2.GetNDofs()
        rstart = 0
     
-    ctr_dist = np.array([np.min(np.sum((ct2-c)**2, 1)) for c in ct1])
+    # mapping between elements (closest element center)
+    if distributed:
+        ctr_dist, k2all, pt2all, pto2all, sh2all = route_destination_data(
+                       ct1, ct2, k2all, pt2all, pto2all, sh2all, fes2)
+        map_1_2 = list(range(len(ct1)))
+    elif len(ct1) > 0 and len(ct2) > 0:
+        ctr_dist, map_1_2 = cKDTree(ct2).query(ct1)
+        ctr_dist = ctr_dist**2
+        map_1_2 = list(map_1_2)
+    else:
+        ctr_dist = np.array([]); map_1_2 = []
     if ctr_dist.size > 0 and np.max(ctr_dist) > 1e-15:
        print('Center Dist may be too large (check mesh): ' + 
             str(np.max(ctr_dist)))
-    # mapping between elements
-    map_1_2= [np.argmin(np.sum((ct2-c)**2, 1)) for c in ct1]
 
-    if use_parallel:
+    if use_parallel and not distributed:
        pt2all =  sum(comm.allgather(pt2all),())
        pto2all = sum(comm.allgather(pto2all),())
        k2all =  sum(comm.allgather(k2all),())
@@ -631,7 +752,8 @@ def gather_dataset(idx1, idx2, fes1, fes2, trans1,
     return  map, data, map_1_2, rstart    
 
 def map_xxx_h1(xxx, idx1, idx2, fes1, fes2=None, trans1=None,
-                   trans2=None, tdof1=None, tdof2=None, tol=1e-4):
+                   trans2=None, tdof1=None, tdof2=None, tol=1e-4,
+                   distributed=False):
     '''
     map DoF on surface to surface
 
@@ -651,7 +773,7 @@ def map_xxx_h1(xxx, idx1, idx2, fes1, fes2=None, trans1=None,
     tdof = tdof1 # ToDo support tdof2    
     map, data, elmap, rstart = gather_dataset(idx1, idx2, fes1, fes2, trans1,
                                               trans2, tol, shape_type = 'scalar',
-                                              mode=xxx)
+                                              mode=xxx, distributed=distributed)
 
 
     pt1all, pt2all, pto1all, pto2all, k1all, k2all, sh1all, sh2all  = data
@@ -714,7 +836,8 @@ def map_edge_h1(idx1, idx2, fes1, fes2=None, trans1=None,
     return map
 ''' 
 def map_xxx_nd(xxx, idx1, idx2, fes1, fes2=None, trans1=None,
-                   trans2=None, tdof1=None, tdof2=None, tol=1e-4):
+                   trans2=None, tdof1=None, tdof2=None, tol=1e-4,
+                   distributed=False):
  
     '''
     map DoF on surface to surface
@@ -735,7 +858,7 @@ def map_xxx_nd(xxx, idx1, idx2, fes1, fes2=None, trans1=None,
     tdof = tdof1 # ToDo support tdof2    
     map, data, elmap, rstart = gather_dataset(idx1, idx2, fes1, fes2, trans1,
                                               trans2, tol, shape_type = 'vector',
-                                              mode=xxx)
+                                              mode=xxx, distributed=distributed)
     pt1all, pt2all, pto1all, pto2all, k1all, k2all, sh1all, sh2all  = data
     
     map_dof_vector(map, fes1, fes2, pt1all, pt2all, pto1all, pto2all, 
@@ -798,13 +921,144 @@ def map_surface_nd(idx1, idx2, fes1, fes2=None, trans1=None,
 # map_surface_rt = map_surface_nd
 # map_surface_l2 = map_surface_h1
 
+def _hash_update(h, x):
+    h.update(x if isinstance(x, bytes) else str(x).encode())
+    
+def value_repr(v):
+    '''
+    repr used for hashing. arrays are represented by its data, since
+    repr of a large array is abbreviated.
+    '''
+    if isinstance(v, np.ndarray):
+        import hashlib
+        return repr(('array', v.shape, v.dtype.str,
+                hashlib.md5(np.ascontiguousarray(v).tobytes()).hexdigest()))
+    if isinstance(v, (list, tuple)):
+        return repr([value_repr(x) for x in v])
+    return repr(v)
+
+def func_signature(f):
+    '''
+    signature of transformation function (code, global names used in
+    code and closure)
+    '''
+    code = getattr(f, '__code__', None)
+    if code is None: return repr(f)
+    g = getattr(f, '__globals__', {})
+    values = [value_repr(g.get(n, None)) for n in code.co_names]
+    closure = [value_repr(c.cell_contents) for c in (f.__closure__ or [])]
+    return (repr(code.co_code) + repr(code.co_consts) + repr(code.co_names) +
+            repr(values) + repr(closure))
+ 
+def mesh_signature(h, mesh):
+    nv = mesh.GetNV()
+    _hash_update(h, (mesh.Dimension(), mesh.SpaceDimension(), nv,
+                     mesh.GetNE(), mesh.GetNBE()))
+    if nv > 0:
+        from petram.mesh.mesh_utils import vertex_array
+        h.update(np.ascontiguousarray(vertex_array(mesh)).tobytes())
+    h.update(np.ascontiguousarray(mesh.GetAttributeArray()).tobytes())
+    h.update(np.ascontiguousarray(mesh.GetBdrAttributeArray()).tobytes())
+    
+def map_cache_key(mode, idx1, idx2, fes1, fes2, trans1, trans2,
+                  tdof1, tdof2, tol, distributed):
+    import hashlib
+    h = hashlib.md5()
+    _hash_update(h, (mode, sorted(list(idx1)), sorted(list(idx2)), tol,
+                     distributed, num_proc, myid))
+    for fes in (fes1, fes2):
+        _hash_update(h, (fes.FEColl().Name(), fes.GetVDim(), fes.GetVSize()))
+        if use_parallel:
+            _hash_update(h, (fes.GetTrueVSize(), fes.GetMyTDofOffset()))
+        mesh_signature(h, fes.GetMesh())
+    for tdof in (tdof1, tdof2):
+        tdof = [] if tdof is None else tdof
+        h.update(np.ascontiguousarray(tdof, dtype=int).tobytes())
+    for trans in (trans1, trans2):
+        _hash_update(h, func_signature(trans))
+    return h.hexdigest()
+
+def cached_mapper(mapper, idx1, idx2, fes, fes2=None, trans1=None,
+                  trans2=None, tdof1=None, tdof2=None, tol=1e-4,
+                  distributed=False, mode=''):
+    '''
+    call mapper, or load the mapping matrix computed before from
+    map_cache_dir. All nodes either load or compute (mapper uses MPI).
+    '''
+    if not use_map_cache:
+        return mapper(idx1, idx2, fes, fes2=fes2, trans1=trans1,
+                      trans2=trans2, tdof1=tdof1, tdof2=tdof2, tol=tol,
+                      distributed=distributed)
+    from scipy.sparse import save_npz, load_npz
+    
+    key = map_cache_key(mode, idx1, idx2, fes, fes if fes2 is None else fes2,
+                        trans1, trans2, tdof1, tdof2, tol, distributed)
+    path = os.path.join(map_cache_dir, 'map_' + key + '.npz')
+    if all(allgather(os.path.exists(path))):
+        try:
+            map = load_npz(path).tolil()
+            success = True
+        except:
+            success = False
+        if all(allgather(success)):
+            dprint1("mapping matrix is loaded from cache", path)
+            try:
+                os.utime(path, None)  # mark as recently used
+            except OSError:
+                pass
+            return map
+        
+    map = mapper(idx1, idx2, fes, fes2=fes2, trans1=trans1, trans2=trans2,
+                 tdof1=tdof1, tdof2=tdof2, tol=tol, distributed=distributed)
+    try:
+        if not os.path.exists(map_cache_dir):
+            try:
+                os.makedirs(map_cache_dir)
+            except OSError:
+                pass  # other node may have created it at the same time
+        save_npz(path, map.tocsr())
+        if myid == 0: prune_map_cache()
+    except:
+        # cache is not available (e.g. directory is not writable)
+        dprint1("failed to write mapping matrix cache", path)
+    return map
+
+def prune_map_cache():
+    '''
+    remove least recently used files until the total size of cache
+    is smaller than map_cache_size
+    '''
+    files = [os.path.join(map_cache_dir, x) for x in os.listdir(map_cache_dir)
+             if x.startswith('map_') and x.endswith('.npz')]
+    stats = []
+    for x in files:
+        try:
+            st = os.stat(x)
+        except OSError:
+            continue
+        stats.append((st.st_mtime, st.st_size, x))
+    stats = sorted(stats, reverse=True)
+
+    total = 0
+    for mtime, size, x in stats:
+        total = total + size
+        if total > map_cache_size*1024*1024:
+            try:
+                os.remove(x)
+            except OSError:
+                pass
+
 def projection_matrix(idx1,  idx2,  fes, tdof1, fes2=None, tdof2=None,
                       trans1=None, trans2 = None, dphase=0.0, weight = None,
-                      tol = 1e-7, mode = 'surface', filldiag=True):
+                      tol = 1e-7, mode = 'surface', filldiag=True,
+                      distributed = None):
     '''
      map: destinatiom mapping 
      smap: source mapping
+     distributed: use distributed mapping in parallel.
+                  (default is given by distributed_mapping)
     '''
+    if distributed is None: distributed = distributed_mapping
     fec_name = fes.FEColl().Name()
 
     if fec_name.startswith('ND') and mode == 'volume':
@@ -822,8 +1076,9 @@ def projection_matrix(idx1,  idx2,  fes, tdof1, fes2=None, tdof2=None,
     else:
         raise NotImplementedError("mapping :" + fec_name + ", mode: " + mode)
 
-    map = mapper(idx2, idx1, fes, fes2=fes2, trans1=trans1, trans2=trans2, tdof1=tdof1,
-                 tdof2=tdof2, tol=tol)
+    map = cached_mapper(mapper, idx2, idx1, fes, fes2=fes2, trans1=trans1,
+                        trans2=trans2, tdof1=tdof1, tdof2=tdof2, tol=tol,
+                        distributed=distributed, mode=mode)
 
 
     if weight is None:
@@ -858,9 +1113,9 @@ def projection_matrix(idx1,  idx2,  fes, tdof1, fes2=None, tdof2=None,
         end_row = map.shape[0]
 
     if filldiag:
-        for i in range(min(map.shape[0], map.shape[1])):
-            r = start_row+i
-            if not r in col: map[i, r] = 1.0
+        i = np.arange(min(map.shape[0], map.shape[1]))
+        i = i[np.logical_not(np.in1d(start_row+i, col))]
+        if len(i) > 0: map[i, start_row+i] = 1.0
         
     from scipy.sparse import coo_matrix, csr_matrix
     if use_parallel:
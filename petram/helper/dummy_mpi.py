@@ -9,6 +9,8 @@ class CommWorld(object):
         pass
     def bcast(self, *args, **kwargs):
         pass
+    def allgather(self, obj):
+        return [obj]
     
 class MPIclass(object):
     def __init__(self, *args, **kwargs):
@@ -0,0 +1,297 @@
+'''
+   expression_compiler
+
+   compile a Python expression string into a form which is evaluated
+   once on arrays of many points (nodes/integration points), instead of
+   evaluating the expression point by point.
+
+   Values which change point by point (such as Variable values) are
+   given as arrays whose first axis is the point index (batch axis).
+   Inside the expression, such a value behaves as the value at one
+   point. For example, when E is given as (N, 3) array,
+      dot(E, conj(E))*sigma
+   returns (N,) array, which is the same as what is obtained by
+   evaluating the expression N times.
+
+   The AST of expression is walked once, and operators, subscriptions,
+   list displays and function calls are replaced by helpers which know
+   the batch axis. Compiled code is cached per expression string.
+
+   Expressions using constructs which can not be evaluated this way
+   (conditional expression, boolean operators, comprehension, calls to
+   user functions with batch arguments...) raise NotVectorizable. The
+   caller is expected to fall back to point-by-point evaluation.
+
+   Usage:
+      value = eval_batch(expr, g, {'E': E_array, 'sigma': sigma_array})
+'''
+import ast
+import operator
+import numpy as np
+
+class NotVectorizable(Exception):
+    pass
+
+class BatchArray(np.ndarray):
+    '''
+    ndarray whose first axis is batch axis
+    '''
+    pass
+
+def is_batch(v):
+    return isinstance(v, BatchArray)
+
+def as_batch(v):
+    return np.asarray(v).view(BatchArray)
+
+def _point_ndim(v):
+    return v.ndim - 1 if is_batch(v) else np.ndim(v)
+
+def _align(args):
+    '''
+    align per-point shapes of batch arrays so that numpy broadcasting works
+    as if it is done point by point
+    '''
+    k = max([_point_ndim(a) for a in args])
+    ret = []
+    for a in args:
+        if is_batch(a) and a.ndim - 1 < k:
+            shape = a.shape[:1] + (1,)*(k - a.ndim + 1) + a.shape[1:]
+            a = a.reshape(shape)
+        ret.append(a)
+    return ret
+
+_binops = {'Add': operator.add,
+           'Sub': operator.sub,
+           'Mult': operator.mul,
+           'Div': getattr(operator, 'div', operator.truediv),
+           'FloorDiv': operator.floordiv,
+           'Mod': operator.mod,
+           'Pow': operator.pow,
+           'Eq': operator.eq,
+           'NotEq': operator.ne,
+           'Lt': operator.lt,
+           'LtE': operator.le,
+           'Gt': operator.gt,
+           'GtE': operator.ge,}
+
+def _binop(name, a, b):
+    if not is_batch(a) and not is_batch(b):
+        return _binops[name](a, b)
+    a, b = _align([a, b])
+    return as_batch(_binops[name](a, b))
+
+def _getitem(a, idx):
+    if not is_batch(a): return a[idx]
+    if not isinstance(idx, tuple): idx = (idx,)
+    for i in idx:
+        if is_batch(i): raise NotVectorizable("batch index")
+    return a[(slice(None),) + idx]
+
+def _list(*args):
+    if not any([is_batch(a) for a in args]): return list(args)
+    n = [len(a) for a in args if is_batch(a)][0]
+    args = [a if is_batch(a) else
+            as_batch(np.broadcast_to(a, (n,) + np.shape(a)))
+            for a in args]
+    args = _align(args)
+    shape = np.broadcast(*args).shape
+    args = [np.broadcast_to(a, shape) for a in args]
+    return as_batch(np.stack(args, axis=1))
+
+def _tuple(*args):
+    if not any([is_batch(a) for a in args]): return tuple(args)
+    return _list(*args)
+
+def _sum(a, *args):
+    if not is_batch(a) or len(args) > 0:
+        if any([is_batch(x) for x in args]): raise NotVectorizable("sum")
+        if is_batch(a): raise NotVectorizable("sum with axis")
+        return np.sum(a, *args)
+    if a.ndim == 1: return a
+    return as_batch(np.sum(a.reshape(a.shape[0], -1), -1))
+
+def _dot(a, b):
+    if not is_batch(a) and not is_batch(b): return np.dot(a, b)
+    if _point_ndim(a) > 1 or _point_ndim(b) > 1: raise NotVectorizable("dot")
+    if _point_ndim(a) == 0 or _point_ndim(b) == 0:
+        return _binop('Mult', a, b)
+    return as_batch(np.sum(np.asarray(a)*np.asarray(b), -1))
+
+def _vdot(a, b):
+    if not is_batch(a) and not is_batch(b): return np.vdot(a, b)
+    return _sum(_binop('Mult', np.conj(a), b))
+
+def _cross(a, b):
+    if not is_batch(a) and not is_batch(b): return np.cross(a, b)
+    if _point_ndim(a) != 1 or _point_ndim(b) != 1: raise NotVectorizable("cross")
+    return as_batch(np.cross(np.asarray(a), np.asarray(b), axis=-1))
+
+def _array(a, *args, **kwargs):
+    if is_batch(a): return a
+    if isinstance(a, list) and not any([is_batch(x) for x in a]):
+        return np.array(a, *args, **kwargs)
+    if isinstance(a, list): return _list(*a)
+    return np.array(a, *args, **kwargs)
+
+# numpy functions which need batch aware version
+_batch_funcs = [(np.sum, _sum),
+                (np.dot, _dot),
+                (np.vdot, _vdot),
+                (np.cross, _cross),
+                (np.array, _array),]
+# functions (which are not ufunc) working element by element
+_elementwise_funcs = [np.real, np.imag, np.angle, abs]
+
+def _call(func, *args):
+    if not any([is_batch(a) for a in args]): return func(*args)
+    for f, f2 in _batch_funcs:
+        if func is f: return f2(*args)
+    if isinstance(func, np.ufunc) or func in _elementwise_funcs:
+        if len(args) > 1: args = _align(args)
+        return as_batch(func(*args))
+    raise NotVectorizable("function call")
+
+def _getattr(a, name):
+    if is_batch(a) and not name in ('real', 'imag'):
+        raise NotVectorizable("attribute " + name)
+    return getattr(a, name)
+
+helpers = {'_binop': _binop,
+           '_getitem': _getitem,
+           '_list': _list,
+           '_tuple': _tuple,
+           '_call': _call,
+           '_getattr': _getattr,}
+
+def _name(n):
+    return ast.Name(id=n, ctx=ast.Load())
+
+def _const(s):
+    if hasattr(ast, 'Constant'):
+        return ast.Constant(value=s)
+    if s is None:
+        return _name('None')
+    return ast.Str(s=s)
+
+def _call_node(name, args):
+    return ast.Call(func=_name(name), args=args, keywords=[],
+                    starargs=None, kwargs=None)
+
+class _Transformer(ast.NodeTransformer):
+    def generic_visit(self, node):
+        if isinstance(node, (ast.IfExp, ast.BoolOp, ast.Lambda,
+                             ast.ListComp, ast.GeneratorExp, ast.Dict,
+                             ast.Set, ast.DictComp, ast.SetComp)):
+            raise NotVectorizable(node.__class__.__name__)
+        return super(_Transformer, self).generic_visit(node)
+
+    def visit_BinOp(self, node):
+        opname = node.op.__class__.__name__
+        if not opname in _binops: raise NotVectorizable(opname)
+        return _call_node('_binop', [_const(opname), self.visit(node.left),
+                                     self.visit(node.right)])
+
+    def visit_UnaryOp(self, node):
+        if isinstance(node.op, ast.Not): raise NotVectorizable('not')
+        return self.generic_visit(node)
+
+    def visit_Compare(self, node):
+        if len(node.ops) != 1: raise NotVectorizable('chained comparison')
+        opname = node.ops[0].__class__.__name__
+        if not opname in _binops: raise NotVectorizable(opname)
+        return _call_node('_binop', [_const(opname), self.visit(node.left),
+                                     self.visit(node.comparators[0])])
+
+    def _slice(self, node):
+        if isinstance(node, ast.Slice):
+            args = [self.visit(x) if x is not None else _const(None)
+                    for x in (node.lower, node.upper, node.step)]
+            return _call_node('slice', args)
+        if hasattr(ast, 'Index') and isinstance(node, ast.Index):
+            return self.visit(node.value)
+        if hasattr(ast, 'ExtSlice') and isinstance(node, ast.ExtSlice):
+            return ast.Tuple(elts=[self._slice(x) for x in node.dims],
+                             ctx=ast.Load())
+        if isinstance(node, ast.Tuple):
+            return ast.Tuple(elts=[self._slice(x) for x in node.elts],
+                             ctx=ast.Load())
+        return self.visit(node)
+
+    def visit_Subscript(self, node):
+        return _call_node('_getitem', [self.visit(node.value),
+                                       self._slice(node.slice)])
+
+    def visit_Attribute(self, node):
+        return _call_node('_getattr', [self.visit(node.value),
+                                       _const(node.attr)])
+
+    def visit_List(self, node):
+        return _call_node('_list', [self.visit(x) for x in node.elts])
+
+    def visit_Tuple(self, node):
+        return _call_node('_tuple', [self.visit(x) for x in node.elts])
+
+    def visit_Call(self, node):
+        if (len(node.keywords) > 0 or
+            getattr(node, 'starargs', None) is not None or
+            getattr(node, 'kwargs', None) is not None):
+            raise NotVectorizable('keyword argument')
+        return _call_node('_call', [self.visit(node.func)] +
+                                   [self.visit(x) for x in node.args])
+
+_compiled = {}
+
+def compile_expression(expr):
+    '''
+    return code object, or None if expression can not be vectorized.
+    '''
+    if expr in _compiled: return _compiled[expr]
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+        tree = _Transformer().visit(tree)
+        tree = ast.fix_missing_locations(tree)
+        code = compile(tree, '<vectorized>', 'eval')
+    except (NotVectorizable, SyntaxError):
+        code = None
+    _compiled[expr] = code
+    return code
+
+def eval_batch(expr, g, batch, check = None):
+    '''
+    evaluate expression on batch of points.
+        expr : expression string
+        g : namespace
+        batch: dictionary of values (arrays) whose first axis is batch axis
+        check: code object for point-by-point evaluation. If given, result is
+               compared with it at the first and the last points.
+
+    returns array whose first axis is the batch axis, or None if
+    the expression could not be vectorized.
+    '''
+    code = compile_expression(expr)
+    if code is None: return None
+
+    n = len(list(batch.values())[0])
+    l = {k: as_batch(v) for k, v in batch.items()}
+    g2 = g.copy()
+    g2.update(helpers)
+    try:
+        value = eval(code, g2, l)
+    except Exception:
+        return None
+
+    if is_batch(value):
+        value = np.asarray(value)
+        if value.shape[0] != n: return None
+    else:
+        value = np.array(value, copy=False)
+        value = np.stack([value]*n)
+
+    if check is not None and n > 0:
+        for i in set((0, n-1)):
+            v0 = np.array(eval(check, g,
+                               {k: batch[k][i] for k in batch}), copy=False)
+            if v0.shape != value[i].shape: return None
+            if not np.allclose(v0, value[i], equal_nan=True): return None
+    return value
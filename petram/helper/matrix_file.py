@@ -3,12 +3,19 @@
    
    a group of helper routine to read and write matrix/vector to file.
 
-
+   dump_format selects the format used by write_coo_matrix and
+   write_vector
+      'text'   : ascii (default)
+      'binary' : .npz (COO arrays + header) / .npy, full precision
+   It can be set by PetraM_DumpFormat environment variable.
+   Use read_coo_matrix to read binary matrix files.
 '''
 import numpy as np
 import os
 import six
 
+dump_format = os.getenv('PetraM_DumpFormat', 'text')
+
 def read_matvec(file, all = False, verbose=False, complex = False, skip = 0):
     ''' 
     read matrix/vector file.  
@@ -43,58 +50,66 @@ def read_matvec(file, all = False, verbose=False, complex = False, skip = 0):
        ret.append(np.array(xxx))
     return np.vstack(ret)
 
-def write_matrix(file, m):
+def rank_suffix():
     from petram.mfem_config import use_parallel
     if use_parallel:
        from mpi4py import MPI                               
-       num_proc = MPI.COMM_WORLD.size
        myid     = MPI.COMM_WORLD.rank
-       smyid = '.'+'{:0>6d}'.format(myid)
+       return '.'+'{:0>6d}'.format(myid)
     else:
-       smyid = ''
+       return ''
+
+def use_binary(binary):
+    if binary is None:
+        return dump_format == 'binary'
+    return binary
+
+def write_matrix(file, m):
+    smyid = rank_suffix()
     if hasattr(m, 'save_data'):
        m.save_data(file + smyid)
     else:
        raise NotImplemented("write matrix not implemented for" + m.__repr__())
 
 
-def write_vector(file, bb):
-    from petram.mfem_config import use_parallel
-    if use_parallel:
-       from mpi4py import MPI                               
-       num_proc = MPI.COMM_WORLD.size
-       myid     = MPI.COMM_WORLD.rank
-       smyid = '.'+'{:0>6d}'.format(myid)
-    else:
-       smyid = ''
+def write_vector(file, bb, binary = None):
+    smyid = rank_suffix()
 
     if hasattr(bb, "SaveToFile"):   # GridFunction
         bb.SaveToFile(file+smyid, 8)
+    elif use_binary(binary):
+        np.save(file+smyid+'.npy', np.asarray(bb))
     else:
         fid = open(file+smyid, "w")
         for k, x in enumerate(bb):
             fid.write(str(k) + ' ' + str(x) +'\n')
         fid.close()
 
-def write_coo_matrix(file, A):
-    from petram.mfem_config import use_parallel
-    if use_parallel:
-       from mpi4py import MPI                               
-       num_proc = MPI.COMM_WORLD.size
-       myid     = MPI.COMM_WORLD.rank
-       smyid = '.'+'{:0>6d}'.format(myid)
-    else:
-       smyid = ''
+def write_coo_matrix(file, A, binary = None, row_offset = 0):
+    '''
+    write COO matrix sorted by (row, col).
+
+    In binary mode, row_offset is stored in the header so that
+    read_coo_matrix can reassemble a matrix whose row index is local
+    to each rank.
+    '''
+    smyid = rank_suffix()
 
     if (A.dtype == 'complex'):
         is_complex = True
     else:
         is_complex = False
 
+    idx = np.lexsort((A.col, A.row))
+    if use_binary(binary):
+        np.savez(file+smyid+'.npz',
+                 format = 'coo',
+                 shape = np.array(A.shape),
+                 row_offset = row_offset,
+                 row = A.row[idx], col = A.col[idx], data = A.data[idx])
+        return
+    
     fid = open(file+smyid, 'w')
-    rc = np.vstack((A.row, A.col)).transpose()
-    tmp = sorted([(k, tuple(x)) for k, x in enumerate(rc)], key=lambda x:x[1])
-    idx = np.array([x[0] for x in tmp])
     if len(idx) == 0:
         fid.close()
         return
@@ -112,3 +127,34 @@ def write_coo_matrix(file, A):
                "{0:.5g}".format(a.imag)]) for r,c,a in zip(row, col, data)]
         fid.write('\n'.join(txt) + "\n")
     fid.close()
+
+def read_coo_matrix(file, all = True):
+    '''
+    read binary matrix file written by write_coo_matrix.
+    If all is on, COO arrays of all rank files ('matrix.000000.npz',
+    'matrix.000001.npz'...) are combined to one matrix.
+    '''
+    from scipy.sparse import coo_matrix
+    
+    if not all or file.endswith('.npz'):
+        files = [file if file.endswith('.npz') else file + '.npz']
+    else:
+        dir  = os.path.dirname(file)
+        base = os.path.basename(file)
+        files = sorted([x for x in os.listdir(dir if dir != '' else '.')
+                        if x.startswith(base + '.') and x.endswith('.npz')])
+        files = [os.path.join(dir, f) for f in files]
+    if len(files) == 0: return
+
+    rows = []; cols = []; datas = []
+    shape = [0, 0]
+    for f in files:
+        d = np.load(f)
+        offset = int(d['row_offset'])
+        rows.append(d['row'] + offset)
+        cols.append(d['col'])
+        datas.append(d['data'])
+        shape[0] = max(shape[0], offset + int(d['shape'][0]))
+        shape[1] = max(shape[1], int(d['shape'][1]))
+    return coo_matrix((np.hstack(datas), (np.hstack(rows), np.hstack(cols))),
+                      shape = shape)
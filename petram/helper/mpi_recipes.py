@@ -35,39 +35,6 @@ def allgather_vector(data, mpi_data_type = None):
     MPI.COMM_WORLD.Allgatherv(senddata, recvdata)
     return recvbuf.reshape(-1, *data.shape[1:])
 
-def gather_vector(data, mpi_data_type = None, root=0):
-    '''
-    gather vector to root node. 
-    B: Vector to be collected 
-    '''
-    from mfem.common.mpi_dtype import  get_mpi_datatype
-    if mpi_data_type is None:
-       mpi_data_type = get_mpi_datatype(data)
-
-    myid     = MPI.COMM_WORLD.rank
-    rcounts = data.shape[0]
-    rcounts = MPI.COMM_WORLD.gather(rcounts, root = root)
-    cm = np.hstack((0, np.cumsum(rcounts)))
-    disps = list(cm[:-1])        
-    recvdata = None
-    senddata = [data, data.shape[0]]
-
-    if myid ==root:
-        length =  cm[-1]
-        recvbuf = np.empty([length], dtype=data.dtype)
-        recvdata = [recvbuf, rcounts, disps, mpi_data_type]       
-    else:
-        recvdata = [None, rcounts, disps, mpi_data_type]
-        recvbuf = None
-    MPI.COMM_WORLD.Barrier()           
-    MPI.COMM_WORLD.Gatherv(senddata, recvdata,  root = root)
-    if myid == root:
-        #print 'collected'
-        MPI.COMM_WORLD.Barrier()
-        return np.array(recvbuf)
-    MPI.COMM_WORLD.Barrier()
-    return None
-
 def gather_vector(data, mpi_data_type = None, parent = False,
                   world = MPI.COMM_WORLD, root=0):
     '''
@@ -82,6 +49,8 @@ def gather_vector(data, mpi_data_type = None, parent = False,
        root group should call with data to tell the data type, like np.array(2)
        world should be specified
 
+    data is sent by a single Gatherv. counts are collected only
+    on root for intra-communication.
     '''
     from mfem.common.mpi_dtype import  get_mpi_datatype
     myid     = world.rank    
@@ -89,6 +58,7 @@ def gather_vector(data, mpi_data_type = None, parent = False,
     if mpi_data_type is None:
        mpi_data_type = get_mpi_datatype(data)
     
+    data = np.ascontiguousarray(data)
     if world.Is_intra():
         if myid == root: parent = True
         rcounts = data.shape[0]
@@ -102,26 +72,22 @@ def gather_vector(data, mpi_data_type = None, parent = False,
         senddata = [data, data.shape[0]]
         if myid == root: parent = True
 
-    rcounts = world.allgather(rcounts)
-    cm = np.hstack((0, np.cumsum(rcounts)))
-    disps = list(cm[:-1])        
+    if world.Is_intra():
+        rcounts = world.gather(rcounts, root = root)
+    else:
+        rcounts = world.allgather(rcounts)
 
     if parent:
+        cm = np.hstack((0, np.cumsum(rcounts)))
+        disps = list(cm[:-1])        
         length =  cm[-1]
         recvbuf = np.empty([length], dtype=data.dtype)
-        recvdata = [recvbuf, rcounts, disps, mpi_data_type]       
+        recvdata = [recvbuf, list(rcounts), disps, mpi_data_type]       
     else:
-        recvdata = [None, rcounts, disps, mpi_data_type]
+        recvdata = None
         recvbuf = None
-    world.Barrier()           
     world.Gatherv(senddata, recvdata,  root = root)
-    if parent:
-        #print 'collected'
-        world.Barrier()
-        return np.array(recvbuf)
-    else:
-        world.Barrier()
-        return None
+    return recvbuf
 
 def scatter_vector(vector, mpi_data_type, rcounts):
     # scatter data
@@ -130,16 +96,18 @@ def scatter_vector(vector, mpi_data_type, rcounts):
     # receives
     #
     # for example:     rcounts = fespace.GetTrueVSize()
+    #
+    # counts are collected only on root and data is sent by
+    # a single Scatterv
     senddata = None
     rcountss = MPI.COMM_WORLD.gather(rcounts, root = 0)
     #dprint1(rcountss)
-    disps = list(np.hstack((0, np.cumsum(rcountss)))[:-1])
     recvdata = np.empty([rcounts], dtype="float64")
     if vector is not None: 
-        sol = np.array(vector, dtype="float64")
+        disps = list(np.hstack((0, np.cumsum(rcountss)))[:-1])
+        sol = np.ascontiguousarray(vector, dtype="float64")
         senddata = [sol, rcountss, disps, mpi_data_type]
     MPI.COMM_WORLD.Scatterv(senddata, recvdata, root = 0)
-    MPI.COMM_WORLD.Barrier()        
     return recvdata
 
 def scatter_vector2(vector, mpi_data_type, rcounts = None):
@@ -226,7 +194,39 @@ def distribute_vec_from_head(b):
         comm.Recv([b0, MPItype], source=0, tag=myid)
     return b0
 
+def index_dtype(n):
+    '''
+    integer type (numpy dtype, MPI type) to hold global index < n
+    '''
+    if n < np.iinfo(np.int32).max:
+        return np.int32, MPI.INT32_T
+    return np.int64, MPI.INT64_T
+
+def alltoallv(data, scounts, rcounts, mpi_data_type, comm = MPI.COMM_WORLD):
+    '''
+    exchange data, which is sorted by destination rank.
+    scounts/rcounts : number of elements sent to/received from each rank
+    '''
+    sdisps = np.hstack((0, np.cumsum(scounts)[:-1]))
+    rdisps = np.hstack((0, np.cumsum(rcounts)[:-1]))
+    recvbuf = np.empty([np.sum(rcounts)], dtype=data.dtype)
+    senddata = [np.ascontiguousarray(data), (list(scounts), list(sdisps)),
+                mpi_data_type]
+    recvdata = [recvbuf, (list(rcounts), list(rdisps)), mpi_data_type]
+    comm.Alltoallv(senddata, recvdata)
+    return recvbuf
+
 def distribute_global_coo(A):
+    '''
+    redistribute COO matrix so that each rank owns the block
+    of rows given by get_partition. 
+
+    A is a part of global matrix (rows are in global index).
+    Destination of each entry is computed locally, and the entries
+    are exchanged by one counts exchange (alltoall) and Alltoallv
+    for row/col/data. Global index is kept in int64 when the matrix
+    size exceeds int32 range.
+    '''
     from mfem.common.mpi_dtype import  get_mpi_datatype           
 
     comm     = MPI.COMM_WORLD     
@@ -234,75 +234,25 @@ def distribute_global_coo(A):
     myid     = MPI.COMM_WORLD.rank
     
     partitioning = get_partition(A)
-    
-    row = A.row
-    col = A.col
-    data = A.data
-
-    ids = np.arange(num_proc)[::-1]
 
-    dtype = data.dtype
-    MPItype = get_mpi_datatype(data)
+    itype, MPIitype = index_dtype(max(A.shape))
+    MPItype = get_mpi_datatype(A.data)
 
-    row2 = []
-    col2 = []
-    data2 = []
-    
-    for i in range(num_proc):
-        ids = np.roll(ids, 1)
-        pair = ids[myid]
-        
-        idx = np.logical_and(row >= partitioning[pair], row < partitioning[pair+1])
-        r0 = row[idx].astype(np.int32)
-        c0 = col[idx].astype(np.int32)
-        d0 = data[idx]
-
-        if pair < myid: # send first
-            comm.send(r0.shape, dest=pair, tag=i)
-            comm.Send([r0, MPI.INT], dest=pair, tag=i)
-            comm.Send([c0, MPI.INT], dest=pair, tag=i)        
-            comm.Send([d0, MPItype], dest=pair, tag=i)
-
-            shape = comm.recv(source=pair, tag=i)                
-            r = np.zeros(shape, dtype = np.int32)
-            c = np.zeros(shape, dtype = np.int32)
-            d = np.zeros(shape, dtype = dtype)                
-            comm.Recv([r, MPI.INT], source=pair, tag=i)
-            comm.Recv([c, MPI.INT], source=pair, tag=i)
-            comm.Recv([d, MPItype], source=pair, tag=i)        
-        elif pair >  myid: # recv first
-            shape = comm.recv(source=pair, tag=i)
-            r = np.zeros(shape, dtype = np.int32)
-            c = np.zeros(shape, dtype = np.int32)
-            d = np.zeros(shape, dtype = dtype)               
-            comm.Recv([r, MPI.INT], source=pair, tag=i)
-            comm.Recv([c, MPI.INT], source=pair, tag=i)
-            comm.Recv([d, MPItype], source=pair, tag=i)                
-            
-            comm.send(r0.shape, dest=pair, tag=i)        
-            comm.Send([r0, MPI.INT], dest=pair, tag=i)
-            comm.Send([c0, MPI.INT], dest=pair, tag=i)        
-            comm.Send([d0, MPItype], dest=pair, tag=i)
-        else:
-            
-            r = r0; c = c0; d = d0
+    # sort entries by destination rank
+    dest = np.searchsorted(partitioning, A.row, side='right') - 1
+    idx = np.argsort(dest, kind='mergesort')
+    scounts = np.bincount(dest, minlength=num_proc).astype(np.int32)
+    rcounts = np.array(comm.alltoall(list(scounts)), dtype=np.int32)
 
-        row2.append(r)
-        col2.append(c)
-        data2.append(d)
+    r = alltoallv(A.row[idx].astype(itype), scounts, rcounts, MPIitype)
+    c = alltoallv(A.col[idx].astype(itype), scounts, rcounts, MPIitype)
+    d = alltoallv(A.data[idx], scounts, rcounts, MPItype)
 
     from scipy.sparse import coo_matrix
 
-    r = np.hstack(row2) - partitioning[myid]
-    c = np.hstack(col2)
-    d = np.hstack(data2)
-
+    r -= partitioning[myid]
     rsize = partitioning[myid+1] -  partitioning[myid]
 
     A = coo_matrix((d, (r, c)), shape=(rsize, A.shape[1]),
                    dtype = d.dtype)
     return A
-
-        
-    
-        
@@ -42,6 +42,14 @@
     @variable.array(complex=True,shape=(2,))
     def atest(x, y, z):
        return np.array([1-0.1j,1-0.1j])
+
+    vectorized = True tells that the function accepts arrays. It is
+    called once for many points with x, y, z (and dependency values)
+    given as arrays whose last axis is the point index.
+
+    @variable.array(shape=(2,), vectorized = True)
+    def vtest(x, y, z):
+       return np.array([x*y, np.exp(-z)])
      
 '''
 import numpy as np
@@ -53,26 +61,31 @@ from weakref import WeakKeyDictionary as WKD
 from weakref import WeakValueDictionary as WVD
 
 from petram.mfem_config import use_parallel
+from petram.sol.solsets import resolve_gf
 if use_parallel:
     import mfem.par as mfem
 else:
     import mfem.ser as mfem
 
 class _decorator(object):
-    def float(self, dependency=None):
+    def float(self, dependency=None, vectorized=False):
         def dec(func):
-            obj = PyFunctionVariable(func, complex = False, dependency=dependency)
+            obj = PyFunctionVariable(func, complex = False, dependency=dependency,
+                                     vectorized = vectorized)
             return obj
         return dec
-    def complex(self, dependency=None):
+    def complex(self, dependency=None, vectorized=False):
         def dec(func):        
-            obj = PyFunctionVariable(func, complex = True, dependency=dependency)
+            obj = PyFunctionVariable(func, complex = True, dependency=dependency,
+                                     vectorized = vectorized)
             return obj
         return dec
-    def array(self, complex=False, shape = (1,), dependency=None):
+    def array(self, complex=False, shape = (1,), dependency=None,
+              vectorized=False):
         def dec(func):
             #print "inside dec", complex, shape
-            obj = PyFunctionVariable(func, complex = complex, shape = shape, dependency=dependency)
+            obj = PyFunctionVariable(func, complex = complex, shape = shape, dependency=dependency,
+                                     vectorized = vectorized)
             return obj
         return dec
         
@@ -350,6 +363,20 @@ class ExpressionVariable(Variable):
             if n in g and isinstance(g[n], Variable):
                 idx = g[n].get_emesh_idx(idx=idx, g = g)
         return idx
+
+    def _eval_batch(self, g, ll_name, ll_value):
+        '''
+        evaluate expression using arrays of Variable values. 
+        if expression can not be vectorized, it is evaluated
+        at each point.
+        '''
+        from petram.helper.expression_compiler import eval_batch
+        value = eval_batch(self.expr, g, dict(zip(ll_name, ll_value)),
+                           check = self.co)
+        if value is None:
+            value = np.array([eval(self.co, g, dict(zip(ll_name, v)))
+                              for v in zip(*ll_value)])
+        return value
     
     def nodal_values(self, iele = None, el2v = None, locs = None,
                      wverts = None, elvertloc = None, g = None,
@@ -378,8 +405,7 @@ class ExpressionVariable(Variable):
             elif (n in g):
                 var_g2[n] = g[n]
         if len(ll_name) > 0:
-            value = np.array([eval(self.co, var_g2, dict(zip(ll_name, v)))
-                        for v in zip(*ll_value)])
+            value = self._eval_batch(var_g2, ll_name, ll_value)
         else:
             for k, name in enumerate(self.ind_vars):
                 l[name] = locs[...,k]
@@ -417,8 +443,7 @@ class ExpressionVariable(Variable):
                 var_g2[n] = g[n]
                 
         if len(ll_name) > 0:
-            value = np.array([eval(self.co, var_g2, dict(zip(ll_name, v)))
-                        for v in zip(*ll_value)])
+            value = self._eval_batch(var_g2, ll_name, ll_value)
         else:
             for k, name in enumerate(self.ind_vars):
                 l[name] = locs[...,k]
@@ -553,12 +578,14 @@ class DomainVariable(Variable):
         
         
 class PyFunctionVariable(Variable):
-    def __init__(self, func, complex=False, shape = tuple(), dependency=None):
+    def __init__(self, func, complex=False, shape = tuple(), dependency=None,
+                 vectorized = False):
         super(PyFunctionVariable, self).__init__(complex = complex, dependency=dependency)
         self.func = func
         self.t = None
         self.x = (0,0,0)
         self.shape = shape
+        self.vectorized = vectorized
         
     def __repr__(self):
         return "PyFunction"
@@ -575,7 +602,35 @@ class PyFunctionVariable(Variable):
         #kwargs = {n: locals()[n]() for n in self.dependency}
         #return np.array(self.func(*args, **kwargs), copy=False)
         return np.array(self.func(*args, **kwargs), copy=False)
-       
+
+    def array_values(self, xyz, **kwargs):
+        '''
+        call vectorized function once for many points.
+            xyz : (npts, sdim) array
+            kwargs : dependency values (array whose first axis is point)
+
+        returns (npts,) + shape array
+        '''
+        xyz = np.array(xyz, copy=False)
+        npts = xyz.shape[0]
+        args = [xyz[:, k] for k in range(xyz.shape[1])]
+        # user function sees the point index as the last axis
+        kwargs = {n: np.rollaxis(np.array(v, copy=False), 0, np.ndim(v))
+                  for n, v in kwargs.items()}
+        value = np.array(self.func(*args, **kwargs), copy=False)
+
+        shape = tuple(self.shape)
+        if value.shape == shape + (npts,):
+            value = np.rollaxis(value, -1)
+        elif value.shape == (npts,) + shape:
+            pass
+        elif value.shape == shape:
+            value = np.tile(value, (npts,) + (1,)*len(shape))
+        else:
+            assert False, ("vectorized function returned wrong shape: " +
+                           str(value.shape))
+        return value
+
     def nodal_values(self, iele = None, el2v = None, locs = None,
                      wverts = None, elvertloc = None, g=None, knowns =None,
                      **kwargs):
@@ -591,22 +646,38 @@ class PyFunctionVariable(Variable):
         dtype = np.complex if self.complex else np.float
         ret = np.zeros(shape, dtype = dtype)
         wverts = np.zeros(size)
-        
-        for kk, m, loc in zip(iele, el2v, elvertloc):
-            if kk < 0: continue
-            for pair, xyz in zip(m, loc):
-                idx = pair[1]
-                '''
-                for n in self.dependency:
-                    g[n].local_value = knowns[g[n]][idx]
-                    # putting the dependency variable to functions global.
-                    # this may not ideal, since there is potential danger
-                    # of name conflict?
-                    self.func.func_globals[n] = g[n]
-                '''
+
+        if self.vectorized:
+            idx = []
+            xyz = []
+            for kk, m, loc in zip(iele, el2v, elvertloc):
+                if kk < 0: continue
+                npair = min(len(m), len(loc))
+                idx.extend([pair[1] for pair in m[:npair]])
+                xyz.append(np.array(loc, copy=False)[:npair])
+            if len(idx) > 0:
+                idx = np.array(idx, dtype=int)
                 kwargs = {n: knowns[g[n]][idx] for n in self.dependency}
-                ret[idx] = ret[idx] + self.func(*xyz, **kwargs)
-                wverts[idx] = wverts[idx] + 1
+                value = self.array_values(np.vstack(xyz), **kwargs)
+                if not self.complex: value = value.real
+                np.add.at(ret, idx, value)
+                np.add.at(wverts, idx, 1)
+        else:
+            for kk, m, loc in zip(iele, el2v, elvertloc):
+                if kk < 0: continue
+                for pair, xyz in zip(m, loc):
+                    idx = pair[1]
+                    '''
+                    for n in self.dependency:
+                        g[n].local_value = knowns[g[n]][idx]
+                        # putting the dependency variable to functions global.
+                        # this may not ideal, since there is potential danger
+                        # of name conflict?
+                        self.func.func_globals[n] = g[n]
+                    '''
+                    kwargs = {n: knowns[g[n]][idx] for n in self.dependency}
+                    ret[idx] = ret[idx] + self.func(*xyz, **kwargs)
+                    wverts[idx] = wverts[idx] + 1
         ret = np.stack([x for x in ret if x is not None])
 
 
@@ -627,6 +698,11 @@ class PyFunctionVariable(Variable):
         
         dtype = np.complex if self.complex else np.float
 
+        if self.vectorized:
+            kwargs = {n: knowns[g[n]] for n in self.dependency}
+            ret = self.array_values(locs, **kwargs)
+            return ret.astype(dtype, copy=False)
+
         ret = [None]*len(locs)
         for idx, xyz in enumerate(locs):
             '''
@@ -643,6 +719,95 @@ class PyFunctionVariable(Variable):
         return ret
 
 
+def nodal_value_operator(gf, iele, el2v, wverts, comp):
+    '''
+    sparse matrix which maps DoFs of gf to the vertex values
+    computed in GFScalarVariable.nodal_values (GetNodalValues
+    averaged over elements sharing a vertex).
+
+    returns None if it does not agree with GetNodalValues.
+    '''
+    from scipy.sparse import coo_matrix
+    # elements used to check the operator (first, middle and last)
+    ncheck = 3
+    
+    fes = gf.FESpace()
+    sdim = fes.GetMesh().SpaceDimension()
+    geom = mfem.Geometry()
+    rows = []; cols = []; data = []
+    checks = []
+    for kk, m in zip(iele, el2v):
+        if kk < 0 or len(m) == 0: continue
+        fe = fes.GetFE(kk)
+        dof = fe.GetDof()
+        rule = geom.GetVertices(fe.GetGeomType())
+        vdofs = np.array(fes.GetElementVDofs(kk), dtype=int)
+        is_scalar = (fe.GetRangeType() == mfem.FiniteElement.SCALAR)
+        if is_scalar:
+            vdofs = vdofs[dof*(comp-1):dof*comp]
+        sign = np.where(vdofs < 0, -1.0, 1.0)
+        vdofs = np.where(vdofs < 0, -1-vdofs, vdofs)
+        shape = mfem.Vector(dof)
+        vshape = mfem.DenseMatrix(dof, sdim)
+        weights = []
+        for k, idx in m:
+            ip = rule.IntPoint(k)
+            if is_scalar and fe.GetMapType() == mfem.FiniteElement.VALUE:
+                fe.CalcShape(ip, shape)
+                w = shape.GetDataArray().copy()
+            elif is_scalar:
+                tr = fes.GetElementTransformation(kk)
+                tr.SetIntPoint(ip)
+                fe.CalcPhysShape(tr, shape)
+                w = shape.GetDataArray().copy()
+            else:
+                tr = fes.GetElementTransformation(kk)
+                tr.SetIntPoint(ip)
+                fe.CalcVShape(tr, vshape)
+                w = vshape.GetDataArray()[:, comp-1].copy()
+            w = w*sign
+            weights.append(w)
+            rows.append(np.zeros(dof, dtype=int) + idx)
+            cols.append(vdofs)
+            data.append(w/wverts[idx])
+        checks.append((kk, m, vdofs, weights))
+
+    # check with random DoF data (not with the solution, which can be
+    # zero), using a tolerance relative to the magnitude of terms
+    if len(checks) > 0:
+        checks = [checks[i] for i in
+                  sorted(set(np.linspace(0, len(checks)-1, ncheck).astype(int)))]
+        gf2 = mfem.GridFunction(fes)
+        x = np.random.RandomState(0).uniform(-1, 1, gf2.Size())
+        gf2.GetDataArray()[:] = x
+        for kk, m, vdofs, weights in checks:
+            values = mfem.doubleArray()
+            gf2.GetNodalValues(kk, values, comp)
+            for (k, idx), w in zip(m, weights):
+                v = np.sum(w*x[vdofs])
+                scale = np.sum(np.abs(w*x[vdofs]))
+                if abs(values[k] - v) > 1e-8*max(scale, abs(values[k])):
+                    return None
+        
+    if len(rows) == 0:
+        rows = cols = [np.zeros(0, dtype=int)]
+        data = [np.zeros(0)]
+    op = coo_matrix((np.hstack(data), (np.hstack(rows), np.hstack(cols))),
+                    shape = (len(wverts), gf.Size()))
+    return op.tocsr()
+
+def get_nodal_value_operator(nodal_ops, gf, iele, el2v, wverts, comp):
+    '''
+    operators are kept in nodal_ops (dict given by evaluator agent),
+    and shared among GridFunctions defined on the same FE space.
+    '''
+    fes = gf.FESpace()
+    key = (fes.FEColl().Name(), fes.GetVDim(), fes.GetOrdering(),
+           fes.GetVSize(), comp)
+    if not key in nodal_ops:
+        nodal_ops[key] = nodal_value_operator(gf, iele, el2v, wverts, comp)
+    return nodal_ops[key]
+
 class GridFunctionVariable(Variable):
     def __init__(self, gf_real, gf_imag = None, comp = 1,
                  deriv = None, complex = False):
@@ -699,7 +864,8 @@ class GFScalarVariable(GridFunctionVariable):
     def set_funcs(self):
         # I should come back here to check if this works
         # with vector gf and/or boundary element. probably not...
-        gf_real, gf_imag, extra = self.deriv(*self.deriv_args)
+        gf_real, gf_imag, extra = self.deriv(*[resolve_gf(x) for x in
+                                               self.deriv_args])
         self.gfr = gf_real
         self.gfi = gf_imag
         name = gf_real.FESpace().FEColl().Name()
@@ -743,9 +909,18 @@ class GFScalarVariable(GridFunctionVariable):
                     1j*self.func_i.Eval(self.T, self.ip))
 
     def nodal_values(self, iele = None, el2v = None, wverts = None,
-                     **kwargs):
+                     nodal_ops = None, **kwargs):
         if iele is None: return        
         if not self.isDerived: self.set_funcs()
+
+        if nodal_ops is not None:
+            op = get_nodal_value_operator(nodal_ops, self.gfr, iele, el2v,
+                                          wverts, self.comp)
+            if op is not None:
+                ret = op.dot(self.gfr.GetDataArray())
+                if self.gfi is not None:
+                    ret = ret + 1j*op.dot(self.gfi.GetDataArray())
+                return ret
         
         size = len(wverts)
         if self.gfi is None:
@@ -838,7 +1013,8 @@ class GFVectorVariable(GridFunctionVariable):
         return "GridFunctionVariable (Vector)"
     
     def set_funcs(self):
-        gf_real, gf_imag, extra = self.deriv(*self.deriv_args)
+        gf_real, gf_imag, extra = self.deriv(*[resolve_gf(x) for x in
+                                               self.deriv_args])
         self.gfr = gf_real
         self.gfi = gf_imag
         self.dim = gf_real.VectorDim()
@@ -888,13 +1064,24 @@ class GFVectorVariable(GridFunctionVariable):
                                      in zip(self.func_r, self.func_i)])
             
     def nodal_values(self, iele = None, el2v = None, wverts = None,
-                     **kwargs):
+                     nodal_ops = None, **kwargs):
                     # iele = None, elattr = None, el2v = None,
                     # wverts = None, locs = None, g = None
        
         if iele is None: return        
         if not self.isDerived: self.set_funcs()
 
+        if nodal_ops is not None:
+            ops = [get_nodal_value_operator(nodal_ops, self.gfr, iele, el2v,
+                                            wverts, comp+1)
+                   for comp in range(self.dim)]
+            if not None in ops:
+                ans = [op.dot(self.gfr.GetDataArray()) for op in ops]
+                if self.gfi is not None:
+                    ans = [a + 1j*op.dot(self.gfi.GetDataArray())
+                           for a, op in zip(ans, ops)]
+                return np.transpose(np.vstack(ans))
+
         size = len(wverts)
 
         ans = []
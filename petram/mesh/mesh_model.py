@@ -22,6 +22,13 @@ else:
 import petram.debug
 dprint1, dprint2, dprint3 = petram.debug.init_dprints('MeshModel')
 
+# partitioned ParMesh is stored in parmesh_cache_dir (see MeshFile.run_par)
+parmesh_cache_dir = os.getenv('PetraM_ParMeshCache',
+                              os.path.join(HOME, '.petram', 'parmeshcache'))
+# number of digits of vertex coordinates written in cache. 16 digits keep
+# float64 coordinates, so that a cached run uses the identical mesh.
+parmesh_precision = 16
+
 class Mesh(Model, NS_mixin):
     isMeshGenerator = False
     isRefinement = False      
@@ -93,6 +100,7 @@ class MeshFile(Mesh):
         v['generate_edges'] = 1
         v['refine'] = True
         v['fix_orientation'] = True
+        v['cache_partition'] = False
 
         return v
         
@@ -101,15 +109,18 @@ class MeshFile(Mesh):
                 ["", "rule: {petram}=$PetraM, {mfem}=PyMFEM, \n     {home}=~ ,{model}=project file dir."  ,2, None],
                 ["Generate edges",    self.generate_edges == 1,  3, {"text":""}],
                 ["Refine",    self.refine==1 ,  3, {"text":""}],
-                ["FixOrientation",    self.fix_orientation ,  3, {"text":""}]]
+                ["FixOrientation",    self.fix_orientation ,  3, {"text":""}],
+                ["Cache parallel partition", self.cache_partition, 3, {"text":""}]]
     def get_panel1_value(self):
-        return (self.path, None, self.generate_edges, self.refine, self.fix_orientation)
+        return (self.path, None, self.generate_edges, self.refine, self.fix_orientation,
+                self.cache_partition)
     
     def import_panel1_value(self, v):
         self.path = str(v[0])
         self.generate_edges = 1 if v[2] else 0
         self.refine = 1 if v[3] else 0
         self.fix_orientation = v[4]
+        self.cache_partition = v[5]
         
     def use_relative_path(self):
         self._path_bk  = self.path
@@ -169,6 +180,58 @@ class MeshFile(Mesh):
            return mesh
         except:
            return None
+
+    def partition_cache_path(self):
+        '''
+        directory to store partitioned mesh. It depends on the contents
+        of mesh file, the options to read it and the number of processes.
+        '''
+        import hashlib
+        path = self.get_real_path()
+        h = hashlib.md5()
+        h.update(str((self.generate_edges, self.refine, self.fix_orientation,
+                      num_proc, parmesh_precision)).encode())
+        fid = open(path, 'rb')
+        while True:
+            data = fid.read(1 << 24)
+            if len(data) == 0: break
+            h.update(data)
+        fid.close()
+        return os.path.join(parmesh_cache_dir, h.hexdigest())
+
+    def run_par(self):
+        '''
+        return ParMesh using partition cache.
+
+        if all processes find their partition in the cache, they read only
+        own partition. Otherwise, the serial mesh is read and partitioned,
+        and then each process writes own partition (solparmesh format)
+        for the later runs.
+        '''
+        path = self.get_real_path()
+        if not os.path.exists(path):
+            print("mesh file does not exists : " + path + " in " + os.getcwd())
+            return None
+
+        cdir = self.partition_cache_path() if myid == 0 else None
+        cdir = MPI.COMM_WORLD.bcast(cdir, root=0)
+        fname = os.path.join(cdir, 'parmesh.'+'{:0>6d}'.format(myid))
+        
+        if all(MPI.COMM_WORLD.allgather(os.path.exists(fname))):
+            dprint1("reading partitioned mesh from " + cdir)
+            return mfem.ParMesh(MPI.COMM_WORLD, fname)
+
+        smesh = self.run()
+        if smesh is None: return None
+        pmesh = mfem.ParMesh(MPI.COMM_WORLD, smesh)
+        if myid == 0 and not os.path.exists(cdir):
+            os.makedirs(cdir)
+        MPI.COMM_WORLD.Barrier()
+        # rename after writing, so that a broken file is not used later
+        pmesh.ParPrintToFile(fname + '.tmp', parmesh_precision)
+        os.rename(fname + '.tmp', fname)
+        dprint1("partitioned mesh is saved in " + cdir)
+        return pmesh
         
 class Mesh1D(Mesh):
     isMeshGenerator = True      
@@ -9,6 +9,62 @@ debug = False
 import petram.debug
 dprint1, dprint2, dprint3 = petram.debug.init_dprints('mesh utils')
 
+def _mfem():
+    from petram.mfem_config import use_parallel
+    if use_parallel:
+        import mfem.par as mfem
+    else:
+        import mfem.ser as mfem
+    return mfem
+
+def vertex_array(mesh):
+    '''
+    coordinates of all vertices (NV x space dim) taken in bulk
+    (Mesh::GetVertices). falls back to GetVertexArray for each vertex
+    '''
+    nv = mesh.GetNV()
+    if nv == 0: return np.zeros((0, mesh.SpaceDimension()))
+    try:
+        v = _mfem().Vector()
+        mesh.GetVertices(v)
+        return v.GetDataArray().reshape(-1, nv).transpose().copy()
+    except (AttributeError, TypeError, NotImplementedError):
+        return np.vstack([mesh.GetVertexArray(k) for k in range(nv)])
+
+def _int_array(arr):
+    if hasattr(arr, 'GetDataArray'):
+        return np.array(arr.GetDataArray(), dtype=int)
+    return np.array(arr.ToList(), dtype=int)
+
+def element_vertex_array(mesh, bdr = False):
+    '''
+    vertex table of all (boundary) elements (NE x nverts) taken in bulk
+    (Mesh::GetElementData). None is returned for a mesh with mixed
+    element geometries, or when it is not available. In such case,
+    caller should collect GetVerticesArray of each element.
+    '''
+    mfem = _mfem()
+    if bdr:
+        ne = mesh.GetNBE()
+        getdata = getattr(mesh, 'GetBdrElementData', None)
+    else:
+        ne = mesh.GetNE()
+        getdata = getattr(mesh, 'GetElementData', None)
+    if getdata is None: return None
+    if ne == 0: return np.zeros((0, 0), dtype=int)
+
+    data = []
+    try:
+        for g in range(getattr(mfem.Geometry, 'NumGeom', 8)):
+            vtx = mfem.intArray()
+            attr = mfem.intArray()
+            getdata(g, vtx, attr)
+            if vtx.Size() > 0: data.append(_int_array(vtx))
+    except (AttributeError, TypeError, NotImplementedError):
+        return None
+    if len(data) != 1 or len(data[0]) % ne != 0: return None
+    return data[0].reshape(ne, -1)
+
 def distribute_shared_entity(pmesh):
     '''
     distribute entitiy numbering in master (owner) process
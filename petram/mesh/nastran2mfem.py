@@ -17,150 +17,170 @@
     index in nas starts from 1. 
     index in mfem starts from 0.
 '''
+import os
 import numpy as np
 import re
 
 fwidth = 16
+
+# card : (element name, field width, number of vertices)
+element_cards = {'CTETRA': ('TETRA', 8, 4),
+                 'CTRIA6': ('TRIA6', 6, 3),
+                 'CTRIA3': ('TRIA3', 8, 3),
+                 'CHEXA':  ('HEXA',  8, 8),
+                 'CQUAD8': ('QUAD8', 8, 4),}
+property_cards = ('PSOLID', 'PSHELL')
+known_cards = set(['GRID'] + list(element_cards) + list(property_cards))
+
+def fixed_fields(lines, width, fields, dtype, pad=0):
+    '''
+    cut fixed width fields from a list of card strings and
+    convert them to array (len(lines), len(fields)).
+    field k starts at k*width - pad
+    '''
+    end = max(fields)*width - pad + width
+    a = np.array(lines)
+    n = max(a.dtype.itemsize//np.dtype(a.dtype.kind+'1').itemsize, end)
+    kind = a.dtype.kind
+    c = a.astype(kind+str(n)).view(kind+'1').reshape(len(lines), n)
+    ret = np.empty((len(lines), len(fields)), dtype=dtype)
+    for i, k in enumerate(fields):
+        s = k*width - pad
+        f = np.ascontiguousarray(c[:, s:s+width]).view(kind+str(width))
+        ret[:, i] = f.ravel().astype(dtype)
+    return ret
+
+def card_name(l):
+    for n in (6, 5, 4):
+        if l[:n] in known_cards: return l[:n]
+    return None
+
+def print_progress(fraction):
+    print(str(int(fraction*100)) + "% done.")
+    
 class NASReader(object):
-    def __init__(self, filename):
+    '''
+    NASReader(filename, progress = None, cache = False, chunk = 100000)
+
+    load reads file in a single pass. Cards are collected in
+    chunk and converted to arrays at once.
+
+    progress: callable which is called with a fraction of file
+              read (default: print progress every 10%)
+    cache   : save the dataset to filename + '.npz' and use it
+              when the file is not modified.
+    '''
+    def __init__(self, filename, progress = None, cache = False,
+                 chunk = 100000):
         self.filename = filename
         self.dataset = None
+        self.progress = print_progress if progress is None else progress
+        self.cache = cache
+        self.chunk = chunk
+
+    @property
+    def cache_file(self):
+        return self.filename + '.npz'
+    
     def load(self):
-        # check format length
-        num_lines = sum(1 for line in open(self.filename))
-        num_lines_base = num_lines/100
-        fid = open(self.filename, 'r')
-        while True:
-            l = fid.readline()
-            if l.startswith('+CONT'):
-                globals()['fwidth'] = 8
-                print('short format ' + str(num_lines) + ' lines')
-                break
-            elif l.startswith('*CONT'):
-                globals()['fwidth'] = 16
-                print('long format ' + str(num_lines) + ' lines')
-                break                
-        fid.close()
+        if self.cache and self.load_cache(): return
         
-        fid = open(self.filename, 'r')
-        while True:
-            l = fid.readline()
-            if l.startswith('$ Grid data section'): break
+        size = max(os.path.getsize(self.filename), 1)
+        chunk = self.chunk
+        cards = {}        # cards waiting for conversion
+        arrays = {}       # converted arrays
+        def flush(name):
+            lines = cards.pop(name, [])
+            if len(lines) == 0: return
+            if name == 'GRID':
+                pad = 8 if fwidth == 16 else 0
+                a = fixed_fields(lines, fwidth, (3, 4, 5), float, pad=pad)
+            elif name in element_cards:
+                void, width, nv = element_cards[name]
+                a = fixed_fields(lines, width, range(2, 3+nv), int)
+            else:
+                a = fixed_fields(lines, 8, (1,), int)
+            if not name in arrays: arrays[name] = []
+            arrays[name].append(a)
 
-        num_grid = 0
-        while True:
-            l = fid.readline()            
-            if l.startswith('GRID'):num_grid = num_grid + 1
-            if l.startswith('$ Element data section'):break
-        fid.close()
-        fid = open(self.filename, 'r')
+        global fwidth
+        width_known = False
+        done = 0; next_report = 0.1
         cl = ''
-
-        while True:
-            l = self._read_line(fid)
-            if l.startswith('$ Grid data section'): break
-
-        grids = [None]*num_grid  ### reading grid      
-        for i in range(num_grid):
-            l = self._read_line(fid)
-            if l.startswith('$ Element data section'):break
-            g = self.parse_grid_fixed(l)
-            grids[i] = np.array((float(g[3]), float(g[4]), float(g[5])))
-        grids = np.vstack(grids)
-
-        elems = {'TRIA6':[],
-                 'TRIA3':[],
-                 'TETRA':[],
-                 'HEXA':[],
-                 'QUAD8':[]} ### reading elements
-        print("reading elements")
-        ll = 0
-        while True:            
-            l = self._read_line(fid)
-            if l.startswith('$ Property data section'):break
-            if l.startswith('CTRIA6'):
-                elems['TRIA6'].append(self.parse_tria6_fixed(l))
-            elif l.startswith('CTRIA3'):
-                elems['TRIA3'].append(self.parse_tria3_fixed(l))
-            elif l.startswith('CTETRA'):
-                elems['TETRA'].append(self.parse_tetra_fixed(l))
-            elif l.startswith('CHEXA'):
-                elems['HEXA'].append(self.parse_hexa_fixed(l))
-            elif l.startswith('CQUAD8'):
-                elems['QUAD8'].append(self.parse_quad8_fixed(l))
-            else: 
-                print("Element not supported: " + l)
+        fid = open(self.filename, 'r')
+        for line in fid:
+            done = done + len(line)
+            l = line.rstrip("\r\n")
+            if l.startswith('+CONT') or l.startswith('*CONT'):
+                if not width_known:
+                    fwidth = 8 if l.startswith('+CONT') else 16
+                    print(('short' if fwidth == 8 else 'long') + ' format')
+                    width_known = True
+                    flush('GRID')
+                l = cl + l[8:]
+            if (l.strip().endswith('+CONT') or
+                l.strip().endswith('*CONT')):
+                cl = l.strip()[:-5]
                 continue
-            ll += 1
-            if ll % num_lines_base == 0:
-               print(str(ll/num_lines_base) + "% done.(" + str(ll) + ")")
-        print("reading elements   (done)")
-        new_elems = {}
-        if len(elems['TETRA']) > 0:
-            TETRA = np.vstack([np.array((int(g[3]), int(g[4]), int(g[5]), int(g[6]),))
-                           for g in elems['TETRA']])
-            TETRA_ATTR = np.array([int(g[2]) for g in elems['TETRA']]) #PSOLID ID
-            new_elems['TETRA'] = TETRA-1
-            new_elems['TETRA_ATTR'] = TETRA_ATTR
-            
-        if len(elems['TRIA6']) > 0:                          
-            TRIA6 = np.vstack([np.array((int(g[3]), int(g[4]), int(g[5]), ))
-                           for g in elems['TRIA6']])
-            TRIA6_ATTR = np.array([int(g[2]) for g in elems['TRIA6']])  #PSHELL ID
-            new_elems['TRIA6'] = TRIA6-1
-            new_elems['TRIA6_ATTR'] = TRIA6_ATTR
 
-        if len(elems['TRIA3']) > 0:                          
-            TRIA3 = np.vstack([np.array((int(g[3]), int(g[4]), int(g[5]), ))
-                           for g in elems['TRIA3']])
-            TRIA3_ATTR = np.array([int(g[2]) for g in elems['TRIA3']])  #PSHELL ID
-            new_elems['TRIA3'] = TRIA3-1
-            new_elems['TRIA3_ATTR'] = TRIA3_ATTR
-            
-        if len(elems['HEXA']) > 0:                                  
-            HEXA = np.vstack([np.array((int(g[3]), int(g[4]), int(g[5]), int(g[6]),
-                           int(g[7]), int(g[8]), int(g[9]), int(g[10]),))
-                           for g in elems['HEXA']])
-            HEXA_ATTR = np.array([int(g[2]) for g in elems['HEXA']]) #PSOLID ID
-            new_elems['HEXA'] = HEXA-1
-            new_elems['HEXA_ATTR'] = HEXA_ATTR
-
-        if len(elems['QUAD8']) > 0:
-            QUAD8 = np.vstack([np.array((int(g[3]), int(g[4]), int(g[5]), int(g[6])))
-                           for g in elems['QUAD8']])
-            QUAD8_ATTR = np.array([int(g[2]) for g in elems['QUAD8']])  #PSHELL ID
-            new_elems['QUAD8'] = QUAD8-1
-            new_elems['QUAD8_ATTR'] = QUAD8_ATTR
-
-        elems =  new_elems
+            name = card_name(l)
+            if name is None: continue
+            if not name in cards: cards[name] = []
+            cards[name].append(l)
+            if len(cards[name]) >= chunk:
+                if name != 'GRID' or width_known: flush(name)
+                
+            if float(done)/size >= next_report:
+                self.progress(float(done)/size)
+                next_report = next_report + 0.1
+        fid.close()
+        
+        if not width_known:
+            fwidth = 16 if cards.get('GRID', [''])[0].startswith('GRID*') else 8
+        for name in list(cards): flush(name)
+        
+        def get(name, ncol, dtype):
+            if not name in arrays: return np.zeros((0, ncol), dtype=dtype)
+            return np.vstack(arrays.pop(name))
 
-        props = {'PSOLID':[],
-                 'PSHELL':[]}
-        print("reading shell/solid")
-        while True:            
-            l = self._read_line(fid)
-            if l.startswith('ENDDATA'):break
-            if l.startswith('PSOLID'):
-                props['PSOLID'].append(self.parse_psolid_fixed(l))
-            elif l.startswith('PSHELL'):
-                props['PSHELL'].append(self.parse_pshell_fixed(l))
-            else: pass
-            ll += 1
-            if ll % num_lines_base == 0:
-               print(str(ll/num_lines_base) + "% done.")
-        print("reading shell/solid ...(done)")                          
-        PSHELL = np.array([int(g[1]) for g in props['PSHELL']])  #PSHELL
-        PSOLID = np.array([int(g[1]) for g in props['PSOLID']])  #PSOLID
+        grids = get('GRID', 3, float)
+        elems = {}
+        for card in element_cards:
+            name, width, nv = element_cards[card]
+            if not card in arrays: continue
+            data = get(card, nv + 1, int)
+            elems[name] = data[:, 1:] - 1
+            elems[name + '_ATTR'] = data[:, 0]  # PSOLID/PSHELL ID
+        props = {name: get(name, 1, int).flatten() for name in property_cards}
 
-        props = {'PSOLID': PSOLID, 
-                 'PSHELL': PSHELL }
+        self.dataset = {'PROPS':props,
+                        'ELEMS' :elems,
+                        'GRIDS':grids}
+        if self.cache: self.save_cache()
 
+    def save_cache(self):
+        data = {'GRIDS': self.dataset['GRIDS']}
+        for key in self.dataset['ELEMS']:
+            data['ELEMS_' + key] = self.dataset['ELEMS'][key]
+        for key in self.dataset['PROPS']:
+            data['PROPS_' + key] = self.dataset['PROPS'][key]
+        np.savez(self.cache_file, **data)
 
-        dataset = {'PROPS':props,
-                   'ELEMS' :elems,
-                   'GRIDS':grids}
-        fid.close()
+    def load_cache(self):
+        path = self.cache_file
+        if not os.path.exists(path): return False
+        if os.path.getmtime(path) < os.path.getmtime(self.filename):
+            return False
+        d = np.load(path)
+        dataset = {'PROPS':{}, 'ELEMS':{}, 'GRIDS':d['GRIDS']}
+        for key in d.files:
+            if key.startswith('ELEMS_'):
+                dataset['ELEMS'][key[6:]] = d[key]
+            if key.startswith('PROPS_'):
+                dataset['PROPS'][key[6:]] = d[key]
         self.dataset = dataset
+        print('reading cached data ' + path)
+        return True
 
     def plot_tet(self, idx, **kwargs):
         from ifigure.interactive import solid
@@ -263,19 +283,28 @@ def write_nas2mfem(filename,  reader, exclude_bdr = None, offset=None):
         else:
             el_2d = ['QUAD8',]
 
-        unique_grids = list(np.unique(np.hstack([elems[name].flatten() for name in el_3d+el_2d if name in elems])))
+        unique_grids = np.unique(np.hstack([elems[name].flatten() for name in el_3d+el_2d if name in elems]))
         print('unique_grid (done)')
         nvtc = len(unique_grids)
         ndim = grid.shape[-1]
-        nelem = 0
-        nbdry = 0
-        
-        for k in elems:
-            if k in el_3d: nelem = nelem + len(elems[k+'_ATTR'])
-            if k in el_2d:
-                tmp = [x for x in elems[k+'_ATTR'] if not x in exclude_bdr]
-                nbrdy = nbdry + len(tmp)
-        
+
+        def write_elements(names, exclude):
+            for name in names:
+                if not name in elems: continue
+                attr = elems[name+'_ATTR']
+                mask = np.logical_not(np.in1d(attr, exclude))
+                # vertex index in the vertices section (rank in unique_grids)
+                vidx = np.searchsorted(unique_grids, elems[name][mask])
+                gtyp = np.zeros(len(vidx), dtype=int) + geom_type[name]
+                np.savetxt(fid, np.hstack((attr[mask].reshape(-1, 1),
+                                           gtyp.reshape(-1, 1), vidx)),
+                           fmt='%d')
+        def count(names, exclude):
+            return sum([np.sum(np.logical_not(np.in1d(elems[name+'_ATTR'],
+                                                      exclude)))
+                        for name in names if name in elems])
+        nelem = count(el_3d, [])
+        nbdry = count(el_2d, exclude_bdr)
         
         fid.write('MFEM mesh v1.0\n')
         fid.write('\n')
@@ -284,47 +313,15 @@ def write_nas2mfem(filename,  reader, exclude_bdr = None, offset=None):
         fid.write('\n')
         fid.write('elements\n')
         fid.write(str(nelem) + '\n')
-        
-        rev_map = {unique_grids[x]:x for x in range(len(unique_grids))}
-        for name in el_3d:
-            if not name in elems: continue            
-            vidx = elems[name]
-            attr = elems[name+'_ATTR']
-            gtyp = geom_type[name]
-            txts = [None]*len(attr)
-            for i in range(len(attr)):
-                txt = [str(attr[i]), str(gtyp)]
-#                txt.extend([str(unique_grids.index(x)) for x in vidx[i]])
-                txt.extend([str(rev_map[x]) for x in vidx[i]])
-                txts[i] = ' '.join(txt)
-            fid.write('\n'.join(txts))
+        write_elements(el_3d, [])
         fid.write('\n')                
         fid.write('boundary\n')
-        fid.write(str(nbrdy) + '\n')
-        for name in el_2d:
-            if not name in elems: continue
-            vidx = elems[name]
-            attr = elems[name+'_ATTR']
-            gtyp = geom_type[name]
-            txts = [None]*len(attr)
-            for i in range(len(attr)):
-                if attr[i] in exclude_bdr: continue
-                txt = [str(attr[i]), str(gtyp)]
-
-#                txt.extend([str(unique_grids.index(x)) for x in vidx[i]])
-                txt.extend([str(rev_map[x]) for x in vidx[i]])
-                txts[i] = ' '.join(txt)
-            fid.write('\n'.join(txts))                
+        fid.write(str(nbdry) + '\n')
+        write_elements(el_2d, exclude_bdr)
         fid.write('\n')                
         fid.write('vertices\n')
         fid.write(str(nvtc) + '\n')                        
         fid.write(str(ndim) + '\n')
-        txts = [None]*nvtc
-        for i in range(nvtc):
-            txt = [str(x+offset[kk]) for kk, x in enumerate(grid[unique_grids[i]])]
-            txts[i] = ' '.join(txt)
-        fid.write('\n'.join(txts))
+        np.savetxt(fid, grid[unique_grids] + np.array(offset)[:ndim],
+                   fmt='%.16g')
         fid.close()
-
-        
-    
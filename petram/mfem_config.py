@@ -1,5 +1,8 @@
 use_parallel = False
 
+# parametric cases handled by this run ('i/N'). see Parametric
+case_group = ''
+
 
    
 
@@ -715,6 +715,10 @@ class Model(RestorableOrderedDict):
                        '                     action = "store_true", ',
                        '                     default = False,',  
                        '                     help="Use parallel model even if nproc = 1.")',
+                       'parser.add_argument("-g", "--case-group", ',
+                       '                     action = "store", ',
+                       '                     default = "",',  
+                       '                     help="Run only parametric cases of group i of N (i/N).")',
                        'parser.add_argument("-d", "--debug-param", ',
                        '                     action = "store", ',
                        '                     default = 1, type=int) ',
@@ -724,6 +728,7 @@ class Model(RestorableOrderedDict):
                        '',
                        'import  petram.mfem_config as mfem_config',
                        'mfem_config.use_parallel = use_parallel',
+                       'mfem_config.case_group = args.case_group',
                        'if (myid == 0): parser.print_options(args)'
                        '',
                        'debug_level=args.debug_param'])
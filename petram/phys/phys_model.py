@@ -19,6 +19,7 @@ else:
    import mfem.ser as mfem
 
 from petram.helper.variables import Variable, eval_code 
+from petram.helper.variables import ExpressionVariable, Constant
 
 # not that PyCoefficient return only real number array
 class PhysConstant(mfem.ConstantCoefficient):
@@ -124,7 +125,135 @@ class Coefficient_Evaluator(object):
         self.flags = [isinstance(co, types.CodeType) for co in self.co]
         self.variables_dd = dict(self.variables)
 
+        # quadrature point table (see quadrature_table.py)
+        self._qp_table = None
+        self._qp_value = None
+
+    def set_quadrature_table(self, table):
+        self._qp_table = table
+
+    def lookup_quadrature_table(self, T, ip):
+        '''
+        stash a precomputed value for (T, ip) so that next EvalValue
+        returns it without evaluating the expression.
+        '''
+        if self._qp_table is None: return False
+        self._qp_value = self._qp_table.lookup(T, ip, self)
+        return self._qp_value is not None
+
+    def is_vectorizable(self):
+        '''
+        expression can be evaluated on arrays if it uses only
+        independent variables and vectorized python function variables
+        '''
+        if not any(self.flags): return False
+        for n, v in self.variables:
+            if not getattr(v, 'vectorized', False): return False
+            if len(v.dependency) > 0: return False
+        return True
+
+    def get_names(self):
+        '''
+        namespace names (including Variables) used in expressions.
+        None if it is not known (see variable_names)
+        '''
+        names = set()
+        for co, flag in zip(self.co, self.flags):
+            if flag: names.update(co.co_names)
+        for n, v in self.variables:
+            names.add(n)
+        names = variable_names(names, self.g)
+        if names is None: return None
+        return names.difference(self.ind_vars)
+
+    def get_dependency_key(self):
+        '''
+        key which identifies the values of expressions. It consists from
+        expressions and the values of namespace names used in them.
+        returns (key, refs). refs are objects which need to be kept
+        alive while the key is used.
+        '''
+        from petram.phys.quadrature_table import value_signature
+
+        names = set()
+        for co, flag in zip(self.co, self.flags):
+            if flag: names.update(co.co_names)
+        # values of names used by ExpressionVariables are a part of key
+        names = variable_names(names, self.g)
+        if names is None: return None
+        refs = []
+        try:
+            deps = tuple([(n, value_signature(self.g[n], refs))
+                          for n in sorted(names)
+                          if n in self.g and not n in self.ind_vars])
+            exprs = value_signature(list(self.exprs), refs)
+            key = (tuple(self.ind_vars), exprs, deps)
+            hash(key)
+        except TypeError:
+            return None
+        return key, refs
+
+    def EvalValueArray(self, x):
+        '''
+        evaluate expressions on many points at once.
+            x : array of points (npts, sdim)
+
+        returns (npts, n) array, where each row is what EvalValue returns
+        at the point. None is returned if expression could not be evaluated
+        as array operation.
+        '''
+        if not self.is_vectorizable(): return None
+        npts = x.shape[0]
+        l = {}
+        for k, name in enumerate(self.ind_vars):
+           l[name] = x[:, k]
+        try:
+            for n, v in self.variables:
+                # point index is the last axis, as ind_vars are
+                value = v.array_values(x)
+                l[n] = np.rollaxis(value, 0, value.ndim)
+        except:
+            return None
+
+        val = []
+        try:
+            with np.errstate(all='ignore'):
+                for co, flag in zip(self.co, self.flags):
+                    v = eval_code(co, self.g, l, flag=flag)
+                    if isinstance(v, list) or isinstance(v, tuple):
+                        # such as [x, y, 0]
+                        v = np.broadcast_arrays(*v)
+                    v = np.array(v, copy=False)
+                    if v.dtype == object: return None
+                    if v.ndim == 0:
+                        v = np.tile(v, (npts, 1))
+                    elif v.shape[-1] == npts:
+                        v = np.rollaxis(v, -1).reshape(npts, -1)
+                    else:
+                        return None
+                    val.append(v)
+        except:
+            return None
+        val = np.hstack(val)
+
+        # check a few points against per point evaluation to make sure
+        # that expression is not something like sum(x).
+        for i in set((0, npts//2, npts-1)):
+            for n, v in self.variables:
+                v.x = x[i]
+            try:
+                v0 = Coefficient_Evaluator.EvalValue(self, x[i])
+            except:
+                return None
+            if v0.shape != val[i].shape: return None
+            if not np.allclose(v0, val[i]): return None
+        return val
+
     def EvalValue(self, x):
+        if self._qp_value is not None:
+           val = self._qp_value
+           self._qp_value = None
+           return val
         for k, name in enumerate(self.ind_vars):
            self.l[name] = x[k]
         for n, v in self.variables:
@@ -136,6 +265,41 @@ class Coefficient_Evaluator(object):
         return np.array(val, copy=False).flatten()
         #return np.array(val, copy=False).ravel()  ## this may be okay
 
+def variable_names(names, g):
+    '''
+    names and the namespace names used by Variables among them
+    (followed recursively).
+
+    None is returned if a Variable other than ExpressionVariable and
+    Constant is used, since such Variable (PyFunctionVariable, GF
+    variables...) may read any name in the global namespace.
+    '''
+    if g is None: return set(names)
+    names = set(names)
+    todo = list(names)
+    while len(todo) > 0:
+        v = g.get(todo.pop(), None)
+        if not isinstance(v, Variable): continue
+        if isinstance(v, Constant): continue
+        if not isinstance(v, ExpressionVariable): return None
+        new = set(v.names).union(v.dependency).difference(v.ind_vars)
+        todo.extend(new.difference(names))
+        names.update(new)
+    return names
+
+def coefficient_names(coeff):
+    '''
+    namespace names which a coefficient depends on.
+    None is returned if it is not known.
+    '''
+    if isinstance(coeff, Coefficient_Evaluator):
+        return coeff.get_names()
+    if isinstance(coeff, (mfem.ConstantCoefficient,
+                          mfem.VectorConstantCoefficient,
+                          mfem.MatrixConstantCoefficient)):
+        return set()
+    return None
+
 class PhysCoefficient(mfem.PyCoefficient, Coefficient_Evaluator):
     def __init__(self, exprs, ind_vars, l, g, real=True, isArray = False):
        #if not isArray:
@@ -147,8 +311,9 @@ class PhysCoefficient(mfem.PyCoefficient, Coefficient_Evaluator):
         return self.__class__.__name__+"(PhysCoefficeint)"
         
     def Eval(self, T, ip):
-        for n, v in self.variables:
-           v.set_point(T, ip, self.g, self.l)
+        if not self.lookup_quadrature_table(T, ip):
+            for n, v in self.variables:
+               v.set_point(T, ip, self.g, self.l)
         return super(PhysCoefficient, self).Eval(T, ip)
 
     def EvalValue(self, x):
@@ -177,8 +342,9 @@ class VectorPhysCoefficient(mfem.VectorPyCoefficient, Coefficient_Evaluator):
         # if V is Matrix, we need to make our own loop to
         # properly set spacial points in variables.
         if isinstance(ip, mfem.IntegrationPoint):
-            for n, v in self.variables:
-                v.set_point(T, ip, self.g, self.l)    
+            if not self.lookup_quadrature_table(T, ip):
+                for n, v in self.variables:
+                    v.set_point(T, ip, self.g, self.l)
             return super(VectorPhysCoefficient, self).Eval(V, T, ip)
         elif isinstance(ip, mfem.IntegrationRule):       
             M = V; ir=ip
@@ -187,8 +353,9 @@ class VectorPhysCoefficient(mfem.VectorPyCoefficient, Coefficient_Evaluator):
             for k in range(ir.GetNPoints()):
                 M.GetColumnReference(k, Mi);
                 ip = ir.IntPoint(k)
-                for n, v in self.variables:
-                   v.set_point(T, ip, self.g, self.l)    
+                if not self.lookup_quadrature_table(T, ip):
+                    for n, v in self.variables:
+                       v.set_point(T, ip, self.g, self.l)
                 super(VectorPhysCoefficient, self).Eval(Mi, T, ip)
 
     def EvalValue(self, x):
@@ -204,8 +371,9 @@ class MatrixPhysCoefficient(mfem.MatrixPyCoefficient, Coefficient_Evaluator):
         return self.__class__.__name__+"(MatrixPhysCoefficeint)"
         
     def Eval(self, K, T, ip):
-        for n, v in self.variables:
-           v.set_point(T, ip, self.g, self.l)           
+        if not self.lookup_quadrature_table(T, ip):
+            for n, v in self.variables:
+               v.set_point(T, ip, self.g, self.l)
         return super(MatrixPhysCoefficient, self).Eval(K, T, ip)
 
     def EvalValue(self, x):
@@ -535,6 +703,7 @@ class Phys(Model, Vtable_mixin, NS_mixin):
     def preprocess_params(self, engine):
         self.vt.preprocess_params(self)
         self.vt3.preprocess_params(self)               
+        self._coeff_names = set()
         return
 
     def import_panel1_value(self, v):
@@ -623,6 +792,9 @@ class Phys(Model, Vtable_mixin, NS_mixin):
         if vt is None: vt = self.vt
         #if vt[name].ndim == 0:
         if not isinstance(coeff, tuple): coeff = (coeff, )
+        self.record_coeff_names(coeff)
+        if getattr(engine, 'vectorized_coeff', False):
+            self.set_quadrature_table(engine, coeff, idx=idx)
         if isinstance(coeff[0], mfem.Coefficient):
             coeff = self.restrict_coeff(coeff, engine, idx=idx)
         elif isinstance(coeff[0], mfem.VectorCoefficient):          
@@ -641,6 +813,85 @@ class Phys(Model, Vtable_mixin, NS_mixin):
         else:
            adder(itg)
 
+    def record_coeff_names(self, coeff):
+        '''
+        record namespace names used by the coefficients of integrators.
+        None means that a coefficient whose dependency is not known
+        is used.
+        '''
+        names = getattr(self, '_coeff_names', set())
+        for c in coeff:
+            n = coefficient_names(c)
+            if n is None or names is None:
+                names = None
+            else:
+                names = names.union(n)
+        self._coeff_names = names
+
+    def get_panel_names(self):
+        '''
+        namespace names used in panel expressions ('*_txt')
+        '''
+        names = set()
+        for attr in self.attribute():
+            if not attr.endswith('_txt'): continue
+            value = getattr(self, attr, None)
+            if not isinstance(value, str): continue
+            value = value.strip()
+            if value.startswith('='): value = value[1:]
+            try:
+                names.update(compile(value, '<string>', 'eval').co_names)
+            except SyntaxError:
+                pass
+        return names
+
+    def get_dependency_names(self):
+        '''
+        namespace names on which the contributions of this model
+        depend. they are names used in the coefficients of integrators and
+        names used in panel expressions of this model and its parents up to
+        root physics (such as frequency). None if it is not known.
+        '''
+        names = getattr(self, '_coeff_names', None)
+        if names is None: return None
+        names = set(names)
+        p = self
+        while isinstance(p, Phys):
+            names.update(p.get_panel_names())
+            p = p.parent
+        return variable_names(names, self._global_ns)
+
+    def depends_on(self, names):
+        '''
+        True if contributions may change when names are changed
+        '''
+        if names is None: return True
+        deps = self.get_dependency_names()
+        if deps is None: return True
+        return len(deps.intersection(names)) > 0
+
+    def set_quadrature_table(self, engine, coeff, idx=None):
+        '''
+        let coefficients evaluate its expression on all integration
+        points in the selection at once (vectorized evaluation).
+        coefficients which are not vectorizable stay in the per point
+        evaluation.
+        '''
+        if isinstance(self, Domain): is_bdr = False
+        elif isinstance(self, Bdry): is_bdr = True
+        else: return
+
+        from petram.phys.quadrature_table import QuadratureTable
+
+        mesh = engine.emeshes[self.get_root_phys().emesh_idx]
+        if idx is None: idx = self._sel_index
+        for c in coeff:
+            if not isinstance(c, Coefficient_Evaluator): continue
+            if not c.is_vectorizable(): continue
+            table = QuadratureTable(mesh, idx, is_bdr=is_bdr,
+                                    cache=engine.coeff_cache)
+            c.set_quadrature_table(table)
+
     def onItemSelChanged(self, evt):
         '''
         GUI response when model object is selected in
@@ -0,0 +1,252 @@
+'''
+   QuadratureTable
+
+   Precomputed table of coefficient values at integration points.
+
+   PhysCoefficient and its vector/matrix variants are called back from
+   MFEM's assembly loop once per integration point. When the expression
+   can be evaluated on NumPy arrays, this table collects the physical
+   coordinates of all integration points of a rule for the entire
+   element set at once, evaluates the expression once, and serves the
+   values by (element, integration point) lookup afterwards.
+
+   The integration rule used by an integrator is not known in advance.
+   When an integration point which is not in the table is requested,
+   the rule containing the point is searched from mfem.IntRules and the
+   table for the rule is built for all elements having the same geometry.
+
+   Tables can be shared among assemblies through QuadratureTableCache.
+
+   Usage:
+      table = QuadratureTable(mesh, attrs, is_bdr = False, cache = cache)
+      coeff.set_quadrature_table(table)
+'''
+import numpy as np
+import types
+
+from petram.mfem_config import use_parallel
+if use_parallel:
+   import mfem.par as mfem
+else:
+   import mfem.ser as mfem
+
+import petram.debug as debug
+dprint1, dprint2, dprint3 = debug.init_dprints('QuadratureTable')
+
+# integration order searched when looking for a rule containing a point
+max_search_order = 30
+
+class QuadratureTable(object):
+    def __init__(self, mesh, attrs, is_bdr=False, cache=None):
+        '''
+        mesh : mfem.Mesh
+        attrs : list of (bdr) attributes. [-1] means all.
+        is_bdr : if True, table is made on boundary elements
+        cache : QuadratureTableCache (optional)
+        '''
+        self.mesh = mesh
+        self.is_bdr = is_bdr
+        self.cache = cache
+
+        if is_bdr:
+            attr = mesh.GetBdrAttributeArray()
+            get_geom = mesh.GetBdrElementBaseGeometry
+        else:
+            attr = mesh.GetAttributeArray()
+            get_geom = mesh.GetElementBaseGeometry
+
+        attr = np.array(attr, copy=False)
+        attrs = list(attrs)
+        if len(attrs) == 1 and attrs[0] == -1:
+            elements = np.arange(len(attr))
+        else:
+            elements = np.where(np.in1d(attr, attrs))[0]
+
+        self.elattr = attr
+        self.geoms = {}      # geom -> array of element index
+        self.slot = {}       # element index -> (geom, slot in geom)
+        gtypes = np.array([get_geom(i) for i in elements], dtype=int)
+        for g in np.unique(gtypes):
+            self.geoms[g] = elements[gtypes == g]
+            for k, i in enumerate(self.geoms[g]):
+                self.slot[i] = (g, k)
+
+        self.selection_key = (id(mesh), is_bdr, tuple(sorted(attrs)))
+        self.points = {g: {} for g in self.geoms}   # ip -> (table, index)
+        self.missing = {g: set() for g in self.geoms} # ip not in IntRules
+        self.failed = False
+        self.tables = []
+
+    def _get_transformation(self, i):
+        if self.is_bdr:
+            return self.mesh.GetBdrElementTransformation(i)
+        else:
+            return self.mesh.GetElementTransformation(i)
+
+    def _find_rule(self, geom, key):
+        for order in range(max_search_order):
+            ir = mfem.IntRules.Get(geom, order)
+            for j in range(ir.GetNPoints()):
+                ip = ir.IntPoint(j)
+                if (ip.x, ip.y, ip.z) == key:
+                    return order, ir
+        return None, None
+
+    def _eval_table(self, geom, ir, evaluator):
+        npts = ir.GetNPoints()
+        ptx = mfem.DenseMatrix()
+        pts = []
+        for i in self.geoms[geom]:
+            T = self._get_transformation(i)
+            T.Transform(ir, ptx)
+            pts.append(ptx.GetDataArray().transpose().copy())
+        pts = np.vstack(pts)
+
+        values = evaluator.EvalValueArray(pts)
+        if values is None: return None
+        return values.reshape(len(self.geoms[geom]), npts, -1)
+
+    def _make_table(self, geom, order, ir, evaluator):
+        npts = ir.GetNPoints()
+
+        key = None
+        values = None
+        if self.cache is not None:
+            dep = evaluator.get_dependency_key()
+            if dep is not None:
+                key = self.selection_key + (geom, order) + dep[0]
+                values = self.cache.get(key)
+        if values is None:
+            values = self._eval_table(geom, ir, evaluator)
+            if values is None: return None
+            if key is not None:
+                self.cache.set(key, values, refs = [self.mesh] + dep[1])
+        else:
+            dprint2("quadrature table is taken from cache (geom/order)", geom, order)
+
+        self.tables.append(values)
+        t = len(self.tables) - 1
+        points = self.points[geom]
+        for j in range(npts):
+            ip = ir.IntPoint(j)
+            key = (ip.x, ip.y, ip.z)
+            if not key in points: points[key] = (t, j)
+        return values
+
+    def lookup(self, T, ip, evaluator):
+        '''
+        return the value at (T, ip). None is returned if the value can not
+        be served from the table. In such case, the caller should
+        evaluate the value by itself.
+        '''
+        if self.failed: return None
+        i = T.ElementNo
+        if not i in self.slot: return None
+        if T.Attribute != self.elattr[i]: return None
+
+        geom, k = self.slot[i]
+        key = (ip.x, ip.y, ip.z)
+        points = self.points[geom]
+        if not key in points:
+            # points not in IntRules (nodal points in projection..)
+            # are remembered, so that the rules are searched only once
+            if key in self.missing[geom]: return None
+            order, ir = self._find_rule(geom, key)
+            if ir is None:
+                self.missing[geom].add(key)
+                return None
+            values = self._make_table(geom, order, ir, evaluator)
+            if values is None:
+                dprint2("expression is not vectorizable. using per point evaluation")
+                self.failed = True
+                return None
+            dprint2("quadrature table is built (geom/order)", geom, order)
+        t, j = points[key]
+        return self.tables[t][k, j]
+
+def value_signature(v, refs):
+    '''
+    hashable signature of a namespace value. Objects which can not be
+    hashed by value are identified by id, and kept alive in refs so that
+    the id is not reused while the signature is in use.
+
+    ExpressionVariable/Constant are identified by their expression/value
+    (the names they use are added to the key by the caller). TypeError
+    is raised for other Variables and python functions, since the value
+    they return may change with any global name they read.
+    '''
+    from petram.helper.variables import (Variable, ExpressionVariable,
+                                         Constant)
+    if isinstance(v, Constant):
+        return ('Constant', value_signature(v.value, refs))
+    if isinstance(v, ExpressionVariable):
+        return ('Expression', v.expr)
+    if isinstance(v, Variable):
+        raise TypeError("value of Variable is not known")
+    if isinstance(v, (types.FunctionType, types.MethodType)):
+        raise TypeError("value of function is not known")
+    if v is None or isinstance(v, (bool, int, long, float, complex, str)):
+        return v
+    if isinstance(v, np.ndarray):
+        import hashlib
+        return ('array', v.shape, v.dtype.str,
+                hashlib.md5(np.ascontiguousarray(v).tostring()).hexdigest())
+    if isinstance(v, np.generic):
+        return v.item()
+    if isinstance(v, (list, tuple)):
+        return tuple([value_signature(x, refs) for x in v])
+    refs.append(v)
+    return ('id', id(v))
+
+class QuadratureTableCache(object):
+    '''
+    Cache of quadrature tables shared among assemblies.
+
+    A table is stored with a key made from mesh, element selection,
+    geometry/integration order and the dependency key of the expression
+    (expression text and the values of the namespace names it refers to).
+    When a parameter used in the expression changes (parametric scan,
+    time step), the key changes and the table is evaluated again.
+
+    Tables are evicted in the least-recently-used order when the total
+    size exceeds max_size (MB).
+    '''
+    def __init__(self, max_size=256):
+        from collections import OrderedDict
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hit = 0
+        self.miss = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def get(self, key):
+        if not key in self.entries:
+            self.miss += 1
+            return None
+        self.hit += 1
+        entry = self.entries.pop(key)
+        self.entries[key] = entry
+        return entry[0]
+
+    def set(self, key, values, refs=None):
+        if key in self.entries:
+            self.size -= self.entries.pop(key)[0].nbytes
+        self.entries[key] = (values, refs)
+        self.size += values.nbytes
+        max_bytes = self.max_size*1024*1024
+        while self.size > max_bytes and len(self.entries) > 1:
+            k, entry = self.entries.popitem(last=False)
+            self.size -= entry[0].nbytes
+            dprint2("quadrature table is evicted from cache", k[:5])
+
+    def info(self):
+        return ("quadrature table cache: " + str(len(self.entries)) +
+                " tables, " + str(self.size//1024) + "kB, " +
+                "hit/miss = " + str(self.hit) + "/" + str(self.miss))
@@ -60,6 +60,7 @@ class WF_PeriodicCommon(Pair, Phys):
         v['tol'] = 1e-4
         v['map_mode'] = "surface"
         v['fes_idx'] = 0
+        v['distributed_mapping'] = False
         super(WF_PeriodicCommon, self).attribute_set(v)
         return v
         
@@ -75,7 +76,9 @@ class WF_PeriodicCommon(Pair, Phys):
                                                         'validator_param':self}],
                 self.make_phys_param_panel('weight',  self.weight_txt),                
                 self.make_phys_param_panel('tol.',  self.tol_txt),
-                ["", "u_dst = u_src" ,2, None],]     
+                ["", "u_dst = u_src" ,2, None],
+                ["distributed mapping", self.distributed_mapping, 3,
+                 {"text":""}],]
 #                ["use Lagrange multiplier",   self.use_multiplier,  3, {"text":""}],]     
 
     def get_panel1_value(self):
@@ -84,7 +87,7 @@ class WF_PeriodicCommon(Pair, Phys):
         
         return (dep_vars[self.fes_idx], 
                 self.dstmap_txt, self.srcmap_txt, self.weight_txt,
-                self.tol_txt, txt)
+                self.tol_txt, txt, self.distributed_mapping)
 
     def import_panel1_value(self, v):
         dep_vars = self.get_root_phys().dep_vars                    
@@ -93,6 +96,7 @@ class WF_PeriodicCommon(Pair, Phys):
         self.srcmap_txt = str(v[2])
         self.weight_txt  = str(v[3])        
         self.tol_txt  = str(v[4])
+        self.distributed_mapping = bool(v[6])
 
     def make_mapper(self):
         g = self._global_ns
@@ -170,10 +174,14 @@ class WF_PeriodicCommon(Pair, Phys):
         #nicePrint(M.GetColPartArray())
         #nicePrint(M.shape)
         '''
+        # distributed = None uses the default of dof_map
+        distributed = True if self.distributed_mapping else None
+
         from petram.helper.dof_map import projection_matrix
         M, r, c = projection_matrix(src, dst, fes, ess_tdof, fes2=fes,
                                     trans1 = dst_mapper, trans2=src_mapper,
-                                    weight = weight, tol = self.tol, mode = mode)
+                                    weight = weight, tol = self.tol, mode = mode,
+                                    distributed = distributed)
 
         return M, r, c
         
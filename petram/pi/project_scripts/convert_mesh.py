@@ -6,7 +6,7 @@ from petram.mesh.nastran2mfem import NASReader, write_nas2mfem
 from os.path import expanduser
 
 
-def nas2mfem(file = None, offset=None):
+def nas2mfem(file = None, offset=None, cache=False):
     if file is None:
         from ifigure.widgets.dialog import read
         path = read(message='Select NAS file to read', wildcard='*.nas')
@@ -20,7 +20,7 @@ def nas2mfem(file = None, offset=None):
         mname = '.'.join(mname.split('.')[:-1])
     mname = mname + '.mesh'
     print('reading file '+ path)
-    reader = NASReader(path)
+    reader = NASReader(path, cache=cache)
     reader.load()
     write_nas2mfem(os.path.join(dirname, mname),  reader, offset=offset)
 
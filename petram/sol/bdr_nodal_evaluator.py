@@ -22,6 +22,69 @@ else:
 from petram.sol.evaluator_agent import EvaluatorAgent
 Geom = mfem.Geometry()
 
+# DoF-to-vertex operators (see variables.nodal_value_operator) for each
+# set of vertices. shared among agents processing the same geometry (
+# the same mesh in different solution files/parametric cases)
+from collections import OrderedDict
+nodal_ops_cache = OrderedDict()
+nodal_ops_cache_size = 32
+
+def get_nodal_ops(mesh, ieles, locs):
+    import hashlib
+    h = hashlib.md5()
+    h.update(str((mesh.Dimension(), mesh.GetNV(), mesh.GetNE())).encode())
+    h.update(np.ascontiguousarray(ieles).tobytes())
+    h.update(np.ascontiguousarray(locs).tobytes())
+    key = h.hexdigest()
+    if key in nodal_ops_cache:
+        nodal_ops = nodal_ops_cache.pop(key)
+    else:
+        nodal_ops = {}
+    nodal_ops_cache[key] = nodal_ops
+    while len(nodal_ops_cache) > nodal_ops_cache_size:
+        nodal_ops_cache.popitem(last=False)
+    return nodal_ops
+
+def vert2el_elements(mesh, iverts_f):
+    '''
+    unique set of elements which share vertices in iverts_f
+    '''
+    vert2el = mesh.GetVertexToElementTable()
+    if not hasattr(vert2el, 'GetIArray'):
+        ieles = np.hstack([vert2el.GetRowList(i) for i in iverts_f])
+        return np.unique(ieles).astype(int)
+
+    # use CSR arrays of table directly
+    I = vert2el.GetIArray()
+    J = vert2el.GetJArray()
+    flag = np.zeros(len(I)-1, dtype=bool)
+    flag[iverts_f] = True
+    rows = np.repeat(flag, np.diff(I))
+    return np.unique(J[rows]).astype(int)
+
+def element_vertex_table(mesh, ieles, bdr = False):
+    '''
+    vertex table of (boundary) elements (len(ieles) x max number of
+    vertices). unused entries (mixed mesh) are filled with -1
+
+    the table of all elements is taken from mesh in bulk. elements are
+    visited one by one only when it is not available (mixed mesh).
+    '''
+    from petram.mesh.mesh_utils import element_vertex_array
+    table = element_vertex_array(mesh, bdr = bdr)
+    if table is not None:
+        return table[np.asarray(ieles, dtype=int)]
+
+    getelement = mesh.GetBdrElement if bdr else mesh.GetElement
+    ev = [getelement(iel).GetVerticesArray() for iel in ieles]
+    if len(ev) == 0: return np.zeros((0, 0), dtype=int)
+    nv = np.array([len(x) for x in ev], dtype=int)
+    if np.all(nv == nv[0]):
+        return np.vstack(ev).astype(int)
+    table = -np.ones((len(ev), np.max(nv)), dtype=int)
+    table[np.arange(np.max(nv)) < nv[:, None]] = np.hstack(ev)
+    return table
+
 def process_iverts2nodals(mesh, iverts):
     ''' 
     collect data to evalutate nodal values of mesh
@@ -34,34 +97,32 @@ def process_iverts2nodals(mesh, iverts):
     iverts_inv = iverts_inv.reshape(iverts.shape)
 
     # then get unique set of elements relating to the verts.
-    vert2el = mesh.GetVertexToElementTable()
-    ieles = np.hstack([vert2el.GetRowList(i) for i in iverts_f])
-    ieles = np.unique(ieles)
+    ieles = vert2el_elements(mesh, iverts_f)
 
     # map from element -> (element's vert index, ivert_f index)
-    elvert2facevert = [None]*len(ieles)
-    elvertloc = [None]*len(ieles)
-    elattr = [None]*len(ieles)
-
-    wverts = np.zeros(len(iverts_f))
-    for kk, iel in enumerate(ieles):
-        elvert2facevert[kk] = []
-        elvertloc[kk] = []
-        elattr[kk] = mesh.GetAttribute(iel)
-        elverts = mesh.GetElement(iel).GetVerticesArray()
-        for k, elvert in enumerate(elverts):
-            idx = np.searchsorted(iverts_f, elvert)
-            if idx == len(iverts_f): continue ## not found   
-            if iverts_f[idx] != elvert: continue ## not found
-            elvert2facevert[kk].append((k, idx))
-            elvertloc[kk].append(mesh.GetVertexArray(elvert))
-            wverts[idx] = wverts[idx]+1
+    table = element_vertex_table(mesh, ieles)
+    idx = np.searchsorted(iverts_f, table)
+    idx[idx == len(iverts_f)] = 0
+    found = np.logical_and(table >= 0, iverts_f[idx] == table)
+
+    kk, k = np.nonzero(found)
+    pairs = np.vstack((k, idx[found])).transpose()
+    splits = np.cumsum(np.sum(found, -1))[:-1]
+
+    # wverts: number of elements sharing each vertex
+    wverts = np.bincount(pairs[:, 1], minlength=len(iverts_f)).astype(float)
 
     # idx of element needs to be evaluated
-    
+    from petram.mesh.mesh_utils import vertex_array
+    locs = vertex_array(mesh)[iverts_f]
+    elvert2facevert = np.split(pairs, splits)
+    elvertloc = np.split(locs[pairs[:, 1]], splits)
+    elattr = mesh.GetAttributeArray()[ieles]
+
     return {'ieles': np.array(ieles),
             'elvert2facevert': elvert2facevert,
-            'locs': np.stack([mesh.GetVertexArray(k) for k in iverts_f]),
+            'locs': locs,
+            'nodal_ops': get_nodal_ops(mesh, ieles, locs),
             'elvertloc': elvertloc,
             'elattr': np.array(elattr),
             'iverts_inv': iverts_inv,
@@ -69,21 +130,23 @@ def process_iverts2nodals(mesh, iverts):
             'wverts' : wverts}
 
 def edge_detect(index):
+    '''
+    edges which belong to only one triangle (boundary of surface)
+
+    edges appearing odd times are kept (the same as toggling
+    a pair each time it appears)
+    '''
     #print("edge_detect", index.shape)
-    store = []
-    def check_pair(store, a, b):
-        a1 = min(a,b)
-        b1 = max(a,b)
-        p = (a1, b1)
-        if p in store: store.remove(p)
-        else: store.append(p)
-        return store
-        
-    for iv in index:
-        store = check_pair(store, iv[0], iv[1])
-        store = check_pair(store, iv[0], iv[2])
-        store = check_pair(store, iv[1], iv[2])        
-    ret = np.vstack(store)
+    index = np.asarray(index, dtype=np.int64)
+    edges = np.vstack((index[:, [0, 1]],
+                       index[:, [0, 2]],
+                       index[:, [1, 2]]))
+    edges = np.sort(edges, -1)
+    base = np.max(edges) + 1 if len(edges) > 0 else 1
+    keys, counts = np.unique(edges[:, 0]*base + edges[:, 1],
+                             return_counts = True)
+    keys = keys[counts % 2 == 1]
+    ret = np.vstack((keys // base, keys % base)).transpose()
     return  ret
 
 def get_emesh_idx(obj, expr, solvars, phys):
@@ -158,6 +221,7 @@ def eval_at_nodals(obj, expr, solvars, phys):
                                     wverts = obj.wverts,
                                     mesh = obj.mesh(),
                                     iverts_f = obj.iverts_f,
+                                    nodal_ops = getattr(obj, 'nodal_ops', None),
                                     g  = g,
                                     knowns = obj.knowns))
            #ll[n] = self.knowns[g[n]]
@@ -190,10 +254,10 @@ class BdrNodalEvaluator(EvaluatorAgent):
 
         if mesh.Dimension() == 3:
             getarray = mesh.GetBdrArray
-            getelement = mesh.GetBdrElement
+            bdr = True
         elif mesh.Dimension() == 2:
             getarray = mesh.GetDomainArray
-            getelement = mesh.GetElement            
+            bdr = False
         else:
             assert False, "BdrNodal Evaluator is not supported for this dimension"
             
@@ -203,8 +267,7 @@ class BdrNodalEvaluator(EvaluatorAgent):
         ibdrs = np.hstack(x).astype(int).flatten()
         self.ibeles = np.array(ibdrs)
         
-        iverts = np.stack([getelement(i).GetVerticesArray()
-                           for i in ibdrs])
+        iverts = element_vertex_table(mesh, ibdrs, bdr = bdr)
         self.iverts = iverts
         if len(self.iverts) == 0: return
 
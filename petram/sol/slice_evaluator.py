@@ -1,6 +1,7 @@
 import numpy as np
 import parser
 import scipy
+import scipy.sparse
 import six
 import weakref
 from weakref import WeakKeyDictionary as WKD
@@ -15,6 +16,7 @@ else:
 
 from petram.sol.evaluator_agent import EvaluatorAgent
 from petram.sol.bdr_nodal_evaluator import process_iverts2nodals
+from petram.sol.bdr_nodal_evaluator import element_vertex_table
 from petram.sol.bdr_nodal_evaluator import eval_at_nodals, get_emesh_idx
 
 class SliceEvaluator(EvaluatorAgent):
@@ -30,6 +32,51 @@ class SliceEvaluator(EvaluatorAgent):
         self.attrs = attrs
         self.plane = plane
         
+    def element_geometry(self, mesh, attrs, emesh_idx):
+        '''
+        vertex table and vertex coordinates of elements in attrs.
+        kept until mesh/attrs changes, so that moving the plane
+        does not rescan the volume
+        '''
+        key = (emesh_idx, tuple(attrs))
+        cache = getattr(self, '_geom_cache', None)
+        if (cache is not None and cache['key'] == key and
+            cache['mesh']() is mesh):
+            return cache
+
+        attr = mesh.GetAttributeArray()
+        x = [np.where(attr == a)[0] for a in attrs]
+        ialleles = np.hstack(x + [[]]).astype(int).flatten()
+        table = element_vertex_table(mesh, ialleles)
+        if len(ialleles) > 0:
+            u, inv = np.unique(table, return_inverse = True)
+            xyz = np.stack([mesh.GetVertexArray(i) for i in u])
+            verts = xyz[inv.reshape(table.shape)]
+        else:
+            verts = np.zeros((0, 0, 3))
+
+        self._geom_cache = {'key': key,
+                            'mesh': weakref.ref(mesh),
+                            'ialleles': ialleles,
+                            'table': table,
+                            'verts': verts,
+                            'axyz': None}
+        return self._geom_cache
+
+    def signed_distance(self, cache, axyz):
+        '''
+        axyz . x at element vertices (without c), and its min/max over
+        each element. c can be swept only by comparing -c with min/max.
+        '''
+        axyz = tuple(axyz)
+        if cache['axyz'] != axyz:
+            d = np.sum(cache['verts']*np.array(axyz), -1)
+            cache['axyz'] = axyz
+            cache['d'] = d
+            cache['dmin'] = np.min(d, -1) if d.size > 0 else d
+            cache['dmax'] = np.max(d, -1) if d.size > 0 else d
+        return cache['d'], cache['dmin'], cache['dmax']
+
     def preprocess_geometry(self, attrs, plane = None, emesh_idx=0):
         #from petram.sol.test import pg
         #return pg(self, battrs, plane = plane)
@@ -46,43 +93,33 @@ class SliceEvaluator(EvaluatorAgent):
         axyz = self.plane[:3]
         c    = self.plane[-1]
 
-        attr = mesh.GetAttributeArray()
-        x = [np.where(attr == a)[0] for a in attrs]
-        if np.sum([len(xx) for xx in x]) == 0: return
-
-        ialleles = np.hstack(x).astype(int).flatten()
-        ieles = []
-        num_tri = 0
-        tri_iverts = []
-        f_values = []
-        for iel in ialleles:
-            verts = np.vstack([mesh.GetVertexArray(i)
-                               for i in mesh.GetElement(iel).GetVerticesArray()])
-            f = np.sum(verts*axyz, -1) + c
-
-            ips = np.where(f > 0)[0]
-            ims = np.where(f < 0)[0]
-            izs = np.where(f == 0)[0]
-            #print f, ips, ims, izs            
-            if (len(ips) == 0 or len(ims) == 0) and len(izs) != 3:
-                continue # outside the plane
-            ieles.append(iel)
-            f_values.append(f)
-
-            if f.prod() > 0: # cross section is quad.
-               num_tri += 2
-            else:
-               num_tri += 1
+        cache = self.element_geometry(mesh, attrs, emesh_idx)
+        if len(cache['ialleles']) == 0: return
+        d, dmin, dmax = self.signed_distance(cache, axyz)
+
+        # elements touching the plane, then check sign of f
+        # at vertices only for them
+        icand = np.where(np.logical_and(dmin <= -c, dmax >= -c))[0]
+        f = d[icand] + c
+        npos = np.sum(f > 0, -1)
+        nneg = np.sum(f < 0, -1)
+        nzero = np.sum(f == 0, -1)
+        cross = np.logical_or(np.logical_and(npos > 0, nneg > 0),
+                              nzero == 3)
+        icross = icand[cross]
+        f = f[cross]; npos = npos[cross]; nneg = nneg[cross]
+        ieles = cache['ialleles'][icross]
 
         # then get unique set of elements relating to the verts.
+        quad = np.logical_and(npos == 2, nneg == 2) # cross section is quad.
+        ntri = np.where(quad, 2, 1)
+        num_tri = np.sum(ntri)
         if num_tri == 0:
             #print "not found"
             return
         print("found " + str(num_tri) + " elements")
-        vert2el = mesh.GetVertexToElementTable()
 
-        iverts = np.array([mesh.GetElement(iel).GetVerticesArray()
-                              for iel in ieles])
+        iverts = cache['table'][icross]
         self.iverts = iverts
 
         data = process_iverts2nodals(mesh, iverts)
@@ -91,50 +128,50 @@ class SliceEvaluator(EvaluatorAgent):
 
         iverts_f = self.iverts_f
 
-        # how to interpolate nodal values...
-        vertices = np.zeros((num_tri, 3, 3))
-        mat      = scipy.sparse.lil_matrix((num_tri*3, len(iverts_f)))
-
-        def fill_vert_mat(vertics, mat, ivv, itri, k, i1, i2, verts, f):
-            v1 = verts[i1]; v2 = verts[i2]
-            f1 = np.abs(f[i1]); f2 = np.abs(f[i2])
-            v = (v1*f2 + v2*f1)/(f1 + f2)
-            vertices[itri, k, :] = v
-            mat[itri*3+k, ivv[i1]] = np.abs(f2)/(f1+f2)
-            mat[itri*3+k, ivv[i2]] = np.abs(f1)/(f1+f2)
-
-        itri = 0
-        for iel, f in zip(ieles, f_values):
-            iv = mesh.GetElement(iel).GetVerticesArray()
-            verts = np.vstack([mesh.GetVertexArray(i) for i in iv])
-            ivv = [np.where(iverts_f == i)[0] for i in iv]
-            ips = np.where(f > 0)[0]
-            ims = np.where(f < 0)[0]           
-            if (len(ips) == 2 and len(ims) == 2):
-                fill_vert_mat(vertices, mat, ivv, itri, 0, ips[0], ims[0], verts, f)
-                fill_vert_mat(vertices, mat, ivv, itri, 1, ips[0], ims[1], verts, f)
-                fill_vert_mat(vertices, mat, ivv, itri, 2, ips[1], ims[0], verts, f)            
-                itri += 1
-
-                fill_vert_mat(vertices, mat, ivv, itri, 0, ips[1], ims[0], verts, f)
-                fill_vert_mat(vertices, mat, ivv, itri, 1, ips[1], ims[1], verts, f)
-                fill_vert_mat(vertices, mat, ivv, itri, 2, ips[0], ims[1], verts, f)            
-                itri += 1
-            else:
-
-                if len(ips) == 1:
-                    ims = np.where(f <= 0)[0]                                       
-                    i =  ips[0]
-                    ii = ims
-                else:
-                    ips = np.where(f >= 0)[0]   
-                    i = ims[0]
-                    ii = ips
-
-                fill_vert_mat(vertices, mat, ivv, itri, 0, i, ii[0], verts, f)
-                fill_vert_mat(vertices, mat, ivv, itri, 1, i, ii[1], verts, f)
-                fill_vert_mat(vertices, mat, ivv, itri, 2, i, ii[2], verts, f)    
-                itri += 1
+        # edges (element's vert index pair) cut by the plane.
+        # positive/negative vertices are taken in ascending order
+        pos = np.argsort(f <= 0, -1, kind='mergesort')
+        neg = np.argsort(f >= 0, -1, kind='mergesort')
+        nonpos = np.argsort(f > 0, -1, kind='mergesort')
+        nonneg = np.argsort(f < 0, -1, kind='mergesort')
+
+        edges = np.zeros((num_tri, 3, 2), dtype=int)
+        itri = np.cumsum(ntri) - ntri
+
+        q = np.where(quad)[0]
+        p0, p1 = pos[q, 0], pos[q, 1]
+        m0, m1 = neg[q, 0], neg[q, 1]
+        edges[itri[q]] = np.stack([np.stack((p0, m0), -1),
+                                   np.stack((p0, m1), -1),
+                                   np.stack((p1, m0), -1)], 1)
+        edges[itri[q]+1] = np.stack([np.stack((p1, m0), -1),
+                                     np.stack((p1, m1), -1),
+                                     np.stack((p0, m1), -1)], 1)
+
+        t = np.where(~quad)[0]
+        one_pos = npos[t] == 1
+        i = np.where(one_pos, pos[t, 0], neg[t, 0])
+        ii = np.where(one_pos[:, None], nonpos[t, :3], nonneg[t, :3])
+        edges[itri[t], :, 0] = i[:, None]
+        edges[itri[t], :, 1] = ii
+
+        # vertices on the edges and interpolation weights
+        iel = np.repeat(np.arange(len(icross)), ntri)[:, None]
+        f1 = np.abs(f[iel, edges[..., 0]])
+        f2 = np.abs(f[iel, edges[..., 1]])
+        verts = cache['verts'][icross]
+        v1 = verts[iel, edges[..., 0]]
+        v2 = verts[iel, edges[..., 1]]
+        vertices = (v1*f2[..., None] + v2*f1[..., None])/(f1 + f2)[..., None]
+
+        col1 = np.searchsorted(iverts_f, iverts[iel, edges[..., 0]])
+        col2 = np.searchsorted(iverts_f, iverts[iel, edges[..., 1]])
+        row = np.arange(num_tri*3)
+        mat = scipy.sparse.coo_matrix(
+                  (np.hstack(((f2/(f1+f2)).flatten(), (f1/(f1+f2)).flatten())),
+                   (np.hstack((row, row)),
+                    np.hstack((col1.flatten(), col2.flatten())))),
+                  shape = (num_tri*3, len(iverts_f))).tocsr()
 
         self.ibeles = None # can not use boundary variable in this evaulator        
         self.vertices = vertices
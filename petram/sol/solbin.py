@@ -0,0 +1,142 @@
+'''
+   solbin
+
+   binary solution container.
+
+   All GridFunctions saved by one rank are stored in a single
+   file (solbin + solfile_suffix). The file starts with a short
+   text header, followed by the data of each GridFunction as
+   contiguous little-endian float64 arrays.
+
+       PetraM-solbin 1
+       {json header}
+       (padding to ALIGN)
+       data ....
+
+   header["entries"] is a dictionary, whose keys are the name of
+   text solution file ('solr_E_0', 'soli_E_0'), and values are
+      offset   : byte offset from the start of data section
+      size     : number of elements
+      fec      : FiniteElementCollection name
+      vdim     : vector dimension of FiniteElementSpace
+      ordering : ordering of FiniteElementSpace
+
+   Data is read through numpy.memmap, so that opening a container
+   does not read the solution until it is actually used.
+'''
+import os
+import json
+import numpy as np
+
+MAGIC = 'PetraM-solbin 1\n'
+ALIGN = 64
+DTYPE = '<f8'
+
+solbin_header = 'solbin'
+
+def _aligned(n):
+    return ((n + ALIGN - 1)//ALIGN)*ALIGN
+
+def gf_info(gf):
+    fes = gf.FESpace()
+    return {'fec': fes.FEColl().Name(),
+            'vdim': fes.GetVDim(),
+            'ordering': fes.GetOrdering()}
+
+def write_solbin(filename, gfs, merge=False):
+    '''
+    gfs: list of (key, GridFunction)
+
+    merge = True keeps the entries of existing container which
+    are not in gfs (solutions saved by another solver in the same
+    directory)
+    '''
+    items = [(key, gf_info(gf), gf.GetDataArray()) for key, gf in gfs]
+    if merge and is_solbin(filename):
+        old = SolbinFile(filename)
+        keys = [key for key, gf in gfs]
+        items = [(key, old.entries[key], np.array(old.array(key)))
+                 for key in old.keys() if not key in keys] + items
+
+    entries = {}
+    arrays = []
+    offset = 0
+    for key, info, data in items:
+        data = np.ascontiguousarray(data, dtype=DTYPE)
+        info = {'fec': info['fec'],
+                'vdim': info['vdim'],
+                'ordering': info['ordering'],}
+        info['offset'] = offset
+        info['size'] = data.size
+        entries[key] = info
+        arrays.append(data)
+        offset = _aligned(offset + data.nbytes)
+
+    header = json.dumps({'entries': entries}) + '\n'
+    fid = open(filename, 'wb')
+    fid.write((MAGIC + header).encode())
+    start = _aligned(fid.tell())
+    for (key, void, void2), data in zip(items, arrays):
+        fid.seek(start + entries[key]['offset'])
+        fid.write(data.tobytes())
+    fid.close()
+
+class SolbinFile(object):
+    '''
+    read only access to solbin container
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        fid = open(filename, 'rb')
+        magic = fid.readline().decode('latin-1')
+        if magic != MAGIC:
+            fid.close()
+            assert False, "not a solbin file: " + filename
+        self.header = json.loads(fid.readline().decode())
+        self.data_start = _aligned(fid.tell())
+        fid.close()
+
+    @property
+    def entries(self):
+        return self.header['entries']
+
+    def keys(self):
+        return [str(k) for k in self.entries]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def array(self, key):
+        info = self.entries[key]
+        if info['size'] == 0:
+            return np.zeros(0, dtype=DTYPE)
+        return np.memmap(self.filename, dtype=DTYPE, mode='r',
+                         offset=self.data_start + info['offset'],
+                         shape=(info['size'],))
+
+    def gridfunction(self, key, mesh, mfem):
+        '''
+        construct GridFunction on mesh from the data of key
+        '''
+        info = self.entries[key]
+        fec = fec_from_name(str(info['fec']), mfem)
+        fes = mfem.FiniteElementSpace(mesh, fec, info['vdim'],
+                                      info['ordering'])
+        gf = mfem.GridFunction(fes)
+        gf.GetDataArray()[:] = self.array(key)
+        # keep fec and fes alive as long as gf is used
+        gf._fec = fec
+        gf._fes = fes
+        return gf
+
+def fec_from_name(name, mfem):
+    if hasattr(mfem.FiniteElementCollection, 'New'):
+        return mfem.FiniteElementCollection.New(name)
+    return mfem.FiniteElementCollection_New(name)
+
+def is_solbin(filename):
+    if not os.path.isfile(filename): return False
+    fid = open(filename, 'rb')
+    magic = fid.read(len(MAGIC)).decode('latin-1')
+    fid.close()
+    return magic == MAGIC
@@ -1,5 +1,16 @@
 import os
+import re
 import six
+from collections import namedtuple, OrderedDict
+
+from petram.sol.solbin import SolbinFile, solbin_header
+
+'''
+SolbinRef: reference to an entry in binary solution container
+   path : container file
+   key  : 'solr_E_0', 'soli_E_0'...
+'''
+SolbinRef = namedtuple('SolbinRef', ('path', 'key'))
 
 class Solfiles(object):
     '''
@@ -15,41 +26,181 @@ class Solfiles(object):
     def __getitem__(self, idx):
         return Solfiles(self.set[idx])
 
+class SolsetsCache(object):
+    '''
+    LRU cache of meshes and GridFunctions loaded by Solsets.
+
+    Objects are dropped from the cache in least-recently-used order
+    when the estimated size of resident objects exceeds maxsize
+    (MB). An evicted object is freed when nobody else refers to it,
+    and is read from the file again when it is needed next time.
+    '''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.objs = OrderedDict()
+
+    def get(self, key, loader):
+        if key in self.objs:
+            obj, size = self.objs.pop(key)
+        else:
+            obj, size = loader()
+        self.objs[key] = (obj, size)
+        self.evict()
+        return obj
+
+    def evict(self):
+        total = sum([size for obj, size in self.objs.values()])
+        while total > self.maxsize*1024*1024 and len(self.objs) > 1:
+            key, (obj, size) = self.objs.popitem(last=False)
+            total = total - size
+
+    def clear(self):
+        self.objs.clear()
+
+sol_cache = SolsetsCache()
+
+def set_cache_size(maxsize):
+    '''
+    set the upper bound of memory (MB) kept by Solsets
+    '''
+    sol_cache.maxsize = maxsize
+    sol_cache.evict()
+
+solbin_files = {}
+def open_solbin(path):
+    key = (path, os.path.getmtime(path))
+    if not key in solbin_files:
+        solbin_files[key] = SolbinFile(path)
+    return solbin_files[key]
+
+def fname2idx(t):
+    if isinstance(t, SolbinRef): t = t.key
+    i = int(os.path.basename(t).split('.')[0].split('_')[-1])
+    return i
+
+def read_gf_header(f):
+    '''
+    returns (fec name, vdim) without reading solution data
+    '''
+    if isinstance(f, SolbinRef):
+        info = open_solbin(f.path).entries[f.key]
+        return str(info['fec']), info['vdim']
+    fid = open(f, 'r')
+    lines = [fid.readline() for i in range(3)]
+    fid.close()
+    fec = lines[1].split(':')[1].strip()
+    vdim = int(lines[2].split(':')[1].strip())
+    return fec, vdim
+
 class MeshDict(dict):
-    pass
+    '''
+    dict of meshes. A mesh is read from the file when it is first
+    accessed.
+    '''
+    def __init__(self, paths, refine=0):
+        dict.__init__(self)
+        self.paths = paths
+        self.refine = refine
+        for i in paths: dict.__setitem__(self, i, None)
+
+    def __getitem__(self, i):
+        path = self.paths[i]
+        key = ('mesh', path, os.path.getmtime(path), self.refine)
+        def loader():
+            import mfem.ser as mfem
+            m = mfem.Mesh(str(path), 1, self.refine)
+            ### what is this refine = 0 !?
+            m.ReorientTetMesh()
+            m._emesh_idx = i
+            return m, os.path.getsize(path)
+        return sol_cache.get(key, loader)
+
+    def get(self, i, default=None):
+        return self[i] if i in self else default
+    def values(self):
+        return [self[i] for i in self.keys()]
+    def items(self):
+        return [(i, self[i]) for i in self.keys()]
+    def itervalues(self):
+        for i in self.keys(): yield self[i]
+    def iteritems(self):
+        for i in self.keys(): yield (i, self[i])
+
+class LazyGridFunction(object):
+    '''
+    placeholder of GridFunction in Solsets.
+
+    VectorDim and _emesh_idx are answered from the file header.
+    Other attributes are forwarded to the GridFunction, which is
+    loaded through sol_cache. Use resolve_gf to get the GridFunction
+    itself (when it is passed to mfem).
+    '''
+    def __init__(self, f, meshes, emesh_idx):
+        self._file = f
+        self._meshes = meshes
+        self._emesh_idx = emesh_idx
+        self._header = None
+
+    def _fec_vdim(self):
+        if self._header is None:
+            self._header = read_gf_header(self._file)
+        return self._header
+
+    def VectorDim(self):
+        fec, vdim = self._fec_vdim()
+        if fec.startswith('ND') or fec.startswith('RT'):
+            return int(re.search(r'_(\d)D', fec).group(1))
+        return vdim
+
+    def get(self):
+        f = self._file
+        path = f.path if isinstance(f, SolbinRef) else f
+        key = ('gf', f, os.path.getmtime(path), self._meshes.refine)
+        def loader():
+            import mfem.ser as mfem
+            m = self._meshes[self._emesh_idx]
+            if isinstance(f, SolbinRef):
+                gf = open_solbin(f.path).gridfunction(f.key, m, mfem)
+            else:
+                gf = mfem.GridFunction(m, str(f))
+            gf._emesh_idx = self._emesh_idx
+            gf._mesh = m  # keep mesh alive as long as gf is used
+            return gf, gf.Size()*8
+        return sol_cache.get(key, loader)
+
+    def __getattr__(self, name):
+        if name.startswith('__'): raise AttributeError(name)
+        return getattr(self.get(), name)
+
+def resolve_gf(gf):
+    if isinstance(gf, LazyGridFunction):
+        return gf.get()
+    return gf
         
 class Solsets(object):
     '''
     Solsets: bundle of GridFunctions
 
       methes: names, meshes, gfr, gfi
+
+    meshes and GridFunctions are loaded when they are accessed.
     '''
     def __init__(self, solfiles, refine=0):
-        def fname2idx(t):
-           i = int(os.path.basename(t).split('.')[0].split('_')[-1])
-           return i
         solfiles = solfiles.set
         object.__init__(self)
         self.set = []
-        import mfem.ser as mfem
-        
+
         for meshes, solf, in solfiles:
             idx = [fname2idx(x) for x in meshes]
-            meshes = {i:  mfem.Mesh(str(x), 1, refine) for i, x in zip(idx, meshes)}
-            meshes=MeshDict(meshes) # to make dict weakref-able
-            ### what is this refine = 0 !?
-            for i in idx:
-                meshes[i].ReorientTetMesh()
-                meshes[i]._emesh_idx = i
+            meshes = MeshDict(dict(zip(idx, meshes)), refine=refine)
             s = {}
             for key in six.iterkeys(solf):
                fr, fi =  solf[key]
                i = fname2idx(fr)
-               m = meshes[i]
-               solr = (mfem.GridFunction(m, str(fr)) if fr is not None else None)
-               soli = (mfem.GridFunction(m, str(fi)) if fi is not None else None)
-               if solr is not None: solr._emesh_idx = i
-               if soli is not None: soli._emesh_idx = i
+               solr = (LazyGridFunction(fr, meshes, i)
+                       if fr is not None else None)
+               soli = (LazyGridFunction(fi, meshes, i)
+                       if fi is not None else None)
                s[key] = (solr, soli)
             self.set.append((meshes, s))
 
@@ -70,10 +221,10 @@ class Solsets(object):
         return tuple(set(ret))
 
     def gfr(self, name):
-        return [x[1][name][0] for x in self.set]
+        return [resolve_gf(x[1][name][0]) for x in self.set]
 
     def gfi(self, name):
-        return [x[1][name][1] for x in self.set]
+        return [resolve_gf(x[1][name][1]) for x in self.set]
 
 def find_solfiles(path, idx = None):
     import os
@@ -82,6 +233,7 @@ def find_solfiles(path, idx = None):
     mfiles = [x for x in files if x.startswith('solmesh')]
     solrfile = [x for x in files if x.startswith('solr')]
     solifile = [x for x in files if x.startswith('soli')]
+    binfiles = [x for x in files if x.startswith(solbin_header)]
 
     if len(mfiles) == 0:
         '''
@@ -109,6 +261,15 @@ def find_solfiles(path, idx = None):
         names = ['_'.join(x.split('.')[0].split('_')[1:]) for x in solrs]
 
         sol = {}
+        if (solbin_header + s) in binfiles:
+            binfile = os.path.join(path, solbin_header + s)
+            keys = SolbinFile(binfile).keys()
+            for key in keys:
+                if not key.startswith('solr_'): continue
+                n = key[5:]
+                keyi = 'soli_' + n
+                sol[n] = (SolbinRef(binfile, key),
+                          SolbinRef(binfile, keyi) if keyi in keys else None)
         for n in names:
             print 'solr_'+ n + s
             solr = (os.path.join(path, 'solr_'+ n + s)
@@ -22,6 +22,7 @@ else:
    default_kind = 'scipy'
 
 from petram.solver.mumps_model import MUMPSPreconditioner   
+from petram.helper.block_matrix import DistributedSolution
 SparseSmootherCls = {"Jacobi": (mfem.DSmoother, 0),
                      "l1Jacobi": (mfem.DSmoother, 1),
                      "lumpedJacobi": (mfem.DSmoother, 2),
@@ -106,6 +107,10 @@ class GMRES(LinearSolverModel):
 
 
     def real_to_complex(self, solall, M):
+        if isinstance(solall, DistributedSolution):
+           b = solall.blocks
+           return DistributedSolution([b[i] + 1j*b[i+1]
+                                       for i in range(0, len(b), 2)])
         if use_parallel:
            from mpi4py import MPI
            myid     = MPI.COMM_WORLD.rank
@@ -176,7 +181,6 @@ class GMRESSolver(LinearSolver):
         from mpi4py import MPI
         myid     = MPI.COMM_WORLD.rank
         nproc    = MPI.COMM_WORLD.size
-        from petram.helper.mpi_recipes import gather_vector
         
         def get_block(Op, i, j):
             try:
@@ -281,7 +285,6 @@ class GMRESSolver(LinearSolver):
         kdim = int(self.kdim)
         printit = 1
 
-        sol = []
 
         solver = mfem.GMRESSolver(MPI.COMM_WORLD)
         solver.SetKDim(kdim)
@@ -298,9 +301,9 @@ class GMRESSolver(LinearSolver):
         solver.SetPreconditioner(M)
         solver.SetPrintLevel(1)
 
-        # solve the problem and gather solution to head node...
-        # may not be the best approach
-
+        # solution is kept distributed. each node keeps local
+        # part of blocks (see DistributedSolution)
+        sol = [[] for i in range(offset.Size()-1)]
         for bb in b:
            rows = MPI.COMM_WORLD.allgather(np.int32(bb.Size()))
            rowstarts = np.hstack((0, np.cumsum(rows)))
@@ -315,21 +318,9 @@ class GMRESSolver(LinearSolver):
               #   dprint1(x.GetBlock(j).GetDataArray())
               #assert False, "must implement this"
            solver.Mult(bb, xx)
-           s = []
            for i in range(offset.Size()-1):
-               v = xx.GetBlock(i).GetDataArray()
-               vv = gather_vector(v)
-               if myid == 0:
-                   s.append(vv)
-               else:
-                   pass
-           if myid == 0:               
-               sol.append(np.hstack(s))
-        if myid == 0:                              
-            sol = np.transpose(np.vstack(sol))
-            return sol
-        else:
-            return None
+               sol[i].append(xx.GetBlock(i).GetDataArray().copy())
+        return DistributedSolution([np.transpose(np.vstack(s)) for s in sol])
         
     def solve_serial(self, A, b, x=None):
 
@@ -24,6 +24,7 @@ else:
    default_kind = 'scipy'
 
 from petram.solver.mumps_model import MUMPSPreconditioner   
+from petram.helper.block_matrix import DistributedSolution
 SparseSmootherCls = {"Jacobi": (mfem.DSmoother, 0),
                      "l1Jacobi": (mfem.DSmoother, 1),
                      "lumpedJacobi": (mfem.DSmoother, 2),
@@ -134,6 +135,10 @@ class Iterative(LinearSolverModel, NS_mixin):
 
 
     def real_to_complex(self, solall, M):
+        if isinstance(solall, DistributedSolution):
+           b = solall.blocks
+           return DistributedSolution([b[i] + 1j*b[i+1]
+                                       for i in range(0, len(b), 2)])
         if use_parallel:
            from mpi4py import MPI
            myid     = MPI.COMM_WORLD.rank
@@ -310,13 +315,11 @@ class IterativeSolver(LinearSolver):
         M = self.make_preconditioner(A, parallel=True)
               
         solver = self.make_solver(A, M, use_mpi=True)
-        sol = []
 
-        # solve the problem and gather solution to head node...
-        # may not be the best approach
-        
-        from petram.helper.mpi_recipes import gather_vector        
+        # solution is kept distributed. each node keeps local
+        # part of blocks (see DistributedSolution)
         offset = A.RowOffsets()
+        sol = [[] for i in range(offset.Size()-1)]
         for bb in b:
            rows = MPI.COMM_WORLD.allgather(np.int32(bb.Size()))
            rowstarts = np.hstack((0, np.cumsum(rows)))
@@ -332,21 +335,9 @@ class IterativeSolver(LinearSolver):
               #assert False, "must implement this"
            self.call_mult(solver, bb, xx)
 
-           s = []
            for i in range(offset.Size()-1):
-               v = xx.GetBlock(i).GetDataArray()
-               vv = gather_vector(v)
-               if myid == 0:
-                   s.append(vv)
-               else:
-                   pass
-           if myid == 0:               
-               sol.append(np.hstack(s))
-        if myid == 0:                              
-            sol = np.transpose(np.vstack(sol))
-            return sol
-        else:
-            return None
+               sol[i].append(xx.GetBlock(i).GetDataArray().copy())
+        return DistributedSolution([np.transpose(np.vstack(s)) for s in sol])
         
     def solve_serial(self, A, b, x=None):
         if self.gui.write_mat:                      
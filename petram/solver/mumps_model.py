@@ -2,6 +2,7 @@ from .solver_model import LinearSolverModel, LinearSolver
 import numpy as np
 import scipy
 import weakref
+from collections import OrderedDict
 
 import petram.debug as debug
 dprint1, dprint2, dprint3 = debug.init_dprints('MUMPSModel')
@@ -28,12 +29,15 @@ class MUMPS(LinearSolverModel):
                 ["write matrix",  self.write_mat,   3, {"text":""}],
 #                ["centralize matrix",  self.central_mat,   3, {"text":""}],
                 ["use BLR",  self.use_blr,   3, {"text":""}],
-                ["BLR drop parameter",  self.blr_drop,   300, {}],]
+                ["BLR drop parameter",  self.blr_drop,   300, {}],
+                ["reuse analysis",  self.reuse_analysis,   3, {"text":""}],
+                ["factor cache size",  self.factor_cache,   400, {}],]
     
     def get_panel1_value(self):
         return (long(self.log_level), self.ordering, self.out_of_core,
                 self.error_ana, self.write_mat, #self.central_mat,
-                self.use_blr, self.blr_drop)
+                self.use_blr, self.blr_drop, self.reuse_analysis,
+                long(self.factor_cache))
     
     def import_panel1_value(self, v):
         self.log_level = long(v[0])
@@ -44,6 +48,8 @@ class MUMPS(LinearSolverModel):
         #self.central_mat = v[5]
         self.use_blr = v[5]
         self.blr_drop = v[6]
+        self.reuse_analysis = v[7]
+        self.factor_cache = long(v[8])
         
     def attribute_set(self, v):
         v = super(MUMPS, self).attribute_set(v)
@@ -63,6 +69,12 @@ class MUMPS(LinearSolverModel):
         v['error_ana'] = 'none'
         v['use_blr'] = False
         v['blr_drop'] = 0.0
+        v['reuse_analysis'] = True
+        '''
+        number of numerical factorizations kept in memory (or on disk with
+        out-of-core). 0 : only the last factorization is kept.
+        '''
+        v['factor_cache'] = 0
         return v
     
     def linear_system_type(self, assemble_real, phys_real):
@@ -168,27 +180,26 @@ class MUMPSSolver(LinearSolver):
             pass
         
     def AllocSolver(self, datatype):
-        from petram.ext.mumps.mumps_solve import DMUMPS, d_to_list
-        from petram.ext.mumps.mumps_solve import ZMUMPS, z_to_list
-        from petram.ext.mumps.mumps_solve import i_array, JOB_1_2_3
-
         if datatype == 'Z':
             from petram.ext.mumps.mumps_solve import z_array as data_array
-            from petram.ext.mumps.mumps_solve import z_to_list as to_list
-            s = ZMUMPS()
             is_complex = True
         elif datatype == 'D':            
             from petram.ext.mumps.mumps_solve import d_array as data_array
-            from petram.ext.mumps.mumps_solve import d_to_list as to_list
-            s = DMUMPS()
             is_complex = False            
         else:
             assert False, "datatype S and F are not supported"
             
-        self.s = s
         self.is_complex = is_complex
         self.data_array = data_array
 
+        self.s = self.new_instance()
+        self.pattern_key = None   # sparsity pattern analyzed by self.s
+        self.factors = OrderedDict()  # value key -> (s, pattern key, dataset)
+
+    def new_instance(self):
+        from petram.ext.mumps.mumps_solve import DMUMPS, ZMUMPS
+        
+        s = ZMUMPS() if self.is_complex else DMUMPS()
         gui = self.gui
         # No outputs
         if gui.log_level == 0:
@@ -203,6 +214,57 @@ class MUMPSSolver(LinearSolver):
             s.set_icntl(2,  6)
             s.set_icntl(3,  6)            
             s.set_icntl(4,  6)
+        return s
+
+    def make_keys(self, row, col, data, shape):
+        '''
+        hash of sparsity pattern and matrix values. keys are made from
+        local data on all ranks so that all ranks agree on them.
+        '''
+        try:
+            from mpi4py import MPI
+        except:
+            from petram.helper.dummy_mpi import MPI
+        import hashlib
+        
+        h = hashlib.md5(str(shape).encode())
+        h.update(np.ascontiguousarray(row).tobytes())
+        h.update(np.ascontiguousarray(col).tobytes())
+        pkey = h.hexdigest()
+        if len(self.factors) > 0 or self.factor_cache_size() > 0:
+            h.update(np.ascontiguousarray(data).tobytes())
+            vkey = h.hexdigest()
+        else:
+            vkey = None
+        keys = MPI.COMM_WORLD.allgather((pkey, vkey))
+        pkey = hashlib.md5(''.join([k[0] for k in keys]).encode()).hexdigest()
+        if vkey is not None:
+            vkey = hashlib.md5(''.join([k[1] for k in keys]).encode()).hexdigest()
+        return pkey, vkey
+
+    def factor_cache_size(self):
+        return int(getattr(self.gui, 'factor_cache', 0))
+
+    def select_instance(self, vkey):
+        '''
+        choose MUMPS instance for new matrix values. Returns True if
+        the factorization of the same matrix is kept in cache.
+        '''
+        size = self.factor_cache_size()
+        if size <= 0: return False
+        
+        if vkey in self.factors:
+            s, pkey, dataset = self.factors.pop(vkey)
+            self.factors[vkey] = (s, pkey, dataset)
+            self.s, self.pattern_key, self.dataset = s, pkey, dataset
+            return True
+        if len(self.factors) >= size:
+            # reuse the least recently used instance
+            s, pkey, dataset = self.factors.popitem(last=False)[1]
+            self.s, self.pattern_key, self.dataset = s, pkey, dataset
+        elif len(self.factors) > 0:
+            self.s, self.pattern_key = self.new_instance(), None
+        return False
         
     def SetOperator(self, A, dist, name=None):
         try:
@@ -212,21 +274,68 @@ class MUMPSSolver(LinearSolver):
         myid     = MPI.COMM_WORLD.rank
         nproc    = MPI.COMM_WORLD.size
         
-        from petram.ext.mumps.mumps_solve import i_array, JOB_1_2_3
+        from petram.ext.mumps.mumps_solve import i_array
+        import petram.ext.mumps.mumps_solve as mumps_solve
+        
         gui = self.gui
-        s = self.s
+        dprint1('!!!these two must be consistent')
+        dprint1('sizeof(MUMPS_INT) ' , mumps_solve.SIZEOF_MUMPS_INT())
+        dtype_int = 'int'+str(mumps_solve.SIZEOF_MUMPS_INT()*8)
+        
         if dist:
             dprint1("SetOperator distributed matrix")
             A.eliminate_zeros()
             if gui.write_mat:
                 write_coo_matrix('matrix', A)
+            row, col, data = A.row, A.col, A.data
+        else:
+            A = A.tocoo(False)#.astype('complex')
+            if gui.write_mat:
+                #tocsr().tocoo() forces the output is row sorted.
+                write_coo_matrix('matrix', A.tocsr().tocoo())
+            if myid == 0:
+                row, col, data = A.row, A.col, A.data
+            else:
+                row, col, data = [np.zeros(0)]*3
+                
+        pkey, vkey = self.make_keys(row, col, data, A.shape)
+        if self.select_instance(vkey):
+            dprint1("SetOperator: reusing factorization kept in cache")
+            return
+        s = self.s
+        
+        if (gui.reuse_analysis and pkey == self.pattern_key and
+            (dist or myid == 0)):
+            # same sparsity pattern. only matrix values are updated.
+            # index arrays set to MUMPS in analysis are kept alive in dataset
+            dprint1("SetOperator: reusing analysis (same sparsity pattern)")
+            row, col = self.dataset[1:3]
+            a = self.data_array(data)
+            if dist:
+                s.set_a_loc(a)
+            else:
+                s.set_a(a)
+            self.dataset = (data, row, col, a) + self.dataset[4:]
+            
+        if gui.reuse_analysis and pkey == self.pattern_key:
+            self.factorize(s)
+        else:
+            self.analyze_and_factorize(s, A, row, col, data, dist, dtype_int)
+            self.pattern_key = pkey
+            
+        if self.factor_cache_size() > 0:
+            self.factors[vkey] = (s, pkey, self.dataset)
 
-            import petram.ext.mumps.mumps_solve as mumps_solve
-            dprint1('!!!these two must be consistent')
-            dprint1('sizeof(MUMPS_INT) ' , mumps_solve.SIZEOF_MUMPS_INT())
-            #dprint1('index data size ' , type(A.col[0]))
-            #dprint1('matrix data type ' , type(A.data[0]))
-
+    def analyze_and_factorize(self, s, A, row, col, data, dist, dtype_int):
+        try:
+            from mpi4py import MPI
+        except:
+            from petram.helper.dummy_mpi import MPI
+        myid     = MPI.COMM_WORLD.rank
+        
+        from petram.ext.mumps.mumps_solve import i_array
+        gui = self.gui
+        if dist:
             s.set_icntl(5,0)
             s.set_icntl(18,3)
 
@@ -235,50 +344,39 @@ class MUMPSSolver(LinearSolver):
             if myid ==0:
                 dprint1("NNZ all: ", nnz_array, np.sum(nnz_array))            
                 s.set_n(A.shape[1])
-            dtype_int = 'int'+str(mumps_solve.SIZEOF_MUMPS_INT()*8)
-            row = A.row
-            col = A.col
             row = row.astype(dtype_int) + 1
             col = col.astype(dtype_int) + 1
             dprint1('index data size ' , type(col[0]))
-            dprint1('matrix data type ' , type(A.data[0]))
+            dprint1('matrix data type ' , type(data[0]))
 
-            s.set_nz_loc(len(A.data))
-            s.set_irn_loc(i_array(row))
-            s.set_jcn_loc(i_array(col))            
-            s.set_a_loc(self.data_array(A.data))
+            irn, jcn, a = i_array(row), i_array(col), self.data_array(data)
+            s.set_nz_loc(len(data))
+            s.set_irn_loc(irn)
+            s.set_jcn_loc(jcn)
+            s.set_a_loc(a)
 
             s.set_icntl(14,  200)
             s.set_icntl(2, 1)
 
-            self.dataset = (A.data, row, col)
+            self.dataset = (data, row, col, a, irn, jcn)
         else:
-            A = A.tocoo(False)#.astype('complex')
-            import petram.ext.mumps.mumps_solve as mumps_solve
-            dprint1('!!!these two must be consistent')
-            dprint1('sizeof(MUMPS_INT) ' , mumps_solve.SIZEOF_MUMPS_INT())
-
-            dtype_int = 'int'+str(mumps_solve.SIZEOF_MUMPS_INT()*8)
-
-            if gui.write_mat:
-                #tocsr().tocoo() forces the output is row sorted.
-                write_coo_matrix('matrix', A.tocsr().tocoo())
             # No outputs
             if myid ==0:
-                row = A.row
-                col = A.col
                 row = row.astype(dtype_int) + 1
                 col = col.astype(dtype_int) + 1
                 dprint1('index data size ' , type(col[0]))
-                dprint1('matrix data type ' , type(A.data[0]))
+                dprint1('matrix data type ' , type(data[0]))
 
                 s.set_n(A.shape[0])
 
-                s.set_nz(len(A.data))
-                s.set_irn(i_array(row))
-                s.set_jcn(i_array(col))            
-                s.set_a(self.data_array(A.data))
-                self.dataset = (A.data, row, col)                
+                irn, jcn, a = i_array(row), i_array(col), self.data_array(data)
+                s.set_nz(len(data))
+                s.set_irn(irn)
+                s.set_jcn(jcn)
+                s.set_a(a)
+                self.dataset = (data, row, col, a, irn, jcn)
+            else:
+                self.dataset = (None,)*6
             s.set_icntl(14,  50)
             s.set_icntl(6,  5)    # column permutation
 
@@ -297,13 +395,19 @@ class MUMPSSolver(LinearSolver):
         s.set_job(1)
         s.run()
 
+        self.factorize(s)
+
+    def factorize(self, s):
+        try:
+            from mpi4py import MPI
+        except:
+            from petram.helper.dummy_mpi import MPI
         MPI.COMM_WORLD.Barrier()
         dprint1("job2")
         s.set_icntl(24, 1)
         s.set_job(2)
         s.run()
     
-
     def Mult(self, b, x=None, case_base=0):
         try:
             from mpi4py import MPI
@@ -1,6 +1,8 @@
 import os
 import traceback
 import gc
+import warnings
+import numpy as np
 
 from petram.model import Model
 from petram.solver.solver_model import Solver
@@ -10,7 +12,8 @@ dprint1, dprint2, dprint3 = debug.init_dprints('Parametric')
 format_memory_usage = debug.format_memory_usage
 
 assembly_methods = {'Full assemble': 0,
-                    'Reuse matrix' : 1}
+                    'Reuse matrix' : 1,
+                    'Affine terms' : 2}
 
 class Parametric(Solver, NS_mixin):
     '''
@@ -34,7 +37,9 @@ class Parametric(Solver, NS_mixin):
                       "choices": assembly_methods.keys()}],
                 self.make_param_panel('scanner',  v[1]),
                 [ "save separate mesh",  v[2],  3, {"text":""}],
-                ["inner solver", v[3]  ,2, None],                
+                ["affine terms",  v[3],  0, {}],
+                ["RHS batch size",  v[4],  400, {}],
+                ["inner solver", v[5]  ,2, None],                
                 ]
     
     def get_panel1_value(self):
@@ -46,12 +51,16 @@ class Parametric(Solver, NS_mixin):
                 str(txt),      
                 str(self.scanner),    
                 self.save_separate_mesh,
+                str(self.affine_terms),
+                long(self.rhs_batch_size),
                 self.get_inner_solver_names())
 
     def import_panel1_value(self, v):
         self.assembly_method = assembly_methods[v[0]]
         self.scanner = v[1]
         self.save_separate_mesh = v[2]
+        self.affine_terms = str(v[3])
+        self.rhs_batch_size = long(v[4])
 
     def get_inner_solver_names(self):
         names = [s.name() for s in self.get_inner_solvers()]
@@ -65,6 +74,8 @@ class Parametric(Solver, NS_mixin):
         v['assembly_method'] = 0
         v['scanner'] = 'Scan("a", [1,2,3])'
         v['save_separate_mesh'] = True
+        v['affine_terms'] = ''
+        v['rhs_batch_size'] = 1
         return v
     
     def get_possible_child(self):
@@ -87,13 +98,166 @@ class Parametric(Solver, NS_mixin):
         return {'Scan': Scan}
 
 
+    def get_child_solver(self):
+        return self.get_inner_solvers()
+
+    def get_matrix_weight(self, timestep_config):
+        weights = [s.get_matrix_weight(timestep_config)
+                   for s in self.get_inner_solvers()]
+        if len(weights) == 0: return [0, 0, 0]
+        return [max(x) for x in zip(*weights)]
+
+    def update_assembly(self, engine, instance, names):
+        '''
+        reassemble forms of model objects which depend on names.
+        returns True if matrix is changed
+        '''
+        phys_target = instance.get_phys()
+        for phys in phys_target:
+            engine.run_update_param(phys)
+        engine.set_update_flag('ParamChanged', names=names)
+        return instance.assemble(inplace=False, update=True)
+
+    def eval_affine_terms(self, scanner):
+        '''
+        evaluate affine terms using the parameter values of
+        current case.
+
+        affine terms (such as "1, freq, freq**2") declares that 
+        the linear system is a linear combination of parameter 
+        independent terms with these coefficients. 
+        '''
+        g = scanner.target_phys[0]._global_ns
+        terms = eval('[' + str(self.affine_terms) + ']', g, {})
+        return np.array(terms, dtype=complex)
+
+    @staticmethod
+    def affine_scale(F):
+        '''
+        scale of each affine term (max magnitude at the sample cases).
+        terms such as "1, freq, freq**2" differ by many orders, and
+        F is checked/solved after each column is divided by this.
+        '''
+        scale = np.max(np.abs(F), 0)
+        scale[scale == 0] = 1.0
+        return scale
+
+    def combine_terms(self, engine, instance, samples, F, f):
+        '''
+        make linear system from the ones assembled at the sample
+        cases. 
+           samples : list of (M, B) at the sample cases
+           F : affine terms at the sample cases (nsample x nterms)
+           f : affine terms at the current case
+        '''
+        # weights c satisfies sum_j c[j]*F[j, :] = f
+        scale = self.affine_scale(F)
+        c = np.linalg.solve((F/scale).transpose(), f/scale)
+        if np.all(c.imag == 0): c = c.real
+        dprint1("combining affine terms with weights", c)
+
+        def combine(blocks):
+            ret = None
+            for b, x in zip(blocks, c):
+                if x == 0: continue
+                ret = b*x if ret is None else ret + b*x
+            return ret
+
+        n_matrix = len(samples[0][0])
+        M = [combine([s[0][k] for s in samples]) for k in range(n_matrix)]
+        B = combine([s[1] for s in samples])
+
+        phys_target = instance.get_phys()
+        phys_range  = instance.get_phys_range()
+        for phys in phys_target:
+            engine.run_update_param(phys)
+        engine.run_apply_essential(phys_target, phys_range)
+        engine.run_fill_X_block()
+        engine.run_combine_blocks(instance.compute_A, instance.compute_rhs,
+                                  M, B, inplace=False)
+
+    @staticmethod
+    def copy_M_B(engine):
+        '''
+        shallow copy of M, B containers, since update assembly
+        replaces their blocks
+        '''
+        B = engine.assembled_blocks[4]
+        M = engine.assembled_blocks[5]
+        M = [m.get_subblock([True]*m.shape[0], [True]*m.shape[1]) for m in M]
+        B = B.get_subblock([True]*B.shape[0], [True]*B.shape[1])
+        return M, B
+
+    def get_case_group(self):
+        '''
+        case group (igroup, ngroup) given by --case-group igroup/ngroup
+        option of model script.
+        '''
+        import petram.mfem_config as mfem_config
+        txt = str(getattr(mfem_config, 'case_group', '')).strip()
+        if txt == '': return 0, 1
+        igroup, ngroup = [int(x) for x in txt.split('/')]
+        assert 0 <= igroup < ngroup, "wrong case group: " + txt
+        return igroup, ngroup
+
+    def get_my_cases(self, ncase):
+        '''
+        cases handled by this run. when independent runs are launched
+        with --case-group i/N, cases are distributed among them in
+        round-robin.
+        '''
+        igroup, ngroup = self.get_case_group()
+        cases = [k for k in range(ncase) if k % ngroup == igroup]
+        if ngroup > 1:
+            dprint1("case group " + str(igroup) + "/" + str(ngroup) +
+                    " : cases " + str(cases))
+        return cases
+
+    def save_case(self, engine, instance, od, kcase, ksolver):
+        path = os.path.join(od, 'case' + str(kcase))
+        if ksolver == 0:
+            engine.mkdir(path) 
+            os.chdir(path)
+            engine.cleancwd() 
+        else:
+            os.chdir(path)
+        
+        instance.save_solution(ksol = 0,
+                               skip_mesh = False, 
+                               mesh_only = False,
+                               save_parmesh=self.save_parmesh)
+        engine.sol = instance.sol
+        os.chdir(od)
+
+    def solve_rhs_batch(self, engine, instances, od, cases):
+        '''
+        solve RHSs of many cases (Reuse matrix mode) at once.
+           cases : list of (kcase, RHS)
+        '''
+        dprint1("solving RHS batch", [kcase for kcase, RHS in cases])
+        RHS_list = [RHS for kcase, RHS in cases]
+        for ksolver, instance in enumerate(instances):
+            instance.set_blk_mask()
+            if instance.linearsolver.is_iterative:
+                # iterative solver is called for each RHS
+                for kcase, RHS in cases:
+                    instance.blocks[2] = RHS
+                    instance.solve(update_operator = False)
+                    self.save_case(engine, instance, od, kcase, ksolver)
+                continue
+            
+            solall = instance.solve_rhs_batch(RHS_list)
+            for k, (kcase, RHS) in enumerate(cases):
+                instance.set_solution(solall, k)
+                self.save_case(engine, instance, od, kcase, ksolver)
+
     @debug.use_profiler
-    def run(self, engine):
+    def run(self, engine, is_first = True):
         if self.clear_wdir:
             engine.remove_solfiles()
 
         scanner = self.get_scanner()
-        if scanner is None: return
+        if scanner is None: return is_first
         
         solvers = self.get_inner_solvers()
         phys_models = []
@@ -102,87 +266,76 @@ class Parametric(Solver, NS_mixin):
                 if not p in phys_models: phys_models.append(p)
         scanner.set_phys_models(phys_models)
 
-        instances = []
+        # inner solvers share the same linear system. it is assembled
+        # by the first instance and solved by all instances
+        instances = [s.allocate_solver_instance(engine) for s in solvers]
+        if len(instances) == 0: return is_first
         od = os.getcwd()
-        
-        for ksolver, s in enumerate(solvers):
-            instance = s.allocate_solver_instance(engine)
-            finished = instance.init(s.init_only)
-            if finished: return
-
-            linearsolver = instance.allocate_linearsolver(s.is_complex)
-            A, X, RHS, Ae, B, M = instance.blocks        
-            AA = engine.finalize_matrix(A, not instance.phys_real,
-                                        format = instance.ls_type)
-            linearsolver.SetOperator(AA,
-                                     dist = engine.is_matrix_distributed)
-            instances.append((instance, linearsolver))            
 
-        for kcase, case in enumerate(scanner):
-            for ksolver, s in enumerate(solvers):
-                instance, linearsolver = instances[ksolver]
-                ls_type = instance.ls_type
-                phys_real = not s.is_complex()
-                A, X, RHS, Ae, B, M = instance.blocks
-                
-                if self.assembly_method == 0:
-                    # DO FULL ASSEMBLE:
-                    if kcase != 0:
-                        phys_target = instance.get_phys()                        
-                        engine.set_formblocks(phys_target, engine.n_matrix)
-                        engine.run_alloc_sol(phys_target)
-                        inits = s.get_init_setting()
-                        if len(inits) == 0:
-                             # in this case alloate all fespace and initialize all
-                             # to zero
-                             engine.run_apply_init(phys_target, 0)
-                        else:
-                            for init in inits:
-                                init.run(engine)
-                        engine.run_apply_essential(phys_target)
-                        instance.assemble()
-                        AA = engine.finalize_matrix(A, not phys_real,
-                                           format = ls_type)
-                        linearsolver.SetOperator(AA,
-                                                  dist = engine.is_matrix_distributed)
-                
-                    RHS = instance.blocks[2]        
-                elif self.assembly_method == 1:
-                    # ASSEMBLE RHS only
-                    if kcase != 0:
-                        instance.assemble_rhs()
-                        A, X, RHS, Ae, B, M = instance.blocks                        
-                        RHS = instance.compute_rhs(M, B, X)
-                        RHS = engine.eliminateBC(Ae, X[-1], RHS)
-                        RHS = engine.apply_interp(RHS=RHS)
-                else:
-                    assert False, "Unknown assembly mode..."
-                    
-                BB = engine.finalize_rhs([RHS], not phys_real,
-                                             format = ls_type)
-                solall = linearsolver.Mult(BB, case_base=kcase)
-                
-                if not phys_real and self.assemble_real:
-                    oprt = linearsolver.oprt
-                    solall = instance.linearsolver_model.real_to_complex(solall,
-                                                                         oprt)
-        
-                instance.sol = A.reformat_central_mat(solall, 0)
+        my_cases = self.get_my_cases(scanner.len())
+        if len(my_cases) == 0: return is_first
 
-                path = os.path.join(od, 'case' + str(kcase))
-                if ksolver == 0:
-                    engine.mkdir(path) 
-                    os.chdir(path)
-                    engine.cleancwd() 
-                else:
-                    os.chdir(path)
+        use_affine = False
+        if self.assembly_method == 2:
+            assert str(self.affine_terms).strip() != '', "affine terms are not given"
+            use_affine = True
+            samples = []    # (M, B) at sample cases
+            F = []          # affine terms at sample cases
+        use_batch = (self.assembly_method == 1 and self.rhs_batch_size > 1)
+        cases = []          # (kcase, RHS) waiting for batch solve
         
-                instance.save_solution(ksol = 0,
-                               skip_mesh = False, 
-                               mesh_only = False,
-                               save_parmesh=self.save_parmesh)
+        for kcase, case in enumerate(scanner):
+            if not kcase in my_cases: continue
+            is_first_case = (kcase == my_cases[0])
+            
+            if use_affine:
+                f = self.eval_affine_terms(scanner)
+                if len(samples) == len(f):
+                    F = np.array(F)
+                    if np.linalg.cond(F/self.affine_scale(F)) > 1e12:
+                        warnings.warn("affine terms at the first cases are "
+                                      "not independent. affine decomposition "
+                                      "is not used (falling back to full "
+                                      "assembly)", RuntimeWarning)
+                        use_affine = False
+                        samples = []
+            if is_first_case:
+                instances[0].set_blk_mask()
+                instances[0].assemble(inplace=False)
+                update_operator = True
+            elif use_affine and len(samples) == len(f):
+                self.combine_terms(engine, instances[0], samples, F, f)
+                update_operator = True
+            elif self.assembly_method in (0, 2):
+                # reassemble forms which depends on parameters
+                update_operator = self.update_assembly(engine, instances[0],
+                                                       scanner.names)
+            elif self.assembly_method == 1:
+                # ASSEMBLE RHS only
+                instances[0].assemble_rhs()
+                update_operator = False
+                if use_batch:
+                    cases.append((kcase, instances[0].blocks[2]))
+                    if (len(cases) == self.rhs_batch_size or
+                        kcase == my_cases[-1]):
+                        self.solve_rhs_batch(engine, instances, od, cases)
+                        cases = []
+                    continue
+            else:
+                assert False, "Unknown assembly mode..."
+
+            if use_affine and len(samples) < len(f):
+                samples.append(self.copy_M_B(engine))
+                F.append(f)
+
+            for ksolver, instance in enumerate(instances):
+                instance.set_blk_mask()
+                instance.solve(update_operator = (update_operator or
+                                                  is_first_case))
+                self.save_case(engine, instance, od, kcase, ksolver)
 
         print(debug.format_memory_usage())
+        return is_first
 
         
 '''    
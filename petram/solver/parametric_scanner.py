@@ -43,6 +43,13 @@ class DefaultParametricScanner(object):
     def len(self):
         return self.max
 
+    @property
+    def names(self):
+        '''
+        names of parameters changed by scanner. None if not known.
+        '''
+        return None
+
     def set_model(self, data):     
         raise NotImplementedError(
              "set model for parametric scanner needs to be given in subclass")
@@ -57,6 +64,12 @@ class SimpleScanner(DefaultParametricScanner):
         dprint1(data)
         DefaultParametricScanner.__init__(self, data = data)
 
+    @property
+    def names(self):
+        if (not isinstance(self.name, tuple) and 
+            not isinstance(self.name, list)):
+            return [self.name]
+        return list(self.name)
 
     def apply_param(self, data):
         if (not isinstance(self.name, tuple) and 
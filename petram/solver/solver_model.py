@@ -188,9 +188,11 @@ class Solver(SolverBase):
         v['init_only'] = False   
         v['assemble_real'] = False
         v['save_parmesh'] = False        
+        v['binary_solfile'] = False
         v['phys_model']   = ''
         #v['init_setting']   = ''
         v['use_profiler'] = False
+        v['vectorized_coeff'] = False
         v['probe'] = ''
         super(Solver, self).attribute_set(v)
         return v
@@ -284,7 +286,7 @@ class SolverInstance(object):
         self.phys_real = True
         self.ls_type = ''
         
-        
+        engine.vectorized_coeff = gui.vectorized_coeff
         self.set_linearsolver_model()
         
     def get_phys(self):
@@ -336,9 +338,11 @@ class SolverInstance(object):
         engine.save_sol_to_file(phys_target, 
                                 skip_mesh = skip_mesh,
                                 mesh_only = mesh_only,
-                                save_parmesh = save_parmesh)
+                                save_parmesh = save_parmesh,
+                                binary = self.gui.binary_solfile)
         if mesh_only: return
-        engine.save_extra_to_file(extra_data)
+        engine.save_extra_to_file(extra_data,
+                                  binary = self.gui.binary_solfile)
         #engine.is_initialzied = False
         
         
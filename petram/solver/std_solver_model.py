@@ -26,7 +26,11 @@ class StdSolver(Solver):
                 ["save parallel mesh",
                  self.save_parmesh,  3, {"text":""}],
                 ["use cProfiler",
-                 self.use_profiler,  3, {"text":""}],]
+                 self.use_profiler,  3, {"text":""}],
+                ["vectorized coefficient evaluation",
+                 self.vectorized_coeff,  3, {"text":""}],
+                ["binary solution file",
+                 self.binary_solfile,  3, {"text":""}],]
 
     def get_panel1_value(self):
         return (#self.init_setting,
@@ -35,7 +39,9 @@ class StdSolver(Solver):
                 self.clear_wdir,
                 self.assemble_real,
                 self.save_parmesh,
-                self.use_profiler)        
+                self.use_profiler,
+                self.vectorized_coeff,
+                self.binary_solfile)
     
     def import_panel1_value(self, v):
         #self.init_setting = str(v[0])        
@@ -45,7 +51,9 @@ class StdSolver(Solver):
 
         self.assemble_real = v[3]
         self.save_parmesh = v[4]
-        self.use_profiler = v[5]                
+        self.use_profiler = v[5]
+        self.vectorized_coeff = v[6]
+        self.binary_solfile = v[7]
 
     def get_editor_menus(self):
         return []
@@ -139,6 +147,7 @@ class StandardSolver(SolverInstance):
         SolverInstance.__init__(self, gui, engine)
         self.assembled = False
         self.linearsolver = None
+        self._AA = None
     @property
     def blocks(self):
         return self.engine.assembled_blocks
@@ -182,7 +191,11 @@ class StandardSolver(SolverInstance):
 
         return A and isAnew
         '''
-        return M[0], True
+        # new container so that BC elimination does not replace
+        # blocks of M[0], which are reused in update mode.
+        shape = M[0].shape
+        A = M[0].get_subblock([True]*shape[0], [True]*shape[1])
+        return A, np.any(mask_M)
     
     def compute_rhs(self, M, B, X):
         '''
@@ -190,7 +203,14 @@ class StandardSolver(SolverInstance):
         '''
         return B
 
-    def assemble(self):
+    def assemble(self, inplace=True, update=False):
+        '''
+        update = True renews only the forms of model objects whose
+        update_flag is set (see engine.set_update_flag). In this case,
+        the previous assembly should be done with inplace = False.
+
+        returns True if matrix is changed
+        '''
         engine = self.engine
         phys_target = self.get_phys()
         phys_range  = self.get_phys_range()
@@ -198,14 +218,23 @@ class StandardSolver(SolverInstance):
         # use get_phys to apply essential to all phys in solvestep        
         dprint1("in assemble", phys_target)
 
-        engine.run_verify_setting(phys_target, self.gui)
-        engine.run_assemble_mat(phys_target, phys_range)
-        engine.run_assemble_b(phys_target)
-        engine.run_fill_X_block()
+        if update:
+            engine.run_apply_essential(phys_target, phys_range, update=True)
+            engine.run_fill_X_block(update=True)
+        else:
+            engine.run_verify_setting(phys_target, self.gui)
+        engine.run_assemble_mat(phys_target, phys_range, update=update)
+        engine.run_assemble_b(phys_target, update=update)
+        if not update:
+            engine.run_fill_X_block()
         
-        self.engine.run_assemble_blocks(self.compute_A, self.compute_rhs)
+        blocks, M_changed = self.engine.run_assemble_blocks(self.compute_A,
+                                                           self.compute_rhs,
+                                                           inplace=inplace,
+                                                           update=update)
         #A, X, RHS, Ae, B, M, names = blocks
         self.assembled = True
+        return M_changed
         
     def assemble_rhs(self):
         engine = self.engine
@@ -213,6 +242,13 @@ class StandardSolver(SolverInstance):
         engine.run_assemble_b(phys_target)
         B = self.engine.run_update_B_blocks()
         self.blocks[4] = B
+
+        # recompute RHS using matrix already assembled
+        A, X, RHS, Ae, B, M, depvars = self.blocks
+        RHS = self.compute_rhs(M, B, X)
+        RHS = engine.eliminateBC(Ae, X[0], RHS)
+        RHS = engine.apply_interp(RHS=RHS)
+        self.blocks[2] = RHS
         self.assembled = True
 
     def solve(self, update_operator = True):
@@ -229,6 +265,10 @@ class StandardSolver(SolverInstance):
         if update_operator:
             AA = engine.finalize_matrix(A, mask, not self.phys_real,
                                     format = self.ls_type)
+            if not self.phys_real and self.gui.assemble_real:
+                self._AA = AA # kept for real_to_complex
+        else:
+            AA = self._AA
         BB = engine.finalize_rhs([RHS], A ,X[0], mask, not self.phys_real,
                                  format = self.ls_type)
 
@@ -262,6 +302,29 @@ class StandardSolver(SolverInstance):
 
         return True
 
+    def solve_rhs_batch(self, RHS_list):
+        '''
+        solve linear system for many RHS at once, using the operator
+        set in the previous solve. 
+        returns solutions as columns of central matrix (see set_solution)
+        '''
+        engine = self.engine
+        A, X, RHS, Ae, B, M, depvars = self.blocks
+        mask = self.blk_mask
+        
+        BB = engine.finalize_rhs(RHS_list, A, X[0], mask, not self.phys_real,
+                                 format = self.ls_type)
+        solall = self.linearsolver.Mult(BB, case_base=0)
+        
+        if not self.phys_real and self.gui.assemble_real:
+            solall = self.linearsolver_model.real_to_complex(solall, self._AA)
+        return solall
+
+    def set_solution(self, solall, ksol):
+        A, X, RHS, Ae, B, M, depvars = self.blocks
+        A.reformat_central_mat(solall, ksol, X[0], self.blk_mask)
+        self.sol = X[0]
+
 
         
         
@@ -233,9 +233,11 @@ class StdSolver(Solver):
         engine.save_sol_to_file(phys_target, 
                                 skip_mesh = skip_mesh,
                                 mesh_only = mesh_only,
-                                save_parmesh = self.save_parmesh)
+                                save_parmesh = self.save_parmesh,
+                                binary = self.binary_solfile)
         if mesh_only: return
-        engine.save_extra_to_file(extra_data)
+        engine.save_extra_to_file(extra_data,
+                                  binary = self.binary_solfile)
         engine.is_initialzied = False
         
     def run(self, engine):
@@ -51,7 +51,9 @@ class TimeDomain(Solver):
                 ["save parallel mesh",
                  self.save_parmesh,  3, {"text":""}],
                 ["use cProfiler",
-                 self.use_profiler,  3, {"text":""}],]
+                 self.use_profiler,  3, {"text":""}],
+                ["vectorized coefficient evaluation",
+                 self.vectorized_coeff,  3, {"text":""}],]
 
     def get_panel1_value(self):
         st_et_nt = ", ".join([str(x) for x in self.st_et_nt])
@@ -67,7 +69,8 @@ class TimeDomain(Solver):
                 self.init_only,               
                 self.assemble_real,
                 self.save_parmesh,
-                self.use_profiler,)
+                self.use_profiler,
+                self.vectorized_coeff,)
 
     
     def import_panel1_value(self, v):
@@ -82,6 +85,7 @@ class TimeDomain(Solver):
         self.assemble_real = v[6]
         self.save_parmesh = v[7]
         self.use_profiler = v[8]
+        self.vectorized_coeff = v[9]
         
         self.ts_method = str(v[3][0])
         self.time_step= float(v[3][1][0])